@@ -0,0 +1,102 @@
+from typing import NamedTuple
+from init_db import database
+
+
+# Spotify answers with large objects (markets, every image size, external urls, ...) of which we keep a few fields;
+# responses are turned into these records as soon as they arrive, and the in-memory caches and queues hold them too.
+# A record is a tuple: no per-instance dict, a few hundred bytes per album instead of kilobytes of parsed JSON
+
+
+class Album(NamedTuple):
+
+    # the columns of the albums table, same fields as AlbumOut (AlbumOut(**album._asdict()))
+    album_id: str
+    album_name: str
+    artist_name: str
+    artist_id: str
+    release_date: str
+    cover: str
+
+
+class Artist(NamedTuple):
+
+    artist_id: str
+    artist_name: str
+
+
+def album_from_spotify(album):
+
+    # Spotify lists the largest image first
+    return Album(
+        album_id=album["id"],
+        album_name=album["name"],
+        artist_name=album["artists"][0]["name"],
+        artist_id=album["artists"][0]["id"],
+        release_date=album["release_date"],
+        cover=album["images"][0]["url"] if album["images"] else "",
+    )
+
+
+def artist_from_spotify(artist):
+
+    return Artist(artist_id=artist["id"], artist_name=artist["name"])
+
+
+class AlbumManager:
+
+    async def missing_album_ids(self, album_ids):
+
+        if not album_ids:
+            return []
+
+        rows = await database.fetch_all(
+            "SELECT album_id FROM albums WHERE album_id = ANY(CAST(:album_ids AS TEXT[]))",
+            {"album_ids": list(album_ids)},
+        )
+        existing = {row["album_id"] for row in rows}
+
+        return [album_id for album_id in album_ids if album_id not in existing]
+
+    async def save_albums(self, albums, update=False):
+
+        # albums are Album records; one multi-row insert for the whole batch instead of one round trip per album
+        # Spotify release dates can be just a year or a year and a month, to_date fills in the missing parts
+        # update=True overwrites rows that already exist (the mirror refresh), otherwise they are left untouched
+        if not albums:
+            return
+
+        # DO UPDATE cannot touch the same row twice in one statement, so a batch repeating an album keeps the last one
+        albums = list({album.album_id: album for album in albums}.values())
+
+        on_conflict = (
+            """
+            DO UPDATE SET album_name = EXCLUDED.album_name, artist_name = EXCLUDED.artist_name,
+            artist_id = EXCLUDED.artist_id, release_date = EXCLUDED.release_date, cover = EXCLUDED.cover
+            """
+            if update
+            else "DO NOTHING"
+        )
+
+        await database.execute(
+            f"""
+            INSERT INTO albums (album_id, album_name, artist_name, artist_id, release_date, cover)
+            SELECT album_id, album_name, artist_name, artist_id, to_date(release_date, 'YYYY-MM-DD'), cover
+            FROM unnest(
+                CAST(:album_ids AS TEXT[]),
+                CAST(:album_names AS TEXT[]),
+                CAST(:artist_names AS TEXT[]),
+                CAST(:artist_ids AS TEXT[]),
+                CAST(:release_dates AS TEXT[]),
+                CAST(:covers AS TEXT[])
+            ) AS t(album_id, album_name, artist_name, artist_id, release_date, cover)
+            ON CONFLICT (album_id) {on_conflict}
+            """,
+            {
+                "album_ids": [album.album_id for album in albums],
+                "album_names": [album.album_name for album in albums],
+                "artist_names": [album.artist_name for album in albums],
+                "artist_ids": [album.artist_id for album in albums],
+                "release_dates": [album.release_date for album in albums],
+                "covers": [album.cover for album in albums],
+            },
+        )
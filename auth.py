@@ -1,54 +1,213 @@
-from passlib.context import CryptContext
 from dotenv import load_dotenv
 import os
+import functools
+import hashlib
+import hmac
+import time
+import uuid
+from collections import OrderedDict
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
-from jose import jwt, JWTError
-from fastapi import Depends, HTTPException, status
-from init_db import database
+from fastapi import Depends, HTTPException, Request, Response, status
+from init_db import database, reader, route_reads, REPLICA_STICKY_SECONDS
 from models import User
 
 
 load_dotenv()
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.getenv("SECRET_KEY")
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 1 day
+# access tokens carry the username and are trusted without a database lookup, so they are short-lived;
+# clients get a new one from /token/refresh, which does check the user
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))  # verified tokens remembered per worker
+# signing keys as kid:secret pairs, e.g. "2025-10:secret-a,2025-07:secret-b"; tokens name their key in the kid header,
+# so a new key can be added (and made active) while tokens signed with the previous one stay valid until they expire
+JWT_KEYS = dict(
+    pair.strip().split(":", 1) for pair in os.getenv("JWT_KEYS", "").split(",") if pair.strip()
+)
+if SECRET_KEY and not JWT_KEYS:
+    JWT_KEYS = {"default": SECRET_KEY}
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID") or next(iter(JWT_KEYS), None)  # the key new tokens are signed with
+# comma separated usernames allowed to use the /admin endpoints
+ADMIN_USERNAMES = {
+    name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()
+}
 oauth2scheme = OAuth2PasswordBearer(tokenUrl="/login")
+# read-your-writes marker: a write request answers with "<user_id>:<time>:<signature>" as this cookie and as the
+# X-Last-Write header; clients send it back (browsers keep the cookie, others echo the header) and whichever worker or
+# instance gets the next request reads from the primary until REPLICA_STICKY_SECONDS have passed
+LAST_WRITE_COOKIE = "last_write"
+LAST_WRITE_HEADER = "X-Last-Write"
 
 
 # oauth2scheme reads header requests, finds 'Authorization', extracts the token after Bearer and will pass it to get_current_user function
 # Authorization: Bearer <JWT_TOKEN>
 # tokenUrl = '/login' is only for swagger UI to know where to get the JWT token from
+# passlib loads its bcrypt backend and jose its crypto backends on import; both are only needed once a request
+# hashes a password or touches a token, so they are imported then and not when the app (or a DAG) is loaded
+@functools.cache
+def pwd_context():
+
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
 def hash_password(password):
 
-    return pwd_context.hash(password)
+    return pwd_context().hash(password)
 
 
 def verify_password(password, hashed_password):
 
-    return pwd_context.verify(password, hashed_password)
+    return pwd_context().verify(password, hashed_password)
 
 
-def create_access_token(data, expires_minutes=ACCESS_TOKEN_EXPIRE_MINUTES):
+def create_token(data, expires_delta, token_type):
 
     # a JWT token is usually composed of 2 elements: sub - subject, who the token is about; our subject will be the user_id, passed thorugh data as a string
     # and exp - expire_date, when the token expire
 
+    from jose import jwt
+
     if "sub" not in data:
         raise ValueError("Token payload must include 'sub'")
     to_encode = data.copy()
-    when_expires = datetime.utcnow() + timedelta(minutes=expires_minutes)
+    when_expires = datetime.utcnow() + expires_delta
     to_encode["exp"] = when_expires  # we add an expiration timestamp to the token
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode["type"] = token_type  # a refresh token must not be accepted as an access token and vice versa
+    return jwt.encode(
+        to_encode, JWT_KEYS[JWT_ACTIVE_KID], algorithm=ALGORITHM, headers={"kid": JWT_ACTIVE_KID}
+    )
+
+
+def create_access_token(user_id, username, expires_minutes=ACCESS_TOKEN_EXPIRE_MINUTES):
+
+    return create_token(
+        {"sub": str(user_id), "username": username}, timedelta(minutes=expires_minutes), "access"
+    )
+
+
+def create_refresh_token(user_id, expires_days=REFRESH_TOKEN_EXPIRE_DAYS):
+
+    # the jti identifies this token in used_refresh_tokens, so /token/refresh accepts it only once
+    return create_token(
+        {"sub": str(user_id), "jti": uuid.uuid4().hex}, timedelta(days=expires_days), "refresh"
+    )
+
+
+def decode_token(token):
+
+    # verifies the signature with the key named by the kid header and the expiry; raises JWTError
+    from jose import jwt, JWTError
+
+    kid = jwt.get_unverified_header(token).get("kid")
+    if kid is None:
+        # tokens issued before signing keys had ids were signed with SECRET_KEY
+        key = SECRET_KEY or JWT_KEYS.get("default")
+    else:
+        key = JWT_KEYS.get(kid)
+    if key is None:
+        raise JWTError(f"Unknown signing key {kid!r}")
+
+    return jwt.decode(token, key, algorithms=[ALGORITHM])
+
+
+def sign_last_write(user_id, at):
+
+    # signed with the active token key, so a client cannot pin its reads to the primary with a made-up time
+    message = f"{user_id}:{at:.3f}"
+    signature = hmac.new(JWT_KEYS[JWT_ACTIVE_KID].encode("utf-8"), message.encode("utf-8"), hashlib.sha256)
+    return f"{message}:{signature.hexdigest()[:32]}"
+
+
+def last_write(request, user_id):
+
+    # the time of the user's last write request from the marker the client sent back, None without a valid one
+    value = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    if not value or JWT_ACTIVE_KID is None:
+        return None
+
+    try:
+        marked_user, at, _ = value.split(":")
+        at = float(at)
+    except ValueError:
+        return None
+    if marked_user != str(user_id) or not hmac.compare_digest(value, sign_last_write(user_id, at)):
+        return None
+
+    return at
+
+
+def track_writes(request, response, user_id):
+
+    # called by get_current_user for every authenticated request; nothing to track without a replica
+    if reader.replica is None:
+        return
+
+    if request.method in ("GET", "HEAD"):
+        route_reads(last_write(request, user_id))
+        return
+
+    now = time.time()
+    marker = sign_last_write(user_id, now)
+    response.set_cookie(
+        LAST_WRITE_COOKIE, marker, max_age=int(REPLICA_STICKY_SECONDS) + 1, httponly=True, samesite="lax"
+    )
+    response.headers[LAST_WRITE_HEADER] = marker
+    route_reads(now)
+
+
+class TokenCache:
+
+    # token -> (User, exp) for recently verified access tokens, least recently used first; a hit skips the signature
+    # check, an entry is never used past the token's own expiry
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, token):
+
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+
+        user, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[token]
+            return None
+
+        self._entries.move_to_end(token)
+        return user
+
+    def put(self, token, user, expires_at):
+
+        self._entries[token] = (user, expires_at)
+        self._entries.move_to_end(token)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+token_cache = TokenCache()
 
 
 # Depends = (oauth2scheme) means: before running the get_current_user function, run the oauth2scheme function on the request, to extract the jwt token
 async def get_current_user(
+    request: Request,
+    response: Response,
     token: str = Depends(oauth2scheme),
 ) -> User:  # we return the Pydantic User model
 
     # to get the current user (their id), we have to decode the jwt token
+    from jose import JWTError
+
+    cached = token_cache.get(token)
+    if cached is not None:
+        track_writes(request, response, cached.id)
+        return cached
 
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -57,9 +216,9 @@ async def get_current_user(
     )
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         user_id = payload.get("sub", None)
-        if user_id is None:
+        if user_id is None or payload.get("type", "access") != "access":
 
             raise credentials_exception
 
@@ -67,14 +226,32 @@ async def get_current_user(
 
         raise credentials_exception
 
-    user = await database.fetch_one(
-        "select id, username from users where id = :user_id",
-        {"user_id": int(user_id)},
-    )
+    if "username" in payload:
+        user = User(id=int(user_id), username=payload["username"])
+    else:
+        # tokens issued before access tokens carried the username
+        row = await database.fetch_one(
+            "select id, username from users where id = :user_id",
+            {"user_id": int(user_id)},
+        )
 
-    if user is None:
-        raise credentials_exception
+        if row is None:
+            raise credentials_exception
+
+        user = User(
+            id=row["id"], username=row["username"]
+        )  # we create the Pydantic class object using the dict given by the db query
+
+    token_cache.put(token, user, payload["exp"])
+    track_writes(request, response, user.id)
+    return user
+
+
+async def get_admin_user(user: User = Depends(get_current_user)) -> User:
+
+    if user.username not in ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required"
+        )
 
-    return User(
-        id=user["id"], username=user["username"]
-    )  # we create the Pydantic class object using the dict given by the db query
+    return user
@@ -0,0 +1,121 @@
+import asyncio
+import functools
+import hashlib
+import os
+import random
+import struct
+import zlib
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+# a local stand-in for the parts of the Spotify Web API that spotify.py uses
+# every answer is derived from a hash of the request, so the same query always returns the same artists and albums
+# FAKE_SPOTIFY_LATENCY_MS / FAKE_SPOTIFY_JITTER_MS add a delay to every call, FAKE_SPOTIFY_ERROR_RATE fails a share of them
+
+LATENCY_MS = float(os.getenv("FAKE_SPOTIFY_LATENCY_MS", "50"))
+JITTER_MS = float(os.getenv("FAKE_SPOTIFY_JITTER_MS", "20"))
+ERROR_RATE = float(os.getenv("FAKE_SPOTIFY_ERROR_RATE", "0"))
+ALBUMS_PER_ARTIST = int(os.getenv("FAKE_SPOTIFY_ALBUMS_PER_ARTIST", "12"))
+RELATED_PER_ARTIST = int(os.getenv("FAKE_SPOTIFY_RELATED_PER_ARTIST", "10"))
+# where album covers point; bench/run.py points them at /image on this server so the cover proxy has something to fetch
+IMAGE_URL = os.getenv("FAKE_SPOTIFY_IMAGE_URL", "https://i.scdn.co/image")
+
+app = FastAPI()
+
+
+def _id(*parts):
+
+    return hashlib.sha1(":".join(parts).encode("utf-8")).hexdigest()[:22]
+
+
+def _artist(artist_id):
+
+    return {"id": artist_id, "name": f"Artist {artist_id[:6]}"}
+
+
+def _album(album_id, artist_id=None):
+
+    artist_id = artist_id or _id("artist-of", album_id)
+    year = 1960 + int(album_id[:4], 16) % 65
+    return {
+        "id": album_id,
+        "name": f"Album {album_id[:6]}",
+        "release_date": f"{year}-01-01",
+        "artists": [_artist(artist_id)],
+        "images": [
+            {"url": f"{IMAGE_URL}/{album_id}", "height": 640, "width": 640}
+        ],
+        "available_markets": ["US", "GB", "DE", "FR", "RO"],
+    }
+
+
+@app.middleware("http")
+async def latency_and_errors(request: Request, call_next):
+
+    await asyncio.sleep(max(0.0, LATENCY_MS + random.uniform(-JITTER_MS, JITTER_MS)) / 1000)
+    if random.random() < ERROR_RATE:
+        return JSONResponse(status_code=503, content={"error": "fake upstream error"})
+    return await call_next(request)
+
+
+@app.post("/api/token")
+async def token():
+    return {"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600}
+
+
+@app.get("/v1/search")
+async def search(q: str, type: str, limit: int = 1):
+
+    if type == "artist":
+        return {"artists": {"items": [_artist(_id("artist", q.lower()))]}}
+
+    return {"albums": {"items": [_album(_id("album", q.lower()))]}}
+
+
+@app.get("/v1/artists/{artist_id}/albums")
+async def artist_albums(artist_id: str):
+
+    return {
+        "items": [
+            _album(_id("album", artist_id, str(i)), artist_id)
+            for i in range(ALBUMS_PER_ARTIST)
+        ]
+    }
+
+
+@app.get("/v1/artists/{artist_id}/related-artists")
+async def related_artists(artist_id: str):
+
+    return {
+        "artists": [
+            _artist(_id("related", artist_id, str(i))) for i in range(RELATED_PER_ARTIST)
+        ]
+    }
+
+
+@app.get("/v1/albums")
+async def albums(ids: str):
+
+    return {"albums": [_album(album_id) for album_id in ids.split(",") if album_id]}
+
+
+@functools.lru_cache(maxsize=1024)
+def _png(image_id, size=640):
+
+    # a plain PNG in a color derived from the id, built by hand so the fake server needs no imaging library
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    row = b"\x00" + bytes.fromhex(_id("color", image_id)[:6]) * size
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * size))
+        + chunk(b"IEND", b"")
+    )
+
+
+@app.get("/image/{image_id}")
+async def image(image_id: str):
+
+    return Response(_png(image_id), media_type="image/png")
@@ -0,0 +1,84 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# import-time benchmark: what a cold worker (server.py) and the Airflow scheduler parsing a DAG file pay before doing
+# any work, measured with python -X importtime in fresh interpreters
+#
+#   python bench/importtime.py                       # every target, 5 runs each, best run reported
+#   python bench/importtime.py --top 15 server       # only the API, with the 15 most expensive top-level imports
+#   python bench/importtime.py --max-ms 400          # exit with status 1 when a target is slower, e.g. in CI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    "server": "import server",
+    "dags/dags.py": "import runpy; runpy.run_path('dags/dags.py')",
+    "dags/catalog_refresh.py": "import runpy; runpy.run_path('dags/catalog_refresh.py')",
+    "dags/trending.py": "import runpy; runpy.run_path('dags/trending.py')",
+}
+
+
+def measure(code):
+
+    # returns (total microseconds, {top-level module: cumulative microseconds}) for one fresh interpreter
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{code!r} failed:\n{result.stderr[-2000:]}")
+
+    # lines look like "import time:       450 |       1041 | server", nested imports are indented under the name
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.startswith(" ") and not name.startswith("  "):
+            modules[name.strip()] = modules.get(name.strip(), 0) + int(cumulative)
+
+    return sum(modules.values()), modules
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure the import time of the API and the DAG files")
+    parser.add_argument("targets", nargs="*", help=f"any of {', '.join(TARGETS)} (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per target, the best one is reported")
+    parser.add_argument("--top", type=int, default=5, help="top-level imports to list per target")
+    parser.add_argument("--max-ms", type=float, help="fail when a target takes longer than this")
+    parser.add_argument("--output", help="append the report to this file (e.g. bench_output.txt)")
+    args = parser.parse_args()
+
+    unknown = set(args.targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+
+    lines = []
+    too_slow = []
+    for target in args.targets or TARGETS:
+        total, modules = min((measure(TARGETS[target]) for _ in range(args.runs)), key=lambda run: run[0])
+        lines.append(f"{target:<28} {total / 1000:8.1f} ms")
+        for name, micros in sorted(modules.items(), key=lambda item: -item[1])[: args.top]:
+            lines.append(f"    {name:<32} {micros / 1000:8.1f} ms")
+        if args.max_ms is not None and total / 1000 > args.max_ms:
+            too_slow.append(target)
+
+    report = "\n".join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(report + "\n")
+
+    if too_slow:
+        print(f"over the {args.max_ms:.0f} ms budget: {', '.join(too_slow)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+import httpx
+
+# load test for the API: starts the fake Spotify server and the FastAPI app from server.py against BENCH_DATABASE_URL,
+# seeds it, then drives a mix of endpoints from many logged in users and reports throughput and latency per route
+#
+#   BENCH_DATABASE_URL=postgresql+asyncpg://... python bench/run.py --scale small --duration 60 --concurrency 50
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, "bench")
+sys.path.insert(0, BENCH_DIR)
+
+from seed import SCALES, BENCH_PASSWORD  # noqa: E402
+
+# (route template, weight); the templates are filled in by make_request
+MIX = [
+    ("GET /user/profile", 15),
+    ("GET /user/{username}/profile", 15),
+    ("GET /user/friends_activity", 15),
+    ("GET /user/get_recommendations", 10),
+    ("GET /user/get_followers", 5),
+    ("GET /user/get_following", 5),
+    ("GET /user/{username}/get_favorites", 5),
+    ("GET /search/album/{album_name}", 10),
+    ("GET /search/artist/{artist_name}", 5),
+    ("POST /album/{album_id}/rating", 10),
+    ("GET /album/{album_id}/cover?size=64", 5),
+    ("POST /user/{followed_id}/follow", 5),
+]
+
+
+def make_request(route, scale):
+
+    users = SCALES[scale]["users"]
+    albums = SCALES[scale]["albums"]
+    method, path = route.split(" ", 1)
+    body = None
+
+    if "{username}" in path:
+        path = path.replace("{username}", f"bench_user_{random.randint(1, users)}")
+    if "{album_name}" in path:
+        path = path.replace("{album_name}", f"Bench Album {random.randint(1, albums)}")
+    if "{artist_name}" in path:
+        # a small pool of names, so after warm-up most artist searches are served from the local mirror
+        path = path.replace("{artist_name}", f"artist {random.randint(1, 200)}")
+    if "{album_id}" in path:
+        path = path.replace("{album_id}", f"bench_album_{random.randint(1, albums)}")
+        body = {"rating": random.randint(0, 5), "review": "benchmark"}
+    if "{followed_id}" in path:
+        path = path.replace("{followed_id}", str(random.randint(1, users)))
+
+    return method, path, body
+
+
+def percentile(values, p):
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low, high = int(k), min(int(k) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+async def wait_until_up(url, timeout=30.0):
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+async def login(client, user_number):
+
+    response = await client.post(
+        "/login",
+        data={"username": f"bench_user_{user_number}", "password": BENCH_PASSWORD},
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def drive(base_url, args):
+
+    routes = [route for route, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30.0) as client:
+
+        user_numbers = random.sample(
+            range(1, SCALES[args.scale]["users"] + 1), args.concurrency
+        )
+        tokens = await asyncio.gather(*(login(client, n) for n in user_numbers))
+
+        deadline = time.monotonic() + args.duration
+
+        async def worker(token):
+            headers = {"Authorization": f"Bearer {token}"}
+            while time.monotonic() < deadline:
+                route = random.choices(routes, weights)[0]
+                method, path, body = make_request(route, args.scale)
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body, headers=headers)
+                    failed = response.status_code >= 500
+                except httpx.HTTPError:
+                    failed = True
+                latencies[route].append((time.perf_counter() - start) * 1000)
+                if failed:
+                    errors[route] += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker(token) for token in tokens))
+        elapsed = time.monotonic() - started
+
+    return latencies, errors, elapsed
+
+
+def report(latencies, errors, elapsed, args):
+
+    lines = [
+        f"scale={args.scale} concurrency={args.concurrency} duration={elapsed:.1f}s "
+        f"spotify_latency={args.spotify_latency_ms}ms spotify_error_rate={args.spotify_error_rate}",
+        f"{'route':<40} {'count':>8} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+    ]
+    total = 0
+    for route, _ in MIX:
+        values = latencies.get(route, [])
+        total += len(values)
+        lines.append(
+            f"{route:<40} {len(values):>8} {errors.get(route, 0):>7} {len(values) / elapsed:>8.1f} "
+            f"{percentile(values, 50):>8.1f} {percentile(values, 95):>8.1f} {percentile(values, 99):>8.1f}"
+        )
+    everything = [value for values in latencies.values() for value in values]
+    lines.append(
+        f"{'TOTAL':<40} {total:>8} {sum(errors.values()):>7} {total / elapsed:>8.1f} "
+        f"{percentile(everything, 50):>8.1f} {percentile(everything, 95):>8.1f} {percentile(everything, 99):>8.1f}"
+    )
+    if everything:
+        lines.append(f"mean latency {statistics.fmean(everything):.1f} ms")
+
+    output = "\n".join(lines)
+    print(output)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(output + "\n\n")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Load test the API against a local Spotify stand-in")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=20, help="simultaneous logged in users")
+    parser.add_argument("--app-port", type=int, default=8100)
+    parser.add_argument("--spotify-port", type=int, default=8101)
+    parser.add_argument("--spotify-latency-ms", type=float, default=50.0)
+    parser.add_argument("--spotify-error-rate", type=float, default=0.0)
+    parser.add_argument("--skip-seed", action="store_true", help="reuse the data already in the database")
+    parser.add_argument("--output", help="append the report to this file (e.g. bench_output.txt)")
+    args = parser.parse_args()
+
+    if not os.getenv("BENCH_DATABASE_URL"):
+        sys.exit("BENCH_DATABASE_URL is not set")
+
+    env = dict(
+        os.environ,
+        DATABASE_URL=os.environ["BENCH_DATABASE_URL"],
+        SPOTIFY_API_URL=f"http://127.0.0.1:{args.spotify_port}/v1",
+        SPOTIFY_ACCOUNTS_URL=f"http://127.0.0.1:{args.spotify_port}",
+        SPOTIFY_CLIENT_ID="bench",
+        SPOTIFY_CLIENT_SECRET="bench",
+        SECRET_KEY=os.getenv("SECRET_KEY", "benchmark-secret"),
+        FAKE_SPOTIFY_LATENCY_MS=str(args.spotify_latency_ms),
+        FAKE_SPOTIFY_ERROR_RATE=str(args.spotify_error_rate),
+        FAKE_SPOTIFY_IMAGE_URL=f"http://127.0.0.1:{args.spotify_port}/image",
+        BENCH_COVER_URL=f"http://127.0.0.1:{args.spotify_port}/image",
+    )
+    if os.getenv("BENCH_REPLICA_URL"):
+        # a replica of BENCH_DATABASE_URL, e.g. from bench/replica-compose.yml
+        env["DATABASE_REPLICA_URL"] = os.environ["BENCH_REPLICA_URL"]
+
+    if not args.skip_seed:
+        subprocess.run(
+            [sys.executable, os.path.join(BENCH_DIR, "seed.py"), "--scale", args.scale],
+            env=env,
+            check=True,
+        )
+
+    uvicorn = [sys.executable, "-m", "uvicorn", "--log-level", "warning"]
+    processes = [
+        subprocess.Popen(
+            uvicorn + ["--app-dir", BENCH_DIR, "--port", str(args.spotify_port), "fake_spotify:app"],
+            env=env,
+            cwd=ROOT,
+        ),
+        subprocess.Popen(
+            uvicorn + ["--port", str(args.app_port), "server:app"], env=env, cwd=ROOT
+        ),
+    ]
+
+    base_url = f"http://127.0.0.1:{args.app_port}"
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{args.spotify_port}/docs"))
+        asyncio.run(wait_until_up(f"{base_url}/docs"))
+        latencies, errors, elapsed = asyncio.run(drive(base_url, args))
+        report(latencies, errors, elapsed, args)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import os
+import sys
+
+# seeds a benchmark database with synthetic users, albums, reviews, favorites and follow graphs
+# WARNING: every table is truncated first, only point BENCH_DATABASE_URL at a throwaway database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCALES = {
+    "small": {"users": 1_000, "artists": 500, "albums": 5_000, "reviews": 20_000, "follows": 10_000},
+    "medium": {"users": 10_000, "artists": 5_000, "albums": 50_000, "reviews": 200_000, "follows": 100_000},
+    "large": {"users": 100_000, "artists": 20_000, "albums": 200_000, "reviews": 2_000_000, "follows": 1_000_000},
+}
+BENCH_PASSWORD = "benchmark"
+# bench/run.py points this at the fake Spotify server, so /album/{album_id}/cover can be benchmarked offline
+BENCH_COVER_URL = os.getenv("BENCH_COVER_URL", "https://i.scdn.co/image")
+
+
+async def seed(scale):
+
+    import init_db
+    from auth import hash_password
+
+    await init_db.main()
+
+    database = init_db.database
+    await database.connect()
+
+    # every benchmark user gets the same password, hashing it once keeps seeding fast
+    params = dict(SCALES[scale], password_hash=hash_password(BENCH_PASSWORD))
+
+    await database.execute(
+        "TRUNCATE users, albums, artists RESTART IDENTITY CASCADE"
+    )
+    await database.execute(
+        """
+        INSERT INTO users (username, password_hash)
+        SELECT 'bench_user_' || g, :password_hash FROM generate_series(1, :users) g
+        """,
+        {"users": params["users"], "password_hash": params["password_hash"]},
+    )
+    await database.execute(
+        """
+        INSERT INTO albums (album_id, album_name, artist_name, artist_id, release_date, cover)
+        SELECT
+            'bench_album_' || g,
+            'Bench Album ' || g,
+            'Bench Artist ' || (g % :artists),
+            'bench_artist_' || (g % :artists),
+            DATE '1960-01-01' + (g % 23000),
+            :cover_url || '/bench_album_' || g
+        FROM generate_series(1, :albums) g
+        """,
+        {"albums": params["albums"], "artists": params["artists"], "cover_url": BENCH_COVER_URL},
+    )
+    # a few users write most of the reviews and a few accounts get most of the follows, like a real social graph
+    await database.execute(
+        """
+        INSERT INTO reviews (user_id, album_id, rating, review, created_at, updated_at)
+        SELECT
+            1 + floor(:users * power(random(), 2))::int,
+            'bench_album_' || (1 + floor(:albums * random())::int),
+            floor(random() * 6)::int,
+            'benchmark review',
+            NOW() - random() * INTERVAL '60 days',
+            NULL
+        FROM generate_series(1, :reviews)
+        ON CONFLICT (user_id, album_id) DO NOTHING
+        """,
+        {"users": params["users"], "albums": params["albums"], "reviews": params["reviews"]},
+    )
+    await database.execute(
+        """
+        INSERT INTO followers (follower_id, followed_id)
+        SELECT f, t FROM (
+            SELECT 1 + floor(:users * random())::int AS f, 1 + floor(:users * power(random(), 3))::int AS t
+            FROM generate_series(1, :follows)
+        ) pairs
+        WHERE f <> t
+        ON CONFLICT (follower_id, followed_id) DO NOTHING
+        """,
+        {"users": params["users"], "follows": params["follows"]},
+    )
+    await database.execute(
+        """
+        INSERT INTO favorites (user_id, album_id)
+        SELECT u, 'bench_album_' || (1 + floor(:albums * random())::int)
+        FROM generate_series(1, :users) u, generate_series(1, 3)
+        ON CONFLICT (user_id, album_id) DO NOTHING
+        """,
+        {"users": params["users"], "albums": params["albums"]},
+    )
+    await database.execute("ANALYZE")
+
+    await database.disconnect()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Seed the benchmark database")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    args = parser.parse_args()
+
+    if not os.getenv("BENCH_DATABASE_URL"):
+        sys.exit("BENCH_DATABASE_URL is not set")
+
+    # init_db reads DATABASE_URL when it is imported
+    os.environ["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+
+    asyncio.run(seed(args.scale))
+    print(f"seeded scale={args.scale}: {SCALES[args.scale]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from album_manager import AlbumManager
+
+load_dotenv()
+CATALOG_QUEUE_SIZE = int(os.getenv("CATALOG_QUEUE_SIZE", "1000"))
+CATALOG_BATCH_SIZE = int(os.getenv("CATALOG_BATCH_SIZE", "100"))
+CATALOG_FLUSH_INTERVAL = float(os.getenv("CATALOG_FLUSH_INTERVAL", "1.0"))  # seconds
+
+logger = logging.getLogger(__name__)
+album_manager = AlbumManager()
+
+
+class CatalogWriter:
+
+    # write-behind buffer for album rows coming from the search endpoints: handlers enqueue and return right away,
+    # a background task writes the rows in batches when batch_size is reached or flush_interval has passed
+
+    def __init__(
+        self,
+        max_queue=CATALOG_QUEUE_SIZE,
+        batch_size=CATALOG_BATCH_SIZE,
+        flush_interval=CATALOG_FLUSH_INTERVAL,
+    ):
+
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = {}  # album_id -> album, everything enqueued but not written yet
+        self._task = None
+
+        self.flushes = 0
+        self.albums_written = 0
+        self.albums_failed = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def start(self):
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10.0):
+
+        # wait for everything already enqueued to be written, then stop the background task
+        if self._task is None:
+            return
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "catalog writer stopped with %d albums still queued", self.queue.qsize()
+            )
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def enqueue(self, album):
+
+        # put() waits while the queue is full, so a burst of searches slows down instead of growing memory without bound
+        self._pending[album.album_id] = album
+        await self.queue.put(album)
+
+    async def ensure_written(self, album_ids):
+
+        # a user usually rates or favorites an album right after finding it through search; those writes reference
+        # albums(album_id), so albums still sitting in the queue are written immediately (the insert is idempotent)
+        albums = [self._pending[a] for a in album_ids if a in self._pending]
+        if albums:
+            await album_manager.save_albums(albums)
+
+    async def _run(self):
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+
+        # the same album can be enqueued by several searches before a flush
+        albums = list({album.album_id: album for album in batch}.values())
+
+        start = time.perf_counter()
+        try:
+            await album_manager.save_albums(albums)
+            self.albums_written += len(albums)
+        except Exception:
+            logger.exception("catalog writer failed to write %d albums", len(albums))
+            self.albums_failed += len(albums)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.flushes += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+            for album in albums:
+                self._pending.pop(album.album_id, None)
+            for _ in batch:
+                self.queue.task_done()
+
+    def stats(self):
+
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "flushes": self.flushes,
+            "albums_written": self.albums_written,
+            "albums_failed": self.albums_failed,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "avg_flush_seconds": (
+                self.total_flush_seconds / self.flushes if self.flushes else 0.0
+            ),
+        }
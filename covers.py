@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from metrics import record_cache, timed_upstream
+
+# album cover proxy: every cover is downloaded once into a content-addressed disk cache (the file name is the sha256
+# of the image), smaller variants are rendered from it in worker processes, and both are served with an ETag derived
+# from the content, so clients and CDNs can keep them forever
+#
+#   COVER_CACHE_DIR/refs/<sha256 of the url>     -> sha256 of the image behind that url
+#   COVER_CACHE_DIR/<ab>/<sha256>                -> the original image
+#   COVER_CACHE_DIR/<ab>/<sha256>-<size>.jpg     -> the variant at most <size> px on its longest side
+#
+# anything in the directory can be deleted at any time, it is rebuilt on the next request
+
+load_dotenv()
+COVER_CACHE_DIR = os.getenv("COVER_CACHE_DIR", os.path.join(".cache", "covers"))
+COVER_SIZES = tuple(sorted(int(size) for size in os.getenv("COVER_SIZES", "64,300").split(",")))
+COVER_WORKERS = int(os.getenv("COVER_WORKERS", "2"))
+COVER_MAX_BYTES = 5 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def make_variant(source, target, size):
+
+    # runs in a worker process: resizing a 640px JPEG takes tens of milliseconds of CPU, which would stall the loop
+    from PIL import Image
+
+    with Image.open(source) as image:
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+        temporary = f"{target}.{os.getpid()}.tmp"
+        image.save(temporary, "JPEG", quality=85, optimize=True)
+    os.replace(temporary, target)
+
+
+def media_type(head):
+
+    if head.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+@timed_upstream("spotify.cover")
+async def fetch_cover(url):
+
+    from spotify import http_client
+
+    # streamed, so an oversized (or endless) response is abandoned once it passes COVER_MAX_BYTES instead of being
+    # read into memory first
+    too_large = ValueError(f"Cover at {url} is larger than {COVER_MAX_BYTES} bytes")
+    chunks = []
+    received = 0
+
+    async with http_client() as client:
+        async with client.stream("GET", url, follow_redirects=True) as response:
+            response.raise_for_status()
+            if int(response.headers.get("content-length", 0)) > COVER_MAX_BYTES:
+                raise too_large
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                if received > COVER_MAX_BYTES:
+                    raise too_large
+                chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+def write_file(path, content):
+
+    # written under a temporary name and renamed, so a reader never sees half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+
+def read_head(path, size=16):
+
+    with open(path, "rb") as f:
+        return f.read(size)
+
+
+class CoverCache:
+
+    def __init__(self, directory=COVER_CACHE_DIR, sizes=COVER_SIZES, workers=COVER_WORKERS):
+
+        self.directory = directory
+        self.sizes = sizes
+        self.workers = workers
+        self._pool = None
+        self._resizing = None  # whether Pillow is installed, checked on the first variant
+        self._inflight = {}  # key -> task, so concurrent requests for the same image download or resize it once
+
+    def _path(self, digest, suffix=""):
+
+        return os.path.join(self.directory, digest[:2], digest + suffix)
+
+    def variant_size(self, size):
+
+        # requested sizes snap to the next configured one, so the cache holds a bounded number of variants
+        if size is None:
+            return None
+        return next((allowed for allowed in self.sizes if allowed >= size), None)
+
+    async def _once(self, key, fn):
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # a client going away must not cancel the download other requests are waiting for
+        return await asyncio.shield(task)
+
+    async def original(self, url):
+
+        # returns the sha256 of the image at url, downloading it on the first request
+        ref = os.path.join(self.directory, "refs", hashlib.sha256(url.encode("utf-8")).hexdigest())
+        try:
+            digest = await asyncio.to_thread(lambda: open(ref).read().strip())
+            if os.path.exists(self._path(digest)):
+                record_cache("cover", True)
+                return digest
+        except FileNotFoundError:
+            pass
+
+        record_cache("cover", False)
+
+        async def download():
+            content = await fetch_cover(url)
+            digest = hashlib.sha256(content).hexdigest()
+            await asyncio.to_thread(write_file, self._path(digest), content)
+            await asyncio.to_thread(write_file, ref, digest.encode("ascii"))
+            return digest
+
+        return await self._once(url, download)
+
+    async def get(self, url, size=None):
+
+        # returns (path, etag, media type) of the cover at url, at most `size` px when a size is asked for
+        digest = await self.original(url)
+        size = self.variant_size(size)
+
+        if size is not None and self._resizing is None:
+            self._resizing = importlib.util.find_spec("PIL") is not None
+            if not self._resizing:
+                logger.warning("Pillow is not installed, covers are served at their original size")
+
+        if size is None or not self._resizing:
+            path = self._path(digest)
+            return path, f'"{digest}"', media_type(await asyncio.to_thread(read_head, path))
+
+        path = self._path(digest, f"-{size}.jpg")
+        if not os.path.exists(path):
+
+            async def resize():
+                if self._pool is None:
+                    # spawned rather than forked, the API process has threads (watchdog, profiler) of its own
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self._pool, make_variant, self._path(digest), path, size)
+
+            await self._once(path, resize)
+
+        return path, f'"{digest}-{size}"', "image/jpeg"
+
+    async def stop(self):
+
+        if self._pool is not None:
+            await asyncio.to_thread(self._pool.shutdown)
+            self._pool = None
@@ -0,0 +1,44 @@
+import asyncio
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from datetime import datetime, timedelta
+
+
+async def refresh_catalog():
+
+    # imported here rather than at the top, so parsing the DAG file stays cheap for the scheduler
+    from spotify import refresh_stale_artists
+    from init_db import database
+
+    await database.connect()
+    try:
+        refreshed = await refresh_stale_artists(limit=500)
+        print(f"Refreshed {refreshed} artists from Spotify")
+    finally:
+        await database.disconnect()
+
+
+def run_refresh_catalog():
+
+    # PythonOperator calls a plain function, so the coroutine has to be run here
+    asyncio.run(refresh_catalog())
+
+
+default_args = {
+    "owner": "airflow",
+    "depends_on_past": False,
+    "start_date": datetime(2025, 9, 14),
+    "retries": 1,
+    "retry_delay": timedelta(minutes=5),
+}
+with DAG(
+    "spotify_catalog_refresh",
+    default_args=default_args,
+    description="Refresh the local mirror of Spotify artists, discographies and related artists",
+    schedule_interval="@daily",
+    catchup=False,
+) as dag:
+
+    refresh_artists = PythonOperator(
+        task_id="refresh_stale_artists", python_callable=run_refresh_catalog
+    )
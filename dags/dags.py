@@ -1,22 +1,73 @@
-from user_manager import UserManager, other_albums_by_artist, collaborative_filtering
+import asyncio
+import os
+from recommendation_stages import STAGES
 from airflow import DAG
 from airflow.operators.python import PythonOperator
 from datetime import datetime, timedelta
 
-user_manager = UserManager()
+# users are split into PARTITIONS id ranges and every (stage, partition) pair is its own task, so the stages and the
+# partitions run in parallel and a failed task is retried alone; progress is checkpointed in the database after every
+# batch, so a retry resumes inside its partition instead of starting it over
+# every run builds a new generation of recommendations, swapped in by the last task once all partitions succeeded
+# the scheduler re-parses this file every few seconds, so the database and Spotify stack is only imported inside the tasks
+PARTITIONS = int(os.getenv("RECOMMENDATION_PARTITIONS", "8"))
+BATCH_SIZE = int(os.getenv("RECOMMENDATION_BATCH_SIZE", "200"))
 
 
-async def recommendation_engine():
+async def with_database(coroutine_fn, *args):
 
-    await user_manager.other_albums_by_artist()
-    await user_manager.collaborative_filtering()
+    from init_db import database, reader
+
+    await database.connect()
+    await reader.connect()  # the runner reads users and reviews from the replica when one is configured
+    try:
+        return await coroutine_fn(*args)
+    finally:
+        await reader.disconnect()
+        await database.disconnect()
+
+
+def plan_partitions(run_id, **context):
+
+    # PythonOperator calls plain functions, so every task runs its coroutine with asyncio.run
+    # the DAG run id keys the checkpoints and the generation: it is unique per run (a manual trigger on the day of a
+    # scheduled run gets its own) and stays the same across task retries and clears, which reuse the checkpoints
+    from recommendation_runner import RecommendationRunner
+
+    runner = RecommendationRunner()
+
+    async def plan():
+        await runner.plan(run_id, PARTITIONS)
+        await runner.begin_generation(run_id)
+
+    asyncio.run(with_database(plan))
+
+
+def run_partition(stage, partition, run_id, **context):
+
+    from recommendation_runner import RecommendationRunner
+
+    runner = RecommendationRunner()
+    users, created = asyncio.run(
+        with_database(runner.run_partition, run_id, stage, partition, BATCH_SIZE)
+    )
+    print(f"{stage} partition {partition}: {users} users, {created} new recommendations")
+
+
+def activate_generation(run_id, **context):
+
+    from recommendation_runner import RecommendationRunner
+
+    runner = RecommendationRunner()
+    dropped = asyncio.run(with_database(runner.activate, run_id))
+    print(f"generation of {run_id} activated, {dropped} old generations dropped")
 
 
 default_args = {
     "owner": "airflow",
     "depends_on_past": False,
     "start_date": datetime(2025, 9, 14),
-    "retries": 1,
+    "retries": 3,
     "retry_delay": timedelta(minutes=5),
 }
 with DAG(
@@ -27,6 +78,13 @@ with DAG(
     catchup=False,
 ) as dag:
 
-    generate_recommendations = PythonOperator(
-        task_id="generate_recommendations", python_callable=recommendation_engine
-    )
+    plan = PythonOperator(task_id="plan_partitions", python_callable=plan_partitions)
+    activate = PythonOperator(task_id="activate_generation", python_callable=activate_generation)
+
+    for stage in STAGES:
+        for partition in range(PARTITIONS):
+            plan >> PythonOperator(
+                task_id=f"{stage}_partition_{partition}",
+                python_callable=run_partition,
+                op_kwargs={"stage": stage, "partition": partition},
+            ) >> activate
@@ -0,0 +1,43 @@
+import asyncio
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from datetime import datetime, timedelta
+
+
+async def update_trending():
+
+    # imported here rather than at the top, so parsing the DAG file stays cheap for the scheduler
+    from trending import recompute_trending
+    from init_db import database
+
+    await database.connect()
+    try:
+        await recompute_trending()
+    finally:
+        await database.disconnect()
+
+
+def run_update_trending():
+
+    # PythonOperator calls a plain function, so the coroutine has to be run here
+    asyncio.run(update_trending())
+
+
+default_args = {
+    "owner": "airflow",
+    "depends_on_past": False,
+    "start_date": datetime(2025, 9, 14),
+    "retries": 1,
+    "retry_delay": timedelta(minutes=1),
+}
+with DAG(
+    "trending_albums",
+    default_args=default_args,
+    description="Recompute the time-decayed trending albums ranking",
+    schedule_interval="*/15 * * * *",
+    catchup=False,
+) as dag:
+
+    recompute = PythonOperator(
+        task_id="recompute_trending", python_callable=run_update_trending
+    )
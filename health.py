@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from init_db import database, reader, REPLICA_MAX_LAG_SECONDS
+from metrics import in_flight, registry
+
+# dependency state for the /health endpoints: a background task probes the database (and the read replica, if there
+# is one) and measures event loop lag every HEALTH_PROBE_SECONDS, so a load balancer or autoscaler polling the
+# endpoints never causes a query; pool usage and the Spotify error rate are read from memory when asked
+
+load_dotenv()
+HEALTH_PROBE_SECONDS = float(os.getenv("HEALTH_PROBE_SECONDS", "5"))
+HEALTH_DB_TIMEOUT_SECONDS = float(os.getenv("HEALTH_DB_TIMEOUT_SECONDS", "1"))
+HEALTH_MAX_LOOP_LAG_MS = float(os.getenv("HEALTH_MAX_LOOP_LAG_MS", "250"))
+HEALTH_MAX_POOL_SATURATION = float(os.getenv("HEALTH_MAX_POOL_SATURATION", "1.0"))  # in use / max size
+HEALTH_MAX_UPSTREAM_ERROR_RATE = float(os.getenv("HEALTH_MAX_UPSTREAM_ERROR_RATE", "0.5"))
+UPSTREAM_MIN_CALLS = 5  # fewer Spotify calls than this between two probes says nothing about its health
+
+logger = logging.getLogger(__name__)
+
+
+def pool_stats():
+
+    # asyncpg's pool behind databases; (in use, max size), or None before connect()
+    pool = getattr(getattr(database, "_backend", None), "_pool", None)
+    if pool is None:
+        return None
+
+    return pool.get_size() - pool.get_idle_size(), pool.get_max_size()
+
+
+def upstream_totals():
+
+    calls = errors = 0
+    for (name, labels), value in list(registry.counters.items()):
+        if not dict(labels).get("call", "").startswith("spotify"):
+            continue
+        if name == "upstream_calls_total":
+            calls += value
+        elif name == "upstream_errors_total":
+            errors += value
+
+    return calls, errors
+
+
+class HealthMonitor:
+
+    def __init__(self, probe_seconds=HEALTH_PROBE_SECONDS):
+
+        self.probe_seconds = probe_seconds
+        self.db_ok = False
+        self.db_latency_ms = None
+        self.db_error = None
+        self.loop_lag_ms = 0.0
+        self.replica_ok = None  # None without a replica
+        self.replica_lag_seconds = None
+        self.replica_error = None
+        self.upstream_calls = 0
+        self.upstream_error_rate = 0.0
+        self.probed_at = None
+        self._upstream_totals = upstream_totals()
+        self._task = None
+
+    def start(self):
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.probe()
+
+            # how late the loop wakes us up is how long any callback waits for its turn right now
+            scheduled = loop.time()
+            await asyncio.sleep(self.probe_seconds)
+            self.loop_lag_ms = max(0.0, (loop.time() - scheduled - self.probe_seconds) * 1000)
+
+    async def probe(self):
+
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(database.fetch_val("SELECT 1"), HEALTH_DB_TIMEOUT_SECONDS)
+            self.db_ok = True
+            self.db_error = None
+        except Exception as e:
+            # a timeout here usually means every pooled connection is busy
+            self.db_ok = False
+            self.db_error = type(e).__name__
+            logger.warning("database health probe failed: %r", e)
+        self.db_latency_ms = (time.perf_counter() - start) * 1000
+
+        if reader.replica is not None:
+            await self.probe_replica()
+
+        calls, errors = upstream_totals()
+        last_calls, last_errors = self._upstream_totals
+        self._upstream_totals = (calls, errors)
+        self.upstream_calls = int(calls - last_calls)
+        self.upstream_error_rate = (errors - last_errors) / self.upstream_calls if self.upstream_calls else 0.0
+
+        self.probed_at = time.time()
+
+    async def probe_replica(self):
+
+        # a replica that does not answer or lags more than REPLICA_MAX_LAG_SECONDS gets no reads until it recovers;
+        # the worker stays ready, the primary can serve the reads in the meantime
+        try:
+            # the lag is 0 when everything received is replayed, otherwise the age of the last replayed transaction;
+            # NULL on a server that is not a standby
+            lag = await asyncio.wait_for(
+                reader.replica.fetch_val(
+                    """
+                    SELECT CASE
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                    END
+                    """
+                ),
+                HEALTH_DB_TIMEOUT_SECONDS,
+            )
+            self.replica_lag_seconds = float(lag) if lag is not None else None
+            self.replica_ok = lag is None or lag <= REPLICA_MAX_LAG_SECONDS
+            self.replica_error = None if self.replica_ok else "lagging"
+        except Exception as e:
+            self.replica_ok = False
+            self.replica_lag_seconds = None
+            self.replica_error = type(e).__name__
+            logger.warning("replica health probe failed: %r", e)
+
+        if reader.replica_healthy != self.replica_ok:
+            logger.warning("reads %s the replica", "return to" if self.replica_ok else "bypass")
+        reader.replica_healthy = self.replica_ok
+
+    def capacity(self):
+
+        # one number for the autoscaler: the most saturated of the pool and the event loop, 1.0 = at the limit
+        pool = pool_stats()
+        pool_saturation = pool[0] / pool[1] if pool else 0.0
+        loop_saturation = self.loop_lag_ms / HEALTH_MAX_LOOP_LAG_MS if HEALTH_MAX_LOOP_LAG_MS else 0.0
+
+        return {
+            "saturation": round(max(pool_saturation, loop_saturation), 3),
+            "in_flight": in_flight(),
+            "pool_in_use": pool[0] if pool else None,
+            "pool_max": pool[1] if pool else None,
+            "pool_saturation": round(pool_saturation, 3),
+            "loop_lag_ms": round(self.loop_lag_ms, 1),
+        }
+
+    def readiness(self, warmed_up):
+
+        # returns (ready, details); Spotify is shared by every worker, so its state is reported but taking this worker
+        # out of rotation would not route around it
+        capacity = self.capacity()
+        checks = {
+            "warmed_up": warmed_up,
+            "database": self.db_ok,
+            "pool": capacity["pool_saturation"] < HEALTH_MAX_POOL_SATURATION,
+            "event_loop": capacity["loop_lag_ms"] < HEALTH_MAX_LOOP_LAG_MS,
+        }
+        upstream_degraded = (
+            self.upstream_calls >= UPSTREAM_MIN_CALLS
+            and self.upstream_error_rate >= HEALTH_MAX_UPSTREAM_ERROR_RATE
+        )
+
+        return all(checks.values()), {
+            "checks": checks,
+            "database": {"latency_ms": self.db_latency_ms, "error": self.db_error},
+            "replica": {
+                "in_use": self.replica_ok,
+                "lag_seconds": self.replica_lag_seconds,
+                "error": self.replica_error,
+            },
+            "spotify": {
+                "status": "degraded" if upstream_degraded else "ok",
+                "calls": self.upstream_calls,
+                "error_rate": round(self.upstream_error_rate, 3),
+            },
+            "capacity": capacity,
+            "probed_at": self.probed_at,
+        }
@@ -1,12 +1,89 @@
 import asyncio
+import contextvars
+import re
+import time
 from databases import Database
 from dotenv import load_dotenv
+from metrics import InstrumentedDatabase
 import os
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-database = Database(DATABASE_URL)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))  # connections opened (and warmed up by server.py) at startup
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+database = InstrumentedDatabase(
+    Database(DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+)  # times every query for the per-request metrics
+
+# optional streaming replica for read-only queries; `database` stays the primary and takes every write
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# a user who sent a write request reads from the primary for this long, so they see their own write despite replica lag
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+# the health monitor stops sending reads to a replica that is further behind than this (or does not answer)
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "30"))
+replica = (
+    InstrumentedDatabase(
+        Database(DATABASE_REPLICA_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+    )
+    if DATABASE_REPLICA_URL
+    else None
+)
+
+_read_from_primary = contextvars.ContextVar("read_from_primary", default=False)
+
+
+def route_reads(last_write):
+
+    # called by get_current_user for every authenticated request with the time.time() of the user's last write
+    # request (None when there was none); the time travels with the client (see auth.track_writes), so every
+    # worker and every instance sends the reads of a user who wrote less than REPLICA_STICKY_SECONDS ago to the primary
+    _read_from_primary.set(last_write is not None and time.time() - last_write < REPLICA_STICKY_SECONDS)
+
+
+class ReadDatabase:
+
+    # the read side: read-only handlers and the recommendation readers use `reader` instead of `database`;
+    # queries go to the replica when there is one, and to the primary without one or when the request is sticky
+    # (reads inside a transaction or followed by a write that depends on them keep using `database`)
+
+    def __init__(self, primary, replica=None):
+
+        self.primary = primary
+        self.replica = replica
+        self.replica_healthy = True  # set by the HealthMonitor's replica probe
+
+    def _target(self):
+
+        if self.replica is None or not self.replica_healthy or _read_from_primary.get():
+            return self.primary
+        return self.replica
+
+    async def connect(self):
+
+        if self.replica is not None:
+            await self.replica.connect()
+
+    async def disconnect(self):
+
+        if self.replica is not None:
+            await self.replica.disconnect()
+
+    async def fetch_all(self, *args, **kwargs):
+        return await self._target().fetch_all(*args, **kwargs)
+
+    async def fetch_one(self, *args, **kwargs):
+        return await self._target().fetch_one(*args, **kwargs)
+
+    async def fetch_val(self, *args, **kwargs):
+        return await self._target().fetch_val(*args, **kwargs)
+
+    async def iterate(self, *args, **kwargs):
+        async for row in self._target().iterate(*args, **kwargs):
+            yield row
+
+
+reader = ReadDatabase(database, replica)
 
 CREATE_USERS_TABLE = """
 CREATE TABLE IF NOT EXISTS users (
@@ -67,6 +144,7 @@ CREATE TABLE IF NOT EXISTS followers (
 );
 """
 
+# migration 7 replaces this table with one partitioned by recommendation generation
 CREATE_RECOMMENDATIONS_TABLE = """
 CREATE TABLE IF NOT EXISTS recommendations (
     id SERIAL PRIMARY KEY,
@@ -79,6 +157,315 @@ CREATE TABLE IF NOT EXISTS recommendations (
 """
 
 
+CREATE_SCHEMA_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# each migration is (version, name, statements); versions are applied in order and recorded in schema_migrations
+# CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so every statement is executed on its own;
+# a failed or cancelled concurrent build leaves an INVALID index behind that IF NOT EXISTS would skip on the re-run,
+# so run_migrations drops invalid indexes before building them and checks every index is valid before recording
+MIGRATIONS = [
+    (
+        1,
+        "hot path indexes",
+        [
+            # reviews by album (album pages, collaborative filtering) and the FK cascade from albums
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_album_id_idx ON reviews (album_id)",
+            # a user's reviews by recency (profile, friends activity)
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_user_recent_idx ON reviews (user_id, (COALESCE(updated_at, created_at)) DESC)",
+            # positively rated reviews, read by every recommendation generator
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_positive_idx ON reviews (album_id, user_id) WHERE rating >= 3",
+            # followers of a user (followers count, get_followers); follower_id is already covered by the unique constraint
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS followers_followed_id_idx ON followers (followed_id, follower_id)",
+            # FK cascades from albums
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS favorites_album_id_idx ON favorites (album_id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS recommendations_album_id_idx ON recommendations (album_id)",
+        ],
+    ),
+    (
+        2,
+        "spotify artist mirror",
+        [
+            # local copy of Spotify artists, their albums and related artists; the *_fetched_at columns tell
+            # spotify.py whether the mirrored data is fresh enough to skip the upstream call
+            """
+            CREATE TABLE IF NOT EXISTS artists (
+                artist_id TEXT PRIMARY KEY,
+                artist_name TEXT NOT NULL,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                albums_fetched_at TIMESTAMP,
+                related_fetched_at TIMESTAMP
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (LOWER(artist_name))",
+            """
+            CREATE TABLE IF NOT EXISTS artist_albums (
+                artist_id TEXT NOT NULL,
+                album_id TEXT NOT NULL,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (artist_id) REFERENCES artists(artist_id) ON DELETE CASCADE,
+                FOREIGN KEY (album_id) REFERENCES albums(album_id) ON DELETE CASCADE,
+                PRIMARY KEY (artist_id, album_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS related_artists (
+                artist_id TEXT NOT NULL,
+                related_artist_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (artist_id) REFERENCES artists(artist_id) ON DELETE CASCADE,
+                FOREIGN KEY (related_artist_id) REFERENCES artists(artist_id) ON DELETE CASCADE,
+                PRIMARY KEY (artist_id, related_artist_id)
+            )
+            """,
+        ],
+    ),
+    (
+        3,
+        "recommendation checkpoints",
+        [
+            # one row per (run, stage, user id partition); last_user_id is the resume point of a partition
+            # and completed_at marks it done, so a retried partition skips the work it already finished
+            """
+            CREATE TABLE IF NOT EXISTS recommendation_checkpoints (
+                run_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                partition INTEGER NOT NULL,
+                first_user_id INTEGER NOT NULL,
+                last_user_id INTEGER NOT NULL,
+                processed_user_id INTEGER NOT NULL DEFAULT 0,
+                recommendations INTEGER NOT NULL DEFAULT 0,
+                completed_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_id, stage, partition)
+            )
+            """,
+        ],
+    ),
+    (
+        4,
+        "user suggestions",
+        [
+            # precomputed "people you may know": friends of friends and users who liked the same albums
+            """
+            CREATE TABLE IF NOT EXISTS user_suggestions (
+                user_id INTEGER NOT NULL,
+                suggested_id INTEGER NOT NULL,
+                mutual_count INTEGER NOT NULL DEFAULT 0,
+                shared_albums INTEGER NOT NULL DEFAULT 0,
+                score REAL NOT NULL DEFAULT 0,
+                computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                FOREIGN KEY (suggested_id) REFERENCES users(id) ON DELETE CASCADE,
+                PRIMARY KEY (user_id, suggested_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS user_suggestions_rank_idx ON user_suggestions (user_id, score DESC)",
+        ],
+    ),
+    (
+        5,
+        "trending albums",
+        [
+            # recent reviews across all users, read by the trending job
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_recent_idx ON reviews ((COALESCE(updated_at, created_at)))",
+            """
+            CREATE TABLE IF NOT EXISTS trending_albums (
+                position INTEGER PRIMARY KEY,
+                album_id TEXT NOT NULL,
+                score REAL NOT NULL,
+                review_count INTEGER NOT NULL,
+                avg_rating REAL NOT NULL,
+                computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (album_id) REFERENCES albums(album_id) ON DELETE CASCADE
+            )
+            """,
+        ],
+    ),
+    (
+        6,
+        "case-insensitive usernames",
+        [
+            # usernames are unique regardless of case; text_pattern_ops lets the same index serve both
+            # LOWER(username) = ... lookups and LOWER(username) LIKE 'prefix%' autocomplete scans
+            # (names differing only in case have to be renamed first, MIGRATION_CHECKS stops before the build)
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_username_lower_idx ON users (LOWER(username) text_pattern_ops)",
+        ],
+    ),
+    (
+        7,
+        "recommendation generations",
+        [
+            # every full recommendation run writes a new generation into its own partition of recommendations;
+            # activating it retires the previous one, whose partition is then dropped instead of deleted row by row.
+            # the existing rows become generation 1, the active one. One block, so a failure leaves the old table as is
+            """
+            DO $$
+            BEGIN
+                CREATE TABLE recommendation_generations (
+                    generation SERIAL PRIMARY KEY,
+                    run_id TEXT NOT NULL UNIQUE,
+                    status TEXT NOT NULL DEFAULT 'building',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    activated_at TIMESTAMP,
+                    dropped_at TIMESTAMP
+                );
+                CREATE UNIQUE INDEX recommendation_generations_active_idx
+                    ON recommendation_generations ((TRUE)) WHERE status = 'active';
+                INSERT INTO recommendation_generations (run_id, status, activated_at)
+                VALUES ('initial', 'active', CURRENT_TIMESTAMP);
+
+                CREATE TEMPORARY TABLE recommendations_copy ON COMMIT DROP AS
+                    SELECT user_id, album_id FROM recommendations;
+                DROP TABLE recommendations;
+
+                CREATE TABLE recommendations (
+                    generation INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    album_id TEXT NOT NULL,
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                    FOREIGN KEY (album_id) REFERENCES albums(album_id) ON DELETE CASCADE,
+                    PRIMARY KEY (generation, user_id, album_id)
+                ) PARTITION BY LIST (generation);
+                -- FK cascade from albums, created on every partition
+                CREATE INDEX recommendations_album_id_idx ON recommendations (album_id);
+                CREATE TABLE recommendations_g1 PARTITION OF recommendations FOR VALUES IN (1);
+
+                INSERT INTO recommendations (generation, user_id, album_id)
+                SELECT 1, user_id, album_id FROM recommendations_copy;
+            END
+            $$
+            """,
+        ],
+    ),
+    (
+        8,
+        "recommendation checkpoint parameters",
+        [
+            # what a run was planned with (partitions, stages, user range), so resuming it with other arguments
+            # is refused instead of silently reusing checkpoints that cover other users
+            "ALTER TABLE recommendation_checkpoints ADD COLUMN IF NOT EXISTS params TEXT",
+        ],
+    ),
+    (
+        9,
+        "spotify artist search queries",
+        [
+            # what a user typed -> the artist Spotify returned for it, so a search for "radiohead" or a misspelling
+            # hits the mirror even though Spotify's canonical name differs from the query
+            """
+            CREATE TABLE IF NOT EXISTS artist_queries (
+                query TEXT PRIMARY KEY,
+                artist_id TEXT NOT NULL,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (artist_id) REFERENCES artists(artist_id) ON DELETE CASCADE
+            )
+            """,
+        ],
+    ),
+    (
+        10,
+        "used refresh tokens",
+        [
+            # the jti of every refresh token exchanged at /token/refresh, kept until the token would have expired;
+            # a refresh token is accepted once, presenting it again is refused
+            """
+            CREATE TABLE IF NOT EXISTS used_refresh_tokens (
+                jti TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS used_refresh_tokens_user_id_idx ON used_refresh_tokens (user_id, expires_at)",
+        ],
+    ),
+]
+
+
+# version -> (query listing what blocks the migration, message); checked before any of the migration's statements,
+# so the operator gets the offending rows instead of a failed index build
+MIGRATION_CHECKS = {
+    6: (
+        """
+        SELECT string_agg(username, ', ' ORDER BY username) AS names
+        FROM users
+        GROUP BY LOWER(username)
+        HAVING COUNT(*) > 1
+        LIMIT 20
+        """,
+        "usernames differing only in case have to be renamed before migration 6 can add users_username_lower_idx",
+    ),
+}
+
+CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE
+)
+
+
+async def index_is_valid(name):
+
+    # True or False for an existing index, None when there is no index by that name
+    return await database.fetch_val(
+        """
+        SELECT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = :name AND pg_catalog.pg_table_is_visible(c.oid)
+        """,
+        {"name": name},
+    )
+
+
+async def create_index_concurrently(name, statement):
+
+    if await index_is_valid(name) is False:
+        await database.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    await database.execute(statement)
+
+    if not await index_is_valid(name):
+        await database.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        raise RuntimeError(f"Index {name} was left invalid by CREATE INDEX CONCURRENTLY, run the migration again")
+
+
+async def run_migrations():
+
+    await database.execute(CREATE_SCHEMA_MIGRATIONS_TABLE)
+
+    rows = await database.fetch_all("SELECT version FROM schema_migrations")
+    applied = {row["version"] for row in rows}
+
+    for version, name, statements in MIGRATIONS:
+
+        if version in applied:
+            continue
+
+        if version in MIGRATION_CHECKS:
+            query, message = MIGRATION_CHECKS[version]
+            blocking = await database.fetch_all(query)
+            if blocking:
+                raise RuntimeError(f"{message}: {'; '.join(row[0] for row in blocking)}")
+
+        for statement in statements:
+            index = CONCURRENT_INDEX.search(statement)
+            if index:
+                await create_index_concurrently(index.group(1), statement)
+            else:
+                await database.execute(statement)
+
+        await database.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES (:version, :name)",
+            {"version": version, "name": name},
+        )
+
+
 async def main():
 
     await database.connect()
@@ -90,4 +477,6 @@ async def main():
     await database.execute(CREATE_FOLLOWERS_TABLE)
     await database.execute(CREATE_RECOMMENDATIONS_TABLE)
 
+    await run_migrations()
+
     await database.disconnect()
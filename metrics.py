@@ -0,0 +1,338 @@
+import contextvars
+import functools
+import logging
+import os
+import time
+from collections import defaultdict
+from dotenv import load_dotenv
+
+# per-request instrumentation: the middleware opens a RequestMetrics for every HTTP request, the database wrapper and
+# the spotify.py helpers add to it, and at the end of the request everything is folded into Prometheus-style series
+
+load_dotenv()
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"  # add a Server-Timing header to every response
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "25"))  # log requests issuing more queries than this
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetrics:
+
+    __slots__ = (
+        "db_queries",
+        "db_seconds",
+        "upstream_calls",
+        "upstream_seconds",
+        "cache_hits",
+        "cache_misses",
+    )
+
+    def __init__(self):
+
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+_in_flight = 0  # HTTP requests currently being handled by this worker
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+
+        self.total += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry:
+
+    def __init__(self):
+
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> callable returning the current value
+        self.help = {}
+
+    def inc(self, name, labels=(), value=1.0):
+
+        self.counters[(name, labels)] += value
+
+    def observe(self, name, labels, value, buckets=BUCKETS):
+
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def gauge(self, name, fn, help_text=""):
+
+        self.gauges[name] = fn
+        self.help[name] = help_text
+
+    def render(self):
+
+        # Prometheus text exposition format
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), hist in sorted(self.histograms.items()):
+            # observe() already counts a value in every bucket it fits in, so the counts are cumulative
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist.total}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist.sum}")
+            lines.append(f"{name}_count{fmt(labels)} {hist.total}")
+        for name, fn in sorted(self.gauges.items()):
+            if self.help.get(name):
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {fn()}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def current():
+
+    return _current.get()
+
+
+def in_flight():
+
+    return _in_flight
+
+
+def record_db_query(seconds):
+
+    registry.inc("db_queries_total")
+    registry.observe("db_query_seconds", (), seconds)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.db_queries += 1
+        metrics.db_seconds += seconds
+
+
+def record_upstream_call(name, seconds, failed=False):
+
+    registry.inc("upstream_calls_total", (("call", name),))
+    registry.observe("upstream_call_seconds", (("call", name),), seconds)
+    if failed:
+        registry.inc("upstream_errors_total", (("call", name),))
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.upstream_calls += 1
+        metrics.upstream_seconds += seconds
+
+
+def record_cache(name, hit):
+
+    registry.inc("cache_requests_total", (("cache", name), ("result", "hit" if hit else "miss")))
+    metrics = _current.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+def timed_upstream(name):
+
+    # decorator for the async functions in spotify.py that talk to Spotify
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = await fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                record_upstream_call(name, time.perf_counter() - start, failed)
+
+        return wrapper
+
+    return decorator
+
+
+def measured(name):
+
+    # decorator for background jobs (the recommendation generators): the same per-run counters as a request,
+    # logged when the job finishes, so a loop issuing one query per row is obvious from the log line
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            metrics = RequestMetrics()
+            token = _current.set(metrics)
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _current.reset(token)
+                elapsed = time.perf_counter() - start
+                labels = (("job", name),)
+                registry.observe("job_seconds", labels, elapsed)
+                registry.inc("job_db_queries_total", labels, metrics.db_queries)
+                registry.inc("job_upstream_calls_total", labels, metrics.upstream_calls)
+                logger.info(
+                    "%s took %.1f s: %d queries (%.1f s), %d upstream calls (%.1f s), %d cache hits",
+                    name,
+                    elapsed,
+                    metrics.db_queries,
+                    metrics.db_seconds,
+                    metrics.upstream_calls,
+                    metrics.upstream_seconds,
+                    metrics.cache_hits,
+                )
+
+        return wrapper
+
+    return decorator
+
+
+class InstrumentedDatabase:
+
+    # wraps a databases.Database and times every query; everything else (connect, transaction, ...) is passed through
+
+    def __init__(self, database):
+
+        self._database = database
+
+    def __getattr__(self, name):
+
+        return getattr(self._database, name)
+
+    async def _timed(self, method, *args, **kwargs):
+
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            record_db_query(time.perf_counter() - start)
+
+    async def fetch_all(self, *args, **kwargs):
+        return await self._timed(self._database.fetch_all, *args, **kwargs)
+
+    async def fetch_one(self, *args, **kwargs):
+        return await self._timed(self._database.fetch_one, *args, **kwargs)
+
+    async def fetch_val(self, *args, **kwargs):
+        return await self._timed(self._database.fetch_val, *args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._timed(self._database.execute, *args, **kwargs)
+
+    async def execute_many(self, *args, **kwargs):
+        return await self._timed(self._database.execute_many, *args, **kwargs)
+
+    async def iterate(self, *args, **kwargs):
+
+        # only the time spent waiting for rows counts as query time, not the time the caller spends on each row
+        iterator = self._database.iterate(*args, **kwargs).__aiter__()
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield row
+        finally:
+            record_db_query(elapsed)
+
+
+class MetricsMiddleware:
+
+    # plain ASGI middleware, so it also sees streaming responses and does not buffer bodies
+
+    def __init__(self, app):
+
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        global _in_flight
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        status_code = 500
+        _in_flight += 1
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING:
+                    total = (time.perf_counter() - start) * 1000
+                    value = (
+                        f"db;desc=\"{metrics.db_queries} queries\";dur={metrics.db_seconds * 1000:.1f}, "
+                        f"upstream;desc=\"{metrics.upstream_calls} calls\";dur={metrics.upstream_seconds * 1000:.1f}, "
+                        f"cache;desc=\"{metrics.cache_hits} hits\", "
+                        f"total;dur={total:.1f}"
+                    )
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", value.encode("latin-1"))
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _in_flight -= 1
+            _current.reset(token)
+            elapsed = time.perf_counter() - start
+
+            # the route template (/user/{username}/profile) keeps the number of series bounded
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            labels = (("method", scope["method"]), ("route", path))
+
+            registry.inc("http_requests_total", labels + (("status", status_code),))
+            registry.observe("http_request_seconds", labels, elapsed)
+            registry.observe("http_request_db_queries", labels, metrics.db_queries, QUERY_COUNT_BUCKETS)
+            registry.inc("http_request_db_seconds_total", labels, metrics.db_seconds)
+            registry.inc("http_request_upstream_calls_total", labels, metrics.upstream_calls)
+            registry.inc("http_request_upstream_seconds_total", labels, metrics.upstream_seconds)
+            registry.inc("http_request_cache_hits_total", labels, metrics.cache_hits)
+
+            if metrics.db_queries > N_PLUS_ONE_THRESHOLD:
+                logger.warning(
+                    "%s %s issued %d queries (%.1f ms), possible N+1",
+                    scope["method"],
+                    path,
+                    metrics.db_queries,
+                    metrics.db_seconds * 1000,
+                )
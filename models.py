@@ -9,6 +9,11 @@ class UserRegister(BaseModel):
     password: str
 
 
+class TokenRefresh(BaseModel):
+
+    refresh_token: str
+
+
 class UserLogin(BaseModel):
 
     username: str
@@ -37,12 +42,39 @@ class AlbumOut(BaseModel):
     cover: str
 
 
+class TrendingAlbumOut(AlbumOut):
+
+    position: int
+    score: float  # time-decayed review volume scaled by the average rating
+    review_count: int  # reviews in the trending window
+    avg_rating: float
+
+
 class ReviewCreate(BaseModel):
 
     rating: int = Field(ge=0, le=5)
     review: Optional[str] = ""
 
 
+class ReviewImportItem(BaseModel):
+
+    album_id: str
+    rating: int = Field(ge=0, le=5)
+    review: Optional[str] = ""
+
+
+class ReviewImport(BaseModel):
+
+    reviews: list[ReviewImportItem] = Field(min_length=1, max_length=500)
+
+
+class ReviewImportResultOut(BaseModel):
+
+    album_id: str
+    success: bool
+    message: str
+
+
 class ReviewDelete(BaseModel):
 
     user_id: int
@@ -77,6 +109,18 @@ class FollowDelete(BaseModel):
     user_id: int
 
 
+class FollowBatch(BaseModel):
+
+    user_ids: list[int] = Field(min_length=1, max_length=500)
+
+
+class FollowResultOut(BaseModel):
+
+    user_id: int
+    success: bool
+    message: str
+
+
 class FollowersOut(BaseModel):
 
     id: int
@@ -89,6 +133,35 @@ class FollowingOut(BaseModel):
     username: str
 
 
+class FollowEntryOut(BaseModel):
+
+    id: int
+    username: str
+    you_follow: bool
+    follows_you: bool
+
+
+class FollowPageOut(BaseModel):
+
+    items: list[FollowEntryOut]
+    next_cursor: Optional[int]  # pass as ?after= to get the next page, None on the last page
+
+
+class UserSuggestionOut(BaseModel):
+
+    id: int
+    username: str
+    mutual_count: int  # people you follow who follow them
+    shared_albums: int  # albums you both rated 3 or more
+
+
+class UserMatchOut(BaseModel):
+
+    id: int
+    username: str
+    follower_count: int
+
+
 class UserProfileOut(BaseModel):
 
     id: int
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from dotenv import load_dotenv
+
+# live hot-path analysis for a running worker, without restarting it under an external profiler:
+# - SamplingProfiler samples the event loop thread's stack from a background thread and returns folded stacks
+#   ("frame;frame;frame count" per line), which flamegraph.pl, speedscope and inferno read directly
+# - LoopWatchdog logs the stack of whatever is holding the event loop longer than SLOW_CALLBACK_THRESHOLD_MS
+
+load_dotenv()
+SLOW_CALLBACK_THRESHOLD_MS = float(os.getenv("SLOW_CALLBACK_THRESHOLD_MS", "100"))  # 0 disables the watchdog
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_name(frame):
+
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+def _folded_stack(frame):
+
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+
+    def __init__(self):
+
+        self._lock = asyncio.Lock()
+
+    async def profile(self, seconds, interval=0.005):
+
+        # profiles the thread running the event loop for `seconds`; only one profile runs at a time per worker
+        if self._lock.locked():
+            raise RuntimeError("A profile is already running")
+
+        async with self._lock:
+            target = threading.get_ident()
+            samples = Counter()
+            stop = threading.Event()
+
+            def sample():
+                while not stop.wait(interval):
+                    frame = sys._current_frames().get(target)
+                    if frame is not None:
+                        samples[_folded_stack(frame)] += 1
+
+            thread = threading.Thread(target=sample, name="sampling-profiler", daemon=True)
+            thread.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                await asyncio.to_thread(thread.join)
+
+        return "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
+
+
+class LoopWatchdog:
+
+    # a task on the loop bumps a heartbeat every threshold / 4; a thread watches it and, when the heartbeat is late,
+    # the loop is blocked by whatever code is running right now, so that stack is logged (once per stall)
+
+    def __init__(self, threshold_ms=SLOW_CALLBACK_THRESHOLD_MS):
+
+        self.threshold = threshold_ms / 1000
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.stalls = 0
+
+    def start(self):
+
+        if self.threshold <= 0 or self._task is not None:
+            return
+
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+
+        if self._task is None:
+            return
+
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _heartbeat(self):
+
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self):
+
+        reported_beat = None
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or beat == reported_beat:
+                continue
+
+            reported_beat = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+            logger.warning(
+                "event loop blocked for more than %.0f ms, currently running:\n%s",
+                blocked * 1000,
+                stack,
+            )
@@ -0,0 +1,145 @@
+import contextvars
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from fastapi import Depends, HTTPException, Request, status
+from auth import get_current_user
+from metrics import registry
+from models import User
+
+# token bucket limits for the endpoints that can reach Spotify, per user and per route
+# the limit only applies to work that actually goes upstream: the route's dependency arms a charge for the request,
+# and the request is charged when it first asks for a Spotify token (every Spotify call starts with one),
+# so results served from the local catalog or the mirror are free
+
+load_dotenv()
+RATE_LIMIT_SEARCH_PER_MINUTE = float(os.getenv("RATE_LIMIT_SEARCH_PER_MINUTE", "30"))
+RATE_LIMIT_SEARCH_BURST = int(os.getenv("RATE_LIMIT_SEARCH_BURST", "10"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))  # buckets kept by the in-memory backend
+# set to share the buckets between workers (needs the redis package), otherwise every worker limits on its own
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(HTTPException):
+
+    def __init__(self, retry_after):
+
+        super().__init__(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many searches reaching Spotify, try again later",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+class MemoryBackend:
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+
+    async def take(self, key, rate, capacity):
+
+        # returns (allowed, seconds until a token is available)
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            # the oldest bucket has had the longest to refill, dropping it at worst gives that user a fresh burst
+            self._buckets.popitem(last=False)
+
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+class RedisBackend:
+
+    # the same token bucket, updated atomically in Redis with the server's clock, so every worker shares it
+    SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or capacity
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+
+        # imported here so the in-memory setup does not need the redis package
+        import redis.asyncio
+
+        self._redis = redis.asyncio.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+
+    async def take(self, key, rate, capacity):
+
+        try:
+            allowed, tokens = await self._script(keys=[f"rate_limit:{key}"], args=[rate, capacity])
+        except Exception:
+            # a Redis outage should not take search down with it
+            logger.exception("rate limit store unavailable, letting the request through")
+            return True, 0.0
+
+        tokens = float(tokens)
+        return bool(allowed), 0.0 if allowed else (1 - tokens) / rate
+
+
+class RateLimiter:
+
+    def __init__(self, backend=None):
+
+        self.backend = backend or (RedisBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryBackend())
+
+    async def check(self, key, per_minute, burst):
+
+        allowed, retry_after = await self.backend.take(key, per_minute / 60, burst)
+        if not allowed:
+            registry.inc("rate_limited_total", (("route", key.split(":", 1)[0]),))
+            raise RateLimitExceeded(retry_after)
+
+
+limiter = RateLimiter()
+
+# (bucket key, per_minute, burst) for the current request, set by the route's dependency, None once charged
+_charge = contextvars.ContextVar("rate_limit_charge", default=None)
+
+
+def limit_upstream(per_minute=RATE_LIMIT_SEARCH_PER_MINUTE, burst=RATE_LIMIT_SEARCH_BURST):
+
+    # route dependency: arms the charge for this user and route template, nothing is taken yet
+    async def dependency(request: Request, user: User = Depends(get_current_user)):
+        route = getattr(request.scope.get("route"), "path", request.url.path)
+        _charge.set((f"{route}:{user.id}", per_minute, burst))
+
+    return dependency
+
+
+async def charge():
+
+    # called before going to Spotify; a request is charged once, however many Spotify calls it makes
+    pending = _charge.get()
+    if pending is None:
+        return
+
+    _charge.set(None)
+    await limiter.check(*pending)
@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import time
+from datetime import datetime
+from init_db import database, reader
+from recommendation_runner import ALBUM_STAGES, RecommendationRunner, STAGES
+
+# runs the recommendation generators without Airflow, e.g. locally or on staging:
+#
+#   python recommend.py --stages artist,collaborative --concurrency 4 --batch-size 100
+#   python recommend.py --user-ids 12,57 --dry-run
+#
+# progress is checkpointed per batch under --run-id; without one every invocation starts a new run (cli-<start time>)
+# and prints its id, passing that id back with the same arguments resumes where it stopped; a run id is bound to the
+# arguments it was planned with, resuming it with others is refused; a dry run computes the candidates but writes no
+# recommendations or checkpoints
+#
+# a run over every user with all the album stages builds a new generation of recommendations and swaps it in at the
+# end; narrower runs add to the current recommendations instead, they would otherwise replace everyone else's
+
+
+class Stats:
+
+    def __init__(self):
+
+        self.started = time.monotonic()
+        self.users = {}
+        self.recommendations = {}
+
+    def add(self, stage, users, recommendations):
+
+        self.users[stage] = self.users.get(stage, 0) + users
+        self.recommendations[stage] = self.recommendations.get(stage, 0) + recommendations
+
+    def report(self, dry_run):
+
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        label = "candidates" if dry_run else "new recommendations"
+        print(f"\n{'stage':<16} {'users':>10} {label:>20} {'users/s':>10}")
+        for stage in self.users:
+            print(
+                f"{stage:<16} {self.users[stage]:>10} {self.recommendations[stage]:>20} "
+                f"{self.users[stage] / elapsed:>10.1f}"
+            )
+        print(f"elapsed {elapsed:.1f}s")
+
+
+async def run(args, stats):
+
+    runner = RecommendationRunner()
+    stages = args.stages.split(",")
+    user_ids = [int(u) for u in args.user_ids.split(",")] if args.user_ids else None
+
+    first_user_id = args.min_user_id
+    last_user_id = args.max_user_id
+    if user_ids:
+        first_user_id = max(first_user_id, min(user_ids))
+        last_user_id = min(last_user_id or max(user_ids), max(user_ids))
+
+    full = (
+        not args.dry_run
+        and set(ALBUM_STAGES) <= set(stages)
+        and not user_ids
+        and first_user_id == 1
+        and last_user_id is None
+    )
+
+    # the partitions of a stage run `concurrency` at a time, the stages themselves run one after the other
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    if args.dry_run:
+        ranges = await runner.partition_ranges(args.concurrency, first_user_id, last_user_id)
+
+        async def run_one(stage, partition):
+            first, last = ranges[partition]
+            async with semaphore:
+                users, count = await runner.run_range(
+                    stage, first, last, args.batch_size, user_ids, dry_run=True
+                )
+            stats.add(stage, users, count)
+
+    else:
+        await runner.plan(args.run_id, args.concurrency, stages, first_user_id, last_user_id, user_ids)
+        if full:
+            await runner.begin_generation(args.run_id)
+
+        async def run_one(stage, partition):
+            async with semaphore:
+                users, created = await runner.run_partition(
+                    args.run_id, stage, partition, args.batch_size, user_ids
+                )
+            stats.add(stage, users, created)
+
+    for stage in stages:
+        # a resumed run goes through the partitions it was planned with
+        partitions = range(len(ranges)) if args.dry_run else await runner.planned_partitions(args.run_id, stage)
+        await asyncio.gather(*(run_one(stage, p) for p in partitions))
+
+    if full:
+        dropped = await runner.activate(args.run_id)
+        print(f"generation of {args.run_id} activated, {dropped} old generations dropped")
+
+
+async def main(args):
+
+    stats = Stats()
+    await database.connect()
+    await reader.connect()
+    if not args.dry_run:
+        print(f"run id {args.run_id}, pass --run-id {args.run_id} to resume it")
+    try:
+        await run(args, stats)
+    finally:
+        stats.report(args.dry_run)
+        await reader.disconnect()
+        await database.disconnect()
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Run the recommendation generators")
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help=f"comma separated subset of {', '.join(STAGES)}",
+    )
+    parser.add_argument("--concurrency", type=int, default=4, help="user id partitions processed at the same time")
+    parser.add_argument("--batch-size", type=int, default=200, help="users per generator call")
+    parser.add_argument("--user-ids", help="comma separated user ids to process, default all users")
+    parser.add_argument("--min-user-id", type=int, default=1)
+    parser.add_argument("--max-user-id", type=int)
+    parser.add_argument("--run-id", help="checkpoint key, reuse it to resume (default: a new run id, printed at start)")
+    parser.add_argument("--dry-run", action="store_true", help="compute candidates without writing anything")
+    args = parser.parse_args()
+
+    unknown = set(args.stages.split(",")) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    if args.concurrency < 1 or args.batch_size < 1:
+        parser.error("--concurrency and --batch-size must be at least 1")
+
+    if args.run_id is None:
+        # not derived from the arguments: the same command next week is a new run, not a finished one to resume,
+        # and a run killed at 23:59 is resumed by passing the printed id back instead of depending on the date
+        args.run_id = f"cli-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print(f"interrupted, run the same command with --run-id {args.run_id} to resume")
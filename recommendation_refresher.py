@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from user_manager import UserManager
+
+load_dotenv()
+REFRESH_DEBOUNCE_SECONDS = float(os.getenv("RECOMMENDATION_REFRESH_DEBOUNCE_SECONDS", "10"))
+REFRESH_TIMEOUT_SECONDS = float(os.getenv("RECOMMENDATION_REFRESH_TIMEOUT_SECONDS", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationRefresher:
+
+    # refreshes one user's recommendations in the background after they rate an album positively, instead of making
+    # them wait for the weekly batch; only the newly liked albums are used as seeds, so the work stays small
+    #
+    # refreshes are debounced per user: every new rating restarts the user's timer, so rating ten albums in a row
+    # triggers one refresh seeded with all ten; a rating that arrives while the user's refresh is running is
+    # picked up by a follow-up refresh when the current one ends
+
+    def __init__(
+        self,
+        user_manager=None,
+        debounce=REFRESH_DEBOUNCE_SECONDS,
+        timeout=REFRESH_TIMEOUT_SECONDS,
+    ):
+
+        self.user_manager = user_manager or UserManager()
+        self.debounce = debounce
+        self.timeout = timeout
+        self._seeds = {}  # user_id -> album ids liked since the user's last refresh started
+        self._waiting = {}  # user_id -> task sleeping through the debounce delay
+        self._running = {}  # user_id -> task currently refreshing
+
+        self.refreshes = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def schedule(self, user_id, album_id):
+
+        self._seeds.setdefault(user_id, set()).add(album_id)
+
+        waiting = self._waiting.get(user_id)
+        if waiting is not None:
+            waiting.cancel()
+
+        if user_id in self._running:
+            # the running refresh reschedules itself when it finishes and sees the new seed
+            self._waiting.pop(user_id, None)
+            return
+
+        self._waiting[user_id] = asyncio.create_task(self._refresh_later(user_id))
+
+    async def _refresh_later(self, user_id):
+
+        await asyncio.sleep(self.debounce)
+
+        self._waiting.pop(user_id, None)
+        album_ids = self._seeds.pop(user_id, set())
+        if not album_ids:
+            return
+
+        self._running[user_id] = asyncio.current_task()
+        try:
+            await asyncio.wait_for(self.refresh(user_id, album_ids), self.timeout)
+            self.refreshes += 1
+        except asyncio.TimeoutError:
+            # whatever was saved before the timeout stays, the weekly batch fills in the rest
+            self.timeouts += 1
+            logger.warning("recommendation refresh for user %s timed out", user_id)
+        except Exception:
+            self.failures += 1
+            logger.exception("recommendation refresh for user %s failed", user_id)
+        finally:
+            self._running.pop(user_id, None)
+            if self._seeds.get(user_id):
+                self._waiting[user_id] = asyncio.create_task(self._refresh_later(user_id))
+
+    async def refresh(self, user_id, album_ids):
+
+        # cheapest generators first, so a refresh cut short by the timeout has still saved something useful
+        user_ids = [user_id]
+        user_manager = self.user_manager
+
+        await user_manager.save_recommendations(
+            await user_manager.artist_candidates(user_ids, album_ids)
+        )
+        await user_manager.save_recommendations(
+            await user_manager.collaborative_candidates(user_ids, album_ids)
+        )
+        await user_manager.save_recommendations(
+            await user_manager.related_artist_candidates(user_ids, album_ids)
+        )
+
+    async def stop(self):
+
+        # pending refreshes are dropped (the weekly batch covers them), running ones get to finish
+        for task in self._waiting.values():
+            task.cancel()
+        self._waiting.clear()
+        self._seeds.clear()
+
+        if self._running:
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+    def stats(self):
+
+        return {
+            "waiting": len(self._waiting),
+            "running": len(self._running),
+            "refreshes": self.refreshes,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+        }
@@ -0,0 +1,345 @@
+import functools
+import json
+from init_db import database, reader
+from recommendation_stages import ALBUM_STAGES, STAGES
+from user_manager import UserManager
+
+# the recommendation pipeline: every stage (generator) is split into user id ranges ("partitions") that can run
+# in parallel, each partition walks its users in batches and checkpoints after every batch in
+# recommendation_checkpoints, so a failed partition is retried on its own and resumes where it stopped
+#
+# a full run builds a new generation of recommendations in its own partition of the table, invisible until activate()
+# swaps it in once every partition is complete; the generation it replaces is dropped with its partition, so stale
+# candidates do not pile up. Runs without a generation (a few users, a few stages) add to the live generations instead
+
+MAX_USER_ID = 2147483647
+
+
+class RecommendationRunner:
+
+    def __init__(self, user_manager=None):
+
+        self.user_manager = user_manager or UserManager()
+
+    def generator(self, stage, dry_run=False, generation=None):
+
+        # a dry run only computes the candidates and reports how many there are, nothing is written
+        if dry_run:
+            candidates = {
+                "artist": self.user_manager.artist_candidates,
+                "related_artist": self.user_manager.related_artist_candidates,
+                "collaborative": self.user_manager.collaborative_candidates,
+                "people": self.user_manager.user_suggestion_candidates,
+            }[stage]
+
+            async def count(user_ids):
+                return len(await candidates(user_ids))
+
+            return count
+
+        if stage in ALBUM_STAGES:
+            return functools.partial(
+                {
+                    "artist": self.user_manager.other_albums_by_artist,
+                    "related_artist": self.user_manager.albums_by_similar_artists,
+                    "collaborative": self.user_manager.collaborative_filtering,
+                }[stage],
+                generation=generation,
+            )
+
+        return self.user_manager.compute_user_suggestions
+
+    async def generation(self, run_id):
+
+        # the generation run_id is building (or built), None for runs that write into the live generations
+        return await database.fetch_val(
+            "SELECT generation FROM recommendation_generations WHERE run_id = :run_id AND status <> 'retired'",
+            {"run_id": run_id},
+        )
+
+    async def begin_generation(self, run_id):
+
+        # idempotent like plan(): a retried planning task gets the generation it created the first time
+        # the row and its partition are created together: refreshes write into every generation being built, and one
+        # without a partition would make each of their inserts fail
+        async with database.transaction():
+            row = await database.fetch_one(
+                """
+                INSERT INTO recommendation_generations (run_id) VALUES (:run_id)
+                ON CONFLICT (run_id) DO UPDATE SET run_id = EXCLUDED.run_id
+                RETURNING generation, status
+                """,
+                {"run_id": run_id},
+            )
+            if row["status"] == "retired":
+                raise ValueError(f"The generation of run {run_id} was replaced by a newer one, use a new run id")
+
+            generation = int(row["generation"])
+            # DDL takes no bind parameters, generation is an integer from the database
+            await database.execute(
+                f"CREATE TABLE IF NOT EXISTS recommendations_g{generation} "
+                f"PARTITION OF recommendations FOR VALUES IN ({generation})"
+            )
+
+        return generation
+
+    async def activate(self, run_id):
+
+        # swaps the run's generation in and drops the ones it replaces; returns the number of generations dropped
+        async with database.transaction():
+            row = await database.fetch_one(
+                "SELECT generation, status FROM recommendation_generations WHERE run_id = :run_id FOR UPDATE",
+                {"run_id": run_id},
+            )
+            if row is None:
+                raise ValueError(f"Run {run_id} did not build a recommendation generation")
+
+            incomplete = await database.fetch_val(
+                "SELECT COUNT(*) FROM recommendation_checkpoints WHERE run_id = :run_id AND completed_at IS NULL",
+                {"run_id": run_id},
+            )
+            if incomplete:
+                raise ValueError(f"Run {run_id} still has {incomplete} partitions to complete")
+
+            if row["status"] == "building":
+                # older generations, the active one and abandoned runs alike, are retired; if a newer run was
+                # activated first this one is retired in turn, it is already out of date
+                params = {"generation": row["generation"]}
+                await database.execute(
+                    "UPDATE recommendation_generations SET status = 'retired' WHERE generation < :generation",
+                    params,
+                )
+                await database.execute(
+                    """
+                    UPDATE recommendation_generations
+                    SET status = 'active', activated_at = CURRENT_TIMESTAMP
+                    WHERE generation = :generation
+                    AND NOT EXISTS (
+                        SELECT 1 FROM recommendation_generations
+                        WHERE status = 'active' AND generation > :generation
+                    )
+                    """,
+                    params,
+                )
+                await database.execute(
+                    """
+                    UPDATE recommendation_generations SET status = 'retired'
+                    WHERE generation = :generation AND status = 'building'
+                    """,
+                    params,
+                )
+
+        return await self.drop_retired()
+
+    async def drop_retired(self):
+
+        # dropping a partition frees its space at once, where deleting the rows would leave the table to vacuum
+        # the rows stay, so a retired run id cannot be planned again into an empty generation
+        rows = await database.fetch_all(
+            """
+            SELECT generation FROM recommendation_generations
+            WHERE status = 'retired' AND dropped_at IS NULL
+            ORDER BY generation
+            """
+        )
+        for row in rows:
+            generation = int(row["generation"])
+            partition = f"recommendations_g{generation}"
+
+            # dropping an attached partition locks recommendations (ACCESS EXCLUSIVE) for every reader and writer;
+            # detaching concurrently (outside a transaction) only waits for the queries already using it, and the
+            # detached table is dropped without touching recommendations
+            attached = await database.fetch_one(
+                "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(:partition)",
+                {"partition": partition},
+            )
+            if attached is not None:
+                # an interrupted concurrent detach leaves the partition pending, it can only be finalized
+                how = "FINALIZE" if attached["inhdetachpending"] else "CONCURRENTLY"
+                await database.execute(f"ALTER TABLE recommendations DETACH PARTITION {partition} {how}")
+            await database.execute(f"DROP TABLE IF EXISTS {partition}")
+            await database.execute(
+                "UPDATE recommendation_generations SET dropped_at = CURRENT_TIMESTAMP WHERE generation = :generation",
+                {"generation": generation},
+            )
+
+        return len(rows)
+
+    async def partition_ranges(self, partitions, first_user_id=1, last_user_id=None):
+
+        # splits [first_user_id, last_user_id] into equal ranges; without last_user_id the range ends at the current
+        # highest id and the last partition is open-ended, so users registered after planning are still covered
+        open_ended = last_user_id is None
+        if open_ended:
+            last_user_id = await database.fetch_val("SELECT COALESCE(MAX(id), 0) FROM users")
+
+        size = max(1, -(-(last_user_id - first_user_id + 1) // partitions))
+        ranges = [
+            (first_user_id + p * size, min(last_user_id, first_user_id + (p + 1) * size - 1))
+            for p in range(partitions)
+        ]
+        if open_ended:
+            ranges[-1] = (ranges[-1][0], MAX_USER_ID)
+
+        return ranges
+
+    async def plan(self, run_id, partitions, stages=STAGES, first_user_id=1, last_user_id=None, user_ids=None):
+
+        # existing rows are kept, so planning the same run twice (a retried planning task, a resumed CLI run)
+        # does not move partition boundaries under partitions that already started; the arguments are stored with
+        # the checkpoints, and planning an existing run with different ones is refused
+        params = json.dumps(
+            {
+                "partitions": partitions,
+                "stages": list(stages),
+                "first_user_id": first_user_id,
+                "last_user_id": last_user_id,
+                "user_ids": sorted(user_ids) if user_ids is not None else None,
+            },
+            sort_keys=True,
+        )
+        planned = await database.fetch_one(
+            """
+            SELECT params FROM recommendation_checkpoints
+            WHERE run_id = :run_id AND params IS DISTINCT FROM :params
+            LIMIT 1
+            """,
+            {"run_id": run_id, "params": params},
+        )
+        if planned is not None:
+            raise ValueError(
+                f"Run {run_id} was planned with other arguments ({planned['params']}), use a new run id"
+            )
+
+        ranges = await self.partition_ranges(partitions, first_user_id, last_user_id)
+
+        for stage in stages:
+            await database.execute(
+                """
+                INSERT INTO recommendation_checkpoints (run_id, stage, partition, first_user_id, last_user_id, params)
+                SELECT :run_id, :stage, partition - 1, first_user_id, last_user_id, :params
+                FROM unnest(CAST(:firsts AS INTEGER[]), CAST(:lasts AS INTEGER[]))
+                    WITH ORDINALITY AS t(first_user_id, last_user_id, partition)
+                ON CONFLICT (run_id, stage, partition) DO NOTHING
+                """,
+                {
+                    "run_id": run_id,
+                    "stage": stage,
+                    "firsts": [first for first, _ in ranges],
+                    "lasts": [last for _, last in ranges],
+                    "params": params,
+                },
+            )
+
+    async def planned_partitions(self, run_id, stage):
+
+        rows = await database.fetch_all(
+            """
+            SELECT partition FROM recommendation_checkpoints
+            WHERE run_id = :run_id AND stage = :stage
+            ORDER BY partition
+            """,
+            {"run_id": run_id, "stage": stage},
+        )
+
+        return [row["partition"] for row in rows]
+
+    async def run_range(
+        self,
+        stage,
+        first_user_id,
+        last_user_id,
+        batch_size=200,
+        user_ids=None,
+        dry_run=False,
+        on_batch=None,
+        generation=None,
+    ):
+
+        # walks the users of [first_user_id, last_user_id] (optionally only `user_ids`) in id order, batch by batch;
+        # on_batch(last_user_id, created) is awaited after every batch and is where progress gets checkpointed
+        generate = self.generator(stage, dry_run, generation)
+        after = first_user_id - 1
+        users = 0
+        total = 0
+
+        while True:
+
+            rows = await reader.fetch_all(
+                """
+                SELECT id FROM users
+                WHERE id > :after AND id <= :last
+                AND (CAST(:user_ids AS INTEGER[]) IS NULL OR id = ANY(CAST(:user_ids AS INTEGER[])))
+                ORDER BY id
+                LIMIT :batch_size
+                """,
+                {
+                    "after": after,
+                    "last": last_user_id,
+                    "user_ids": list(user_ids) if user_ids is not None else None,
+                    "batch_size": batch_size,
+                },
+            )
+            if not rows:
+                break
+
+            batch = [row["id"] for row in rows]
+            created = await generate(batch)
+            users += len(batch)
+            total += created
+            after = batch[-1]
+
+            if on_batch is not None:
+                await on_batch(after, created)
+
+        return users, total
+
+    async def run_partition(self, run_id, stage, partition, batch_size=200, user_ids=None):
+
+        # returns (users processed, recommendations created) for this attempt; 0, 0 when the partition is already done
+        checkpoint = await database.fetch_one(
+            """
+            SELECT first_user_id, last_user_id, processed_user_id, completed_at
+            FROM recommendation_checkpoints
+            WHERE run_id = :run_id AND stage = :stage AND partition = :partition
+            """,
+            {"run_id": run_id, "stage": stage, "partition": partition},
+        )
+        if checkpoint is None:
+            raise ValueError(f"Partition {partition} of {stage} was not planned for run {run_id}")
+        if checkpoint["completed_at"] is not None:
+            return 0, 0
+
+        params = {"run_id": run_id, "stage": stage, "partition": partition}
+
+        async def save_progress(processed_user_id, created):
+            await database.execute(
+                """
+                UPDATE recommendation_checkpoints
+                SET processed_user_id = :processed_user_id, recommendations = recommendations + :created,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE run_id = :run_id AND stage = :stage AND partition = :partition
+                """,
+                dict(params, processed_user_id=processed_user_id, created=created),
+            )
+
+        result = await self.run_range(
+            stage,
+            max(checkpoint["processed_user_id"] + 1, checkpoint["first_user_id"]),
+            checkpoint["last_user_id"],
+            batch_size,
+            user_ids=user_ids,
+            on_batch=save_progress,
+            generation=await self.generation(run_id),
+        )
+
+        await database.execute(
+            """
+            UPDATE recommendation_checkpoints
+            SET completed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE run_id = :run_id AND stage = :stage AND partition = :partition
+            """,
+            params,
+        )
+
+        return result
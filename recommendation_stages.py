@@ -0,0 +1,5 @@
+# the stages of the recommendation pipeline, kept apart from recommendation_runner so the Airflow DAG can lay out its
+# tasks without importing the database and Spotify stack every time the scheduler parses the DAG file
+# ALBUM_STAGES write into recommendations, a run only builds a new generation of them when it runs all three
+ALBUM_STAGES = ("artist", "related_artist", "collaborative")
+STAGES = ALBUM_STAGES + ("people",)
@@ -1,64 +1,122 @@
 import sqlite3
-from init_db import database
+from album_manager import AlbumManager
+from spotify import get_spotify_token, search_for_albums_by_ids
+from init_db import database, reader
+
+album_manager = AlbumManager()
+
+# the hot read queries are module constants, so tests/test_indexes.py can EXPLAIN exactly what the handlers run
+
+# a user's reviews, newest first (profile); LIMIT NULL means no limit
+USER_REVIEWS_QUERY = """
+    SELECT a.album_name, a.artist_name, a.cover, r.rating, r.review
+    FROM reviews r JOIN albums a ON r.album_id = a.album_id
+    WHERE user_id = :user_id
+    ORDER BY COALESCE(r.updated_at, r.created_at) DESC
+    LIMIT :limit
+"""
+
+# last week's reviews by the users someone follows
+FRIENDS_ACTIVITY_QUERY = """
+    SELECT a.album_name, a.artist_name, a.cover, r.rating, r.review
+    FROM followers f
+    JOIN reviews r ON r.user_id = f.followed_id
+    JOIN albums a ON a.album_id = r.album_id
+    WHERE f.follower_id = :user_id
+    AND COALESCE(r.updated_at, r.created_at) >= NOW() - INTERVAL '7 days'
+    ORDER BY COALESCE(r.updated_at, r.created_at) DESC
+"""
 
 
 class ReviewManager:
 
     async def add_review(self, user_id, album_id, rating, review):
 
-        row = await database.fetch_one(
-            "SELECT * FROM reviews WHERE user_id = :user_id AND album_id = :album_id",
-            {"user_id": int(user_id), "album_id": album_id},
+        # created_at keeps its original value on conflict, only the rating, the text and updated_at change
+        await database.fetch_one(
+            """
+                INSERT INTO reviews (user_id, album_id, rating, review, created_at)
+                VALUES (:user_id, :album_id, :rating, :review, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id, album_id) DO UPDATE
+                SET rating = EXCLUDED.rating, review = EXCLUDED.review, updated_at = CURRENT_TIMESTAMP
+                RETURNING id
+                """,
+            {
+                "rating": rating,
+                "review": review,
+                "user_id": int(user_id),
+                "album_id": album_id,
+            },
         )
 
-        if row:
-
-            await database.execute(
-                """
-                    UPDATE reviews
-                    SET rating = :rating, review = :review, updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = :user_id AND album_id = :album_id
-                    """,
-                {
-                    "rating": rating,
-                    "review": review,
-                    "user_id": int(user_id),
-                    "album_id": album_id,
-                },
-            )
-        else:
-
-            await database.execute(
-                """
-                    INSERT INTO reviews (user_id, album_id, rating, review, created_at)
-                    VALUES (:user_id, :album_id, :rating, :review, CURRENT_TIMESTAMP)
-                    """,
-                {
-                    "rating": rating,
-                    "review": review,
-                    "user_id": int(user_id),
-                    "album_id": album_id,
-                },
-            )
-
         return True, "Review added successfully"
 
     async def delete_review(self, user_id, album_id):
 
-        existing = await database.fetch_one(
-            "select * from reviews where user_id = :user_id and album_id = :album_id",
+        deleted = await database.fetch_one(
+            "DELETE FROM reviews WHERE user_id = :user_id AND album_id = :album_id RETURNING id",
             {"user_id": int(user_id), "album_id": album_id},
         )
-        if not existing:
+        if not deleted:
             return False, "Review not found"
 
-        await database.execute(
-            "DELETE FROM reviews WHERE user_id = :user_id AND album_id = :album_id",
-            {"user_id": int(user_id), "album_id": album_id},
-        )
-
         return True, "Review deleted"
 
+    async def import_reviews(self, user_id, reviews):
+
+        # reviews is a list of (album_id, rating, review); if the same album appears twice the last one wins
+        latest = {album_id: (rating, review) for album_id, rating, review in reviews}
+        album_ids = list(latest)
+
+        # albums we have never seen locally are hydrated with one batched Spotify lookup; the lookup runs before the
+        # transaction so no connection is held across the network call, the album rows are written inside it
+        missing = await album_manager.missing_album_ids(album_ids)
+        unknown = set()
+        found = []
+        if missing:
+            token = await get_spotify_token()
+            found = await search_for_albums_by_ids(token, missing)
+            unknown = set(missing) - {album.album_id for album in found}
+
+        to_save = [album_id for album_id in album_ids if album_id not in unknown]
+
+        saved = set()
+        if to_save:
+            async with database.transaction():
+                await album_manager.save_albums(found)
+                rows = await database.fetch_all(
+                    """
+                    INSERT INTO reviews (user_id, album_id, rating, review, created_at)
+                    SELECT :user_id, album_id, rating, review, CURRENT_TIMESTAMP
+                    FROM unnest(
+                        CAST(:album_ids AS TEXT[]),
+                        CAST(:ratings AS INTEGER[]),
+                        CAST(:reviews AS TEXT[])
+                    ) AS t(album_id, rating, review)
+                    ON CONFLICT (user_id, album_id) DO UPDATE
+                    SET rating = EXCLUDED.rating, review = EXCLUDED.review, updated_at = CURRENT_TIMESTAMP
+                    RETURNING album_id
+                    """,
+                    {
+                        "user_id": int(user_id),
+                        "album_ids": to_save,
+                        "ratings": [latest[album_id][0] for album_id in to_save],
+                        "reviews": [latest[album_id][1] for album_id in to_save],
+                    },
+                )
+            saved = {row["album_id"] for row in rows}
+
+        results = []
+        for album_id, _, _ in reviews:
+            if album_id in saved:
+                results.append((album_id, True, "Review added successfully"))
+            elif album_id in unknown:
+                results.append((album_id, False, "Album not found"))
+            else:
+                results.append((album_id, False, "Review could not be saved"))
+
+        return results
+
     def get_reviews_for_album(self, album_id):
 
         with self.connect() as conn:
@@ -70,29 +128,39 @@ class ReviewManager:
             )
             return cursor.fetchall()
 
-    async def get_user_reviews(self, user_id):
+    async def get_user_reviews(self, user_id, limit=None):
 
-        reviews = await database.fetch_all(
-            "SELECT a.album_name, a.artist_name, a.cover, r.rating, r.review FROM reviews r JOIN albums a ON r.album_id = a.album_id WHERE user_id = :user_id",
-            {"user_id": user_id},
-        )
+        # newest first; limit=None returns every review (LIMIT NULL means no limit in Postgres)
+        reviews = await reader.fetch_all(USER_REVIEWS_QUERY, {"user_id": user_id, "limit": limit})
         return reviews
 
+    async def iterate_user_reviews(self, user_id):
+
+        # rows come from a server-side cursor, so exporting a long history never holds it all in memory
+        async for row in reader.iterate(
+            """
+            SELECT r.album_id, a.album_name, a.artist_name, r.rating, r.review, r.created_at, r.updated_at
+            FROM reviews r JOIN albums a ON r.album_id = a.album_id
+            WHERE r.user_id = :user_id
+            ORDER BY r.id
+            """,
+            {"user_id": user_id},
+        ):
+            yield row
+
+    async def iterate_user_follows(self, user_id):
+
+        async for row in reader.iterate(
+            """
+            SELECT u.id AS followed_id, u.username AS followed_username, f.created_at
+            FROM followers f JOIN users u ON u.id = f.followed_id
+            WHERE f.follower_id = :user_id
+            ORDER BY f.created_at
+            """,
+            {"user_id": user_id},
+        ):
+            yield row
+
     async def friends_recent_activity(self, user_id):
 
-        query = """
-        SELECT
-    a.album_name,
-    a.artist_name,
-    a.cover,
-    r.rating,
-    r.review
-FROM followers f
-JOIN reviews r ON r.user_id = f.followed_id
-JOIN albums a ON a.album_id = r.album_id
-WHERE f.follower_id = :user_id
-  AND COALESCE(r.updated_at, r.created_at) >= NOW() - INTERVAL '7 days'
-ORDER BY COALESCE(r.updated_at, r.created_at) DESC
-        """
-
-        return await database.fetch_all(query, {"user_id": user_id})
+        return await reader.fetch_all(FRIENDS_ACTIVITY_QUERY, {"user_id": user_id})
@@ -1,90 +1,252 @@
 from user_manager import UserManager
 from review_manager import ReviewManager
+from catalog_writer import CatalogWriter
+from recommendation_refresher import RecommendationRefresher
+from metrics import MetricsMiddleware, registry, in_flight
+from profiler import LoopWatchdog, SamplingProfiler
+from trending import TrendingCache, TRENDING_SIZE
+from health import HealthMonitor
+from rate_limit import limit_upstream
+from covers import CoverCache
 import os
-from spotify import get_spotify_token, search_for_artist_albums, search_for_album
+import asyncio
+import contextlib
+import logging
+import csv
+import io
+import json
+from spotify import (
+    CLIENT_ID,
+    CLIENT_SECRET,
+    get_spotify_token,
+    search_for_artist_albums,
+    search_for_album,
+)
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from init_db import database
-from fastapi import FastAPI, status, Response, HTTPException, Depends
+from init_db import database, reader, DB_POOL_MIN_SIZE
+from fastapi import APIRouter, BackgroundTasks, FastAPI, status, Request, Response, HTTPException, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from models import (
     AlbumOut,
+    TrendingAlbumOut,
     ReviewCreate,
+    ReviewImport,
+    ReviewImportResultOut,
     ReviewDelete,
     ReviewOut,
     FavoriteCreate,
     FollowerCreate,
     FavoritesOut,
     FollowDelete,
+    FollowBatch,
+    FollowResultOut,
     FollowersOut,
     FollowingOut,
+    FollowEntryOut,
+    FollowPageOut,
+    UserSuggestionOut,
+    UserMatchOut,
     UserProfileOut,
     ActivityOut,
     BioUpdate,
     PictureUpdate,
     UserRegister,
     UserLogin,
+    TokenRefresh,
     User,
 )
-from auth import hash_password, verify_password, create_access_token, get_current_user
+from auth import (
+    hash_password,
+    verify_password,
+    create_access_token,
+    create_refresh_token,
+    decode_token,
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    get_current_user,
+    get_admin_user,
+    LAST_WRITE_HEADER,
+)
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+router = APIRouter()
+logger = logging.getLogger(__name__)
+PROFILE_REVIEWS_LIMIT = int(os.getenv("PROFILE_REVIEWS_LIMIT", "20"))  # the full history is at /user/export
+EXPORT_COLUMNS = [
+    "type",
+    "album_id",
+    "album_name",
+    "artist_name",
+    "rating",
+    "review",
+    "followed_id",
+    "followed_username",
+    "created_at",
+    "updated_at",
+]
 review_manager = ReviewManager()
 user_manager = UserManager()
+# the stateful parts (background tasks, queues, caches) are built per app in create_app and live on app.state
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
+async def warm_up(app):
 
-@app.on_event("startup")
-async def startup():
-    await database.connect()
+    # everything the first requests after a deploy would otherwise pay for; /health/ready reports ready once it is done
+    # a failing step is logged and skipped, the requests that need it will pay for it as before
+    try:
+        # run a query on every connection the pool keeps open, so none of them is set up on a request's time
+        await asyncio.gather(*(database.fetch_val("SELECT 1") for _ in range(DB_POOL_MIN_SIZE)))
+    except Exception:
+        logger.exception("could not warm up the database pool")
+
+    if CLIENT_ID and CLIENT_SECRET:
+        try:
+            await get_spotify_token()
+        except Exception:
+            # Spotify being down must not keep the worker out of rotation, most reads are served locally
+            logger.exception("could not prefetch the Spotify token")
 
+    # the trending list, with its album rows, is the hot data every worker serves from memory
+    try:
+        await app.state.trending_cache.refresh()
+    except Exception:
+        logger.exception("could not preload the trending albums")
+    app.state.trending_cache.start()
 
-@app.on_event("shutdown")
-async def shutdown():
-    await database.disconnect()
+    app.state.ready = True
 
 
-@app.get("/")
+@contextlib.asynccontextmanager
+async def lifespan(app):
+
+    # the database connection is the only thing startup waits for, so the worker answers liveness checks
+    # while warm_up runs in the background
+    app.state.ready = False
+    await database.connect()
+    await reader.connect()
+    state = app.state
+    state.catalog_writer.start()
+    state.loop_watchdog.start()
+    state.health_monitor.start()
+    warming = asyncio.create_task(warm_up(app))
+
+    try:
+        yield
+    finally:
+        # uvicorn only gets here after it closed the listener and waited for open connections
+        # (--timeout-graceful-shutdown), so there are no requests left to drain, only background work
+        warming.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await warming
+
+        await state.loop_watchdog.stop()
+        await state.health_monitor.stop()
+        await state.trending_cache.stop()
+        await state.recommendation_refresher.stop()
+        await state.catalog_writer.stop()  # albums still queued are written before the database goes away
+        await state.cover_cache.stop()
+        await reader.disconnect()
+        await database.disconnect()
+
+
+@router.get("/")
 def home():
     return "musicboxd_backend is up and running"
 
 
+# the health endpoints answer from the HealthMonitor's last probe, none of them queries the database
+
+
+@router.get("/health/live")
+def liveness(request: Request):
+    # answering at all means the event loop is running; restarts are for a worker that stops answering
+    return {"alive": True, "loop_lag_ms": round(request.app.state.health_monitor.loop_lag_ms, 1)}
+
+
+@router.get("/health/ready")
+def readiness(request: Request, response: Response):
+    # 503 until warm-up has finished, while the database probe fails, the pool is exhausted or the loop lags,
+    # and again once shutdown has started
+    ready, details = request.app.state.health_monitor.readiness(getattr(request.app.state, "ready", False))
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"ready": ready, **details}
+
+
+@router.get("/health/capacity")
+def capacity(request: Request):
+    # for the autoscaler: "saturation" near or above 1 means this worker is at its limit
+    return request.app.state.health_monitor.capacity()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text format: per-route latency, DB queries, upstream calls and cache hits
+    return registry.render()
+
+
+@router.get("/metrics/catalog_writer", status_code=status.HTTP_200_OK)
+def catalog_writer_metrics(request: Request):
+    return request.app.state.catalog_writer.stats()
+
+
+@router.post("/admin/profile", response_class=PlainTextResponse)
+async def profile_worker(
+    request: Request,
+    seconds: float = Query(10, gt=0, le=60),
+    interval_ms: float = Query(5, ge=1, le=100),
+    user: User = Depends(get_admin_user),
+):
+    # samples this worker's event loop for `seconds` and returns folded stacks for a flamegraph
+    # (e.g. flamegraph.pl profile.txt > profile.svg, or open the file in speedscope)
+    try:
+        return await request.app.state.profiler.profile(seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+
 # USER FUNCTIONS
 
 
-@app.post("/register", status_code=status.HTTP_201_CREATED)
+@router.post("/register", status_code=status.HTTP_201_CREATED)
 async def register(user: UserRegister):
 
     existing = await database.fetch_one(
-        "select * from users where username = :username", {"username": user.username}
+        "select id from users where LOWER(username) = LOWER(:username)",
+        {"username": user.username},
     )
     if existing:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists"
         )
 
-    hashed_password = hash_password(user.password)
-    await database.execute(
-        "insert into users (username, password_hash) values (:username, :password_hash)",
+    # bcrypt is deliberately slow, so it runs in the threadpool instead of blocking the event loop
+    hashed_password = await run_in_threadpool(hash_password, user.password)
+    # the check above is only a shortcut: two requests for "Bob" and "bob" can both pass it, the unique index on
+    # LOWER(username) decides, and the one that loses gets the same answer instead of a unique violation
+    created = await database.fetch_one(
+        """
+        insert into users (username, password_hash) values (:username, :password_hash)
+        on conflict do nothing
+        returning id
+        """,
         {"username": user.username, "password_hash": hashed_password},
     )
+    if created is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists"
+        )
 
     return {"message": "User successfully registered"}
 
 
-@app.post("/login", status_code=status.HTTP_200_OK)
+@router.post("/login", status_code=status.HTTP_200_OK)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
 
     user = await database.fetch_one(
-        "select id, username, password_hash from users where username = :username",
+        "select id, username, password_hash from users where LOWER(username) = LOWER(:username)",
         {"username": form_data.username},
     )
     if not user:
@@ -93,67 +255,103 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
         )
     hashed_password = user["password_hash"]
 
-    if not verify_password(form_data.password, hashed_password):
+    if not await run_in_threadpool(
+        verify_password, form_data.password, hashed_password
+    ):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Wrong password"
         )
 
     # after the user credentials are verified, we have to return a jwt token
 
-    token = create_access_token({"sub": str(user["id"])})
+    return issue_tokens(user["id"], user["username"])
+
+
+def issue_tokens(user_id, username):
+
+    return {
+        "access_token": create_access_token(user_id, username),
+        "refresh_token": create_refresh_token(user_id),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
 
-    return {"access_token": token, "token_type": "bearer"}
+@router.post("/token/refresh", status_code=status.HTTP_200_OK)
+async def refresh_token(body: TokenRefresh):
+
+    # the one place a token leads to a user lookup: a deleted user cannot get new access tokens, and the username
+    # in the new access token is the current one; the refresh token is rotated: its jti is recorded as used, so it
+    # cannot be exchanged a second time (a stolen copy stops working once either party has used it)
+    from jose import JWTError
+
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = decode_token(body.refresh_token)
+    except JWTError:
+        raise credentials_exception
+    if payload.get("type") != "refresh" or payload.get("sub") is None or payload.get("jti") is None:
+        raise credentials_exception
+
+    # the user lookup, marking the jti as used and purging the user's expired entries are one statement; of two
+    # requests with the same token only the one whose insert wins gets a row back
+    user = await database.fetch_one(
+        """
+        WITH purged AS (
+            DELETE FROM used_refresh_tokens WHERE user_id = :user_id AND expires_at < CURRENT_TIMESTAMP
+        ),
+        used AS (
+            INSERT INTO used_refresh_tokens (jti, user_id, expires_at)
+            SELECT :jti, id, to_timestamp(CAST(:expires_at AS DOUBLE PRECISION)) FROM users WHERE id = :user_id
+            ON CONFLICT (jti) DO NOTHING
+            RETURNING user_id
+        )
+        SELECT u.id, u.username FROM users u JOIN used ON used.user_id = u.id
+        """,
+        {"user_id": int(payload["sub"]), "jti": payload["jti"], "expires_at": payload["exp"]},
+    )
+    if user is None:
+        raise credentials_exception
+
+    return issue_tokens(user["id"], user["username"])
 
 
 # REVIEWS FUNCTIONS
 
 
-@app.get(
+@router.get(
     "/search/artist/{artist_name}",
     response_model=list[AlbumOut],
     status_code=status.HTTP_200_OK,
+    dependencies=[Depends(limit_upstream())],
 )
 async def search_artists_albums(
-    artist_name: str, user: User = Depends(get_current_user)
+    artist_name: str, background_tasks: BackgroundTasks, user: User = Depends(get_current_user)
 ):  # we don t need current user data here, but by adding the dependency the request will wait for the JWT Token, so only logged in user can use this
 
-    token = await get_spotify_token()
+    # on a mirror miss the Spotify answer is returned right away and the mirror is written after the response is sent
     albums_list: list[AlbumOut] = []
-    albums = await search_for_artist_albums(token, artist_name)
+    albums = await search_for_artist_albums(artist_name, defer=background_tasks.add_task)
     for album in albums:
-        album_data = AlbumOut(
-            album_id=album["id"],
-            album_name=album["name"],
-            artist_name=album["artists"][0]["name"],
-            artist_id=album["artists"][0]["id"],
-            release_date=album["release_date"],
-            cover=album["images"][0]["url"],
-        )
-        await database.execute(
-            """
-            INSERT INTO albums
-            (album_id, album_name, artist_name, artist_id, release_date, cover)
-            VALUES (:album_id, :album_name, :artist_name, :artist_id, :release_date, :cover)
-            ON CONFLICT (album_id) DO NOTHING
-            """,
-            album_data.model_dump(),  # converts the AlbumOut object (called album_data) from a Pydantic model
-            # to a python dictionary; :album_id, :album_name etc. are placeholder names for variables
-            # that will be replaced by album_id, album_name etc. from the python dictionary
-        )
-        albums_list.append(album_data)
+        albums_list.append(AlbumOut(**album._asdict()))
 
     return albums_list
 
 
-@app.get(
+@router.get(
     "/search/album/{album_name}",
     response_model=list[AlbumOut],
     status_code=status.HTTP_200_OK,
+    dependencies=[Depends(limit_upstream())],
 )
-async def search_album(album_name: str, user: User = Depends(get_current_user)):
+async def search_album(album_name: str, request: Request, user: User = Depends(get_current_user)):
 
     pattern = f"%{album_name}%"
-    existing = await database.fetch_one(
+    existing = await reader.fetch_one(
         "SELECT * FROM albums WHERE lower(album_name) ILIKE lower(:pattern)",
         {
             "pattern": pattern
@@ -163,26 +361,16 @@ async def search_album(album_name: str, user: User = Depends(get_current_user)):
     if not existing:
 
         token = await get_spotify_token()
-        album = await search_for_album(token, album_name)  # returns a dictionary
-
-        album_data = AlbumOut(
-            album_id=album["id"],
-            album_name=album["name"],
-            artist_name=album["artists"][0]["name"],
-            artist_id=album["artists"][0]["id"],
-            release_date=album["release_date"],
-            cover=album["images"][0]["url"],
-        )
+        album = await search_for_album(token, album_name)  # returns an Album record
+        if album is None:
+            return []
 
-        await database.execute(
-            """
-                           INSERT INTO albums (album_id, album_name, artist_name, artist_id, release_date, cover) VALUES 
-                (:album_id, :album_name, :artist_name, :artist_id, :release_date, :cover)
-                ON CONFLICT (album_id) DO NOTHING""",
-            album_data.model_dump(),
-        )
+        await request.app.state.catalog_writer.enqueue(album)
+
+        # nothing matched locally, so the album we just found is the whole result
+        return [AlbumOut(**album._asdict())]
 
-    albums = await database.fetch_all(
+    albums = await reader.fetch_all(
         "SELECT * FROM albums WHERE lower(album_name) ILIKE lower(:pattern)",
         {"pattern": pattern},
     )
@@ -206,12 +394,42 @@ async def search_album(album_name: str, user: User = Depends(get_current_user)):
 # LATER, WHEN WE HAVE AUTH, WE WILL DO IT WITH Depends(get_current_user)
 
 
-@app.post("/album/{album_id}/rating", status_code=status.HTTP_200_OK)
+@router.get("/album/{album_id}/cover")
+async def album_cover(
+    album_id: str, request: Request, size: int | None = Query(None, ge=16, le=1000)
+):
+    # no auth: covers are public and <img> tags cannot send a bearer token
+    # only covers of albums in our catalog are proxied, never an arbitrary url
+    cover = await reader.fetch_val(
+        "SELECT cover FROM albums WHERE album_id = :album_id", {"album_id": album_id}
+    )
+    if not cover:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Cover not found")
+
+    try:
+        path, etag, media_type = await request.app.state.cover_cache.get(cover, size)
+    except Exception:
+        logger.exception("could not fetch the cover of album %s", album_id)
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY, detail="Cover could not be fetched"
+        )
+
+    # the ETag is the hash of the image, so the same URL keeps serving the same bytes and can be cached for good
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@router.post("/album/{album_id}/rating", status_code=status.HTTP_200_OK)
 async def rate_album(
-    album_id: str, review: ReviewCreate, user: User = Depends(get_current_user)
+    album_id: str, review: ReviewCreate, request: Request, user: User = Depends(get_current_user)
 ):  # review is an object of the ReviewCreate Pydantic class
 
     user_id = user.id
+    await request.app.state.catalog_writer.ensure_written([album_id])
     success, message = await review_manager.add_review(
         user_id, album_id, review.rating, review.review
     )
@@ -220,10 +438,38 @@ async def rate_album(
     if not success:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
 
+    # a liked album refreshes the user's recommendations in the background (debounced per user)
+    if review.rating >= 3:
+        request.app.state.recommendation_refresher.schedule(user_id, album_id)
+
     return {"message": message}  # fastapi automatically serializes this to json
 
 
-@app.delete("/album/{album_id}/delete_rating", status_code=status.HTTP_200_OK)
+@router.post(
+    "/album/import_ratings",
+    response_model=list[ReviewImportResultOut],
+    status_code=status.HTTP_200_OK,
+)
+async def import_ratings(batch: ReviewImport, request: Request, user: User = Depends(get_current_user)):
+
+    # one request (and one auth check) for a whole list of ratings, results are reported per album
+    await request.app.state.catalog_writer.ensure_written([item.album_id for item in batch.reviews])
+    results = await review_manager.import_reviews(
+        user.id, [(item.album_id, item.rating, item.review) for item in batch.reviews]
+    )
+
+    ratings = {item.album_id: item.rating for item in batch.reviews}
+    for album_id, success, _ in results:
+        if success and ratings[album_id] >= 3:
+            request.app.state.recommendation_refresher.schedule(user.id, album_id)
+
+    return [
+        ReviewImportResultOut(album_id=album_id, success=success, message=message)
+        for album_id, success, message in results
+    ]
+
+
+@router.delete("/album/{album_id}/delete_rating", status_code=status.HTTP_200_OK)
 async def delete_rate(album_id: str, user: User = Depends(get_current_user)):
 
     user_id = user.id
@@ -238,10 +484,11 @@ async def delete_rate(album_id: str, user: User = Depends(get_current_user)):
 # FAVORITES FUNCTION
 
 
-@app.post("/album/{album_id}/add_favorite", status_code=status.HTTP_201_CREATED)
-async def add_to_favorites(album_id: str, user: User = Depends(get_current_user)):
+@router.post("/album/{album_id}/add_favorite", status_code=status.HTTP_201_CREATED)
+async def add_to_favorites(album_id: str, request: Request, user: User = Depends(get_current_user)):
 
     user_id = user.id
+    await request.app.state.catalog_writer.ensure_written([album_id])
     success, message = await user_manager.add_favourite(user_id, album_id)
     if not success:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
@@ -249,15 +496,16 @@ async def add_to_favorites(album_id: str, user: User = Depends(get_current_user)
     return {"message": message}
 
 
-@app.get(
+@router.get(
     "/user/{username}/get_favorites",
     response_model=list[AlbumOut],
     status_code=status.HTTP_200_OK,
 )
 async def get_user_favorites(username: str, user: User = Depends(get_current_user)):
 
-    searched_user = await database.fetch_one(
-        "select id from users where username = :username", {"username": username}
+    searched_user = await reader.fetch_one(
+        "select id from users where LOWER(username) = LOWER(:username)",
+        {"username": username},
     )
     if not searched_user:
         raise HTTPException(
@@ -271,16 +519,30 @@ async def get_user_favorites(username: str, user: User = Depends(get_current_use
 # FOLLOWERS FUNCTIONS
 
 
-@app.get("/user/{username}/search", status_code=status.HTTP_200_OK, response_model=User)
+@router.get("/user/{username}/search", status_code=status.HTTP_200_OK, response_model=User)
 async def search_user(username: str, user: User = Depends(get_current_user)):
 
-    searched_user_id = await user_manager.search_user(username)
-    if not searched_user_id:
+    searched_user = await user_manager.search_user(username)
+    if not searched_user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(id=searched_user_id, username=username)
+    return User(**searched_user)
 
 
-@app.post("/user/{followed_id}/follow", status_code=status.HTTP_200_OK)
+@router.get(
+    "/user/autocomplete",
+    response_model=list[UserMatchOut],
+    status_code=status.HTTP_200_OK,
+)
+async def autocomplete_users(
+    q: str = Query(..., min_length=1, max_length=50),
+    limit: int = Query(10, ge=1, le=25),
+    user: User = Depends(get_current_user),
+):
+    # meant to be called on every keystroke: one index range scan, no Spotify, no per-user queries
+    return await user_manager.autocomplete_users(q, limit)
+
+
+@router.post("/user/{followed_id}/follow", status_code=status.HTTP_200_OK)
 async def follow(followed_id: int, user: User = Depends(get_current_user)):
 
     follower_id = user.id
@@ -298,7 +560,7 @@ async def follow(followed_id: int, user: User = Depends(get_current_user)):
     return {"message": message}
 
 
-@app.delete("/user/{followed_id}/unfollow", status_code=status.HTTP_200_OK)
+@router.delete("/user/{followed_id}/unfollow", status_code=status.HTTP_200_OK)
 async def unfollow(followed_id: int, user: User = Depends(get_current_user)):
 
     follower_id = user.id
@@ -316,42 +578,126 @@ async def unfollow(followed_id: int, user: User = Depends(get_current_user)):
     return {"message": message}
 
 
-@app.get(
+@router.post(
+    "/user/follow_batch",
+    response_model=list[FollowResultOut],
+    status_code=status.HTTP_200_OK,
+)
+async def follow_batch(batch: FollowBatch, user: User = Depends(get_current_user)):
+
+    results = await user_manager.follow_users(user.id, batch.user_ids)
+
+    return [
+        FollowResultOut(user_id=user_id, success=success, message=message)
+        for user_id, success, message in results
+    ]
+
+
+@router.post(
+    "/user/unfollow_batch",
+    response_model=list[FollowResultOut],
+    status_code=status.HTTP_200_OK,
+)
+async def unfollow_batch(batch: FollowBatch, user: User = Depends(get_current_user)):
+
+    results = await user_manager.unfollow_users(user.id, batch.user_ids)
+
+    return [
+        FollowResultOut(user_id=user_id, success=success, message=message)
+        for user_id, success, message in results
+    ]
+
+
+@router.get(
     "/user/get_followers",
     response_model=list[FollowersOut],
     status_code=status.HTTP_200_OK,
 )
-async def get_follower(user: User = Depends(get_current_user)):
-    followers = await user_manager.get_followers(user.id)
-    followers_return: list[FollowersOut] = []
-    for follower in followers:
-        followers_return.append(follower)
-    return followers_return
+async def get_follower(
+    after: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+    user: User = Depends(get_current_user),
+):
+    # legacy endpoint, the whole list unless the client asks for a page (LIMIT NULL is no limit);
+    # /user/{user_id}/followers is the paginated one
+    return await user_manager.get_followers(user.id, after=after, limit=limit)
 
 
-@app.get(
+@router.get(
     "/user/get_following",
     response_model=list[FollowingOut],
     status_code=status.HTTP_200_OK,
 )
-async def get_following(user: User = Depends(get_current_user)):
-    followings = await user_manager.get_following(user.id)
-    followings_return: list[FollowingOut] = []
-    for following in followings:
-        followings_return.append(following)
-    return followings_return
+async def get_following(
+    after: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+    user: User = Depends(get_current_user),
+):
+    # legacy endpoint, the whole list unless the client asks for a page (LIMIT NULL is no limit);
+    # /user/{user_id}/following is the paginated one
+    return await user_manager.get_following(user.id, after=after, limit=limit)
+
+
+def follow_page(rows, limit):
+
+    # one extra row is fetched to know whether another page exists
+    items = [FollowEntryOut(**row) for row in rows[:limit]]
+    next_cursor = items[-1].id if len(rows) > limit else None
+    return FollowPageOut(items=items, next_cursor=next_cursor)
+
+
+@router.get(
+    "/user/{user_id}/followers",
+    response_model=FollowPageOut,
+    status_code=status.HTTP_200_OK,
+)
+async def get_user_followers(
+    user_id: int,
+    after: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=200),
+    user: User = Depends(get_current_user),
+):
+    rows = await user_manager.get_followers(user_id, user.id, after, limit + 1)
+    return follow_page(rows, limit)
+
+
+@router.get(
+    "/user/{user_id}/following",
+    response_model=FollowPageOut,
+    status_code=status.HTTP_200_OK,
+)
+async def get_user_following(
+    user_id: int,
+    after: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=200),
+    user: User = Depends(get_current_user),
+):
+    rows = await user_manager.get_following(user_id, user.id, after, limit + 1)
+    return follow_page(rows, limit)
+
+
+@router.get(
+    "/user/suggestions",
+    response_model=list[UserSuggestionOut],
+    status_code=status.HTTP_200_OK,
+)
+async def get_user_suggestions(
+    limit: int = Query(20, ge=1, le=50), user: User = Depends(get_current_user)
+):
+    # precomputed by the recommendation pipeline ("people" stage), one indexed read per request
+    return await user_manager.get_user_suggestions(user.id, limit)
 
 
 # USER PROFILE
-@app.get(
+@router.get(
     "/user/{username}/profile",
     response_model=UserProfileOut,
     status_code=status.HTTP_200_OK,
 )
 async def get_profile(username, user: User = Depends(get_current_user)):
 
-    user = await database.fetch_one(
-        "SELECT id, username, bio, picture FROM users WHERE LOWER(username) = :username",
+    user = await reader.fetch_one(
+        "SELECT id, username, bio, picture FROM users WHERE LOWER(username) = :username",  # users_username_lower_idx
         {"username": username.lower()},
     )
     if not user:
@@ -366,7 +712,7 @@ async def get_profile(username, user: User = Depends(get_current_user)):
         "picture": user["picture"],
     }
 
-    favorites = await database.fetch_all(
+    favorites = await reader.fetch_all(
         """
             SELECT a.album_id as album_id, a.album_name as album_name, a.artist_id as artist_id, a.artist_name as artist_name, a.release_date as release_date, a.cover as cover
             FROM favorites f
@@ -382,19 +728,21 @@ async def get_profile(username, user: User = Depends(get_current_user)):
     # the sql query returnes a list of dictionaries with the same keys as the name of the fields of AlbumOut => favorites is that list of dicts
     # so we create a list of AlbumOut objects, by unpacking the dict key-value pairs with the **operator
 
-    row = await database.fetch_one(
+    row = await reader.fetch_one(
         "SELECT COUNT(*) as count FROM followers WHERE followed_id = :user_id",
         {"user_id": user_data["id"]},
     )
     user_data["followers_count"] = row["count"]
 
-    row = await database.fetch_one(
+    row = await reader.fetch_one(
         "SELECT COUNT(*) as count FROM followers WHERE follower_id = :user_id",
         {"user_id": user_data["id"]},
     )
     user_data["following_count"] = row["count"]
 
-    reviews = await review_manager.get_user_reviews(user["id"])
+    reviews = await review_manager.get_user_reviews(
+        user["id"], limit=PROFILE_REVIEWS_LIMIT
+    )
     user_data["reviews"] = [
         ReviewOut(**dict(r)) for r in reviews
     ]  # same as with favorites
@@ -411,10 +759,10 @@ async def get_profile(username, user: User = Depends(get_current_user)):
     )
 
 
-@app.get("/user/profile", response_model=UserProfileOut, status_code=status.HTTP_200_OK)
+@router.get("/user/profile", response_model=UserProfileOut, status_code=status.HTTP_200_OK)
 async def get_own_profile(user: User = Depends(get_current_user)):
 
-    user = await database.fetch_one(
+    user = await reader.fetch_one(
         "SELECT id, username, bio, picture FROM users WHERE id = :id",
         {"id": user.id},
     )
@@ -426,7 +774,7 @@ async def get_own_profile(user: User = Depends(get_current_user)):
         "picture": user["picture"],
     }
 
-    favorites = await database.fetch_all(
+    favorites = await reader.fetch_all(
         """
             SELECT a.album_id as album_id, a.album_name as album_name, a.artist_id as artist_id, a.artist_name as artist_name, a.release_date as release_date, a.cover as cover
             FROM favorites f
@@ -442,19 +790,21 @@ async def get_own_profile(user: User = Depends(get_current_user)):
     # the sql query returnes a list of dictionaries with the same keys as the name of the fields of AlbumOut => favorites is that list of dicts
     # so we create a list of AlbumOut objects, by unpacking the dict key-value pairs with the **operator
 
-    row = await database.fetch_one(
+    row = await reader.fetch_one(
         "SELECT COUNT(*) as count FROM followers WHERE followed_id = :user_id",
         {"user_id": user_data["id"]},
     )
     user_data["followers_count"] = row["count"]
 
-    row = await database.fetch_one(
+    row = await reader.fetch_one(
         "SELECT COUNT(*) as count FROM followers WHERE follower_id = :user_id",
         {"user_id": user_data["id"]},
     )
     user_data["following_count"] = row["count"]
 
-    reviews = await review_manager.get_user_reviews(user["id"])
+    reviews = await review_manager.get_user_reviews(
+        user["id"], limit=PROFILE_REVIEWS_LIMIT
+    )
     user_data["reviews"] = [
         ReviewOut(**dict(r)) for r in reviews
     ]  # same as with favorites
@@ -471,7 +821,56 @@ async def get_own_profile(user: User = Depends(get_current_user)):
     )
 
 
-@app.get(
+@router.get("/user/export", status_code=status.HTTP_200_OK)
+async def export_activity(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    user: User = Depends(get_current_user),
+):
+
+    # streams every review and follow of the user, one record per line, straight from a server-side cursor;
+    # memory stays constant however long the history is
+    async def records():
+        async for row in review_manager.iterate_user_reviews(user.id):
+            yield {"type": "review", **dict(row)}
+        async for row in review_manager.iterate_user_follows(user.id):
+            yield {"type": "follow", **dict(row)}
+
+    def jsonable(record):
+        return {
+            key: value.isoformat() if hasattr(value, "isoformat") else value
+            for key, value in record.items()
+        }
+
+    async def ndjson():
+        async for record in records():
+            yield json.dumps(jsonable(record)) + "\n"
+
+    async def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+        writer.writeheader()
+        async for record in records():
+            writer.writerow(jsonable(record))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
+
+    if format == "csv":
+        return StreamingResponse(
+            csv_lines(),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="export.csv"'},
+        )
+
+    return StreamingResponse(
+        ndjson(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="export.ndjson"'},
+    )
+
+
+@router.get(
     "/user/friends_activity",
     response_model=list[ActivityOut],
     status_code=status.HTTP_200_OK,
@@ -482,7 +881,7 @@ async def friends_activity(user: User = Depends(get_current_user)):
     return recent_activity
 
 
-@app.put("/user/update_bio", status_code=status.HTTP_200_OK)
+@router.put("/user/update_bio", status_code=status.HTTP_200_OK)
 async def update_bio(bio: BioUpdate, user: User = Depends(get_current_user)):
 
     if not user.id:
@@ -499,7 +898,7 @@ async def update_bio(bio: BioUpdate, user: User = Depends(get_current_user)):
     return {"message": "Bio successfully updated"}
 
 
-@app.put("/user/update_picture", status_code=status.HTTP_200_OK)
+@router.put("/user/update_picture", status_code=status.HTTP_200_OK)
 async def update_picture(
     picture: PictureUpdate, user: User = Depends(get_current_user)
 ):
@@ -522,9 +921,11 @@ async def update_picture(
 # RECOMANDATION ENGINE
 
 
-@app.get("/user/get_recommendations", response_model=list[AlbumOut])
+@router.get("/user/get_recommendations", response_model=list[AlbumOut])
 async def get_recommendations(user: User = Depends(get_current_user)):
 
+    # only the active generation is read (the subquery is evaluated first, so the other partitions are pruned);
+    # albums reviewed since the generation was built are skipped, probed through the reviews (user_id, album_id) index
     query = """
         SELECT
             a.album_id,
@@ -535,8 +936,80 @@ async def get_recommendations(user: User = Depends(get_current_user)):
         FROM recommendations r
         JOIN albums a ON a.album_id = r.album_id
         WHERE r.user_id = :user_id
+        AND r.generation = (SELECT generation FROM recommendation_generations WHERE status = 'active')
+        AND NOT EXISTS (
+            SELECT 1 FROM reviews rv
+            WHERE rv.user_id = r.user_id AND rv.album_id = r.album_id
+        )
         ORDER BY RANDOM()
         LIMIT 10
     """
 
-    return await database.fetch_all(query, {"user_id": user.id})
+    return await reader.fetch_all(query, {"user_id": user.id})
+
+
+@router.get("/albums/trending", response_model=list[TrendingAlbumOut])
+async def trending_albums(request: Request, limit: int = Query(20, ge=1, le=TRENDING_SIZE)):
+
+    # served from memory: the ranking is recomputed by the trending_albums DAG and re-read in the background
+    return request.app.state.trending_cache.get(limit)
+
+
+def create_app():
+
+    # uvicorn server:app uses the module-level app below, uvicorn --factory server:create_app builds a fresh one;
+    # nothing here touches the database or Spotify, connections are opened by lifespan()
+    app = FastAPI(lifespan=lifespan)
+
+    # one of each per app, so two apps in a process (tests, --factory reloads) do not share queues or background tasks
+    state = app.state
+    state.catalog_writer = CatalogWriter()
+    state.profiler = SamplingProfiler()
+    state.recommendation_refresher = RecommendationRefresher(user_manager)
+    state.loop_watchdog = LoopWatchdog()
+    state.trending_cache = TrendingCache()
+    state.health_monitor = HealthMonitor()
+    state.cover_cache = CoverCache()
+
+    # the registry is per process, the gauges report the app built last (the one uvicorn serves)
+    registry.gauge(
+        "catalog_writer_queue_depth",
+        lambda: state.catalog_writer.queue.qsize(),
+        "Albums waiting to be written to the catalog",
+    )
+    registry.gauge(
+        "catalog_writer_last_flush_seconds",
+        lambda: state.catalog_writer.last_flush_seconds,
+        "Duration of the last catalog flush",
+    )
+    registry.gauge(
+        "http_requests_in_flight",
+        in_flight,
+        "Requests this worker is handling right now",
+    )
+    registry.gauge(
+        "worker_saturation",
+        lambda: state.health_monitor.capacity()["saturation"],
+        "Most saturated of the DB pool and the event loop, 1 = at the limit",
+    )
+    registry.gauge(
+        "recommendation_refreshes_waiting",
+        lambda: state.recommendation_refresher.stats()["waiting"],
+        "Users with an on-demand recommendation refresh waiting for its debounce delay",
+    )
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=False,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=[LAST_WRITE_HEADER],  # so a browser client on another origin can echo it back
+    )
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+
+    return app
+
+
+app = create_app()
@@ -1,19 +1,63 @@
 from dotenv import load_dotenv
 import os
+import time
 import base64
-import requests
-import httpx  # we cannot use requests with await, we need httpx which is a modern http library replacing requests
-
-# we have httpx.AsyncClient which is the async version
+from album_manager import AlbumManager, Album, Artist, album_from_spotify, artist_from_spotify
+from init_db import database
+from metrics import record_cache, timed_upstream
+from rate_limit import charge
 
 load_dotenv()
 CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+# overridable so the benchmarks can point the app at a local Spotify stand-in (bench/fake_spotify.py)
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+
+# mirrored artist data younger than MIRROR_MAX_AGE_DAYS is served without calling Spotify,
+# the refresh DAG re-fetches anything older than MIRROR_REFRESH_AGE_DAYS before it gets there
+MIRROR_MAX_AGE_DAYS = int(os.getenv("SPOTIFY_MIRROR_MAX_AGE_DAYS", "30"))
+MIRROR_REFRESH_AGE_DAYS = int(os.getenv("SPOTIFY_MIRROR_REFRESH_AGE_DAYS", "7"))
+# Spotify has no field selection outside of playlists; with a market (e.g. US) album objects come without their
+# available_markets list, usually the largest part of the response, and only albums playable there are returned
+SPOTIFY_MARKET = os.getenv("SPOTIFY_MARKET")
+
+album_manager = AlbumManager()
+
+
+def http_client():
+
+    # we cannot use requests with await, httpx.AsyncClient is the async version; it is imported on the first
+    # Spotify call instead of at startup, most requests are served from the mirror and never need it
+    import httpx
+
+    return httpx.AsyncClient()
+
+
+# client credentials tokens are valid for an hour, so we keep the last one instead of asking for a new one on every call
+_token = None
+_token_expires_at = 0.0
 
 
 async def get_spotify_token():
 
-    url = "https://accounts.spotify.com/api/token"
+    # every Spotify call starts here, so this is where a rate limited request pays for going upstream
+    await charge()
+
+    if _token and time.monotonic() < _token_expires_at:
+        record_cache("spotify_token", True)
+        return _token
+
+    record_cache("spotify_token", False)
+    return await fetch_spotify_token()
+
+
+@timed_upstream("spotify.token")
+async def fetch_spotify_token():
+
+    global _token, _token_expires_at
+
+    url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
 
     id = CLIENT_ID + ":" + CLIENT_SECRET
     id_encoded = id.encode("utf-8")
@@ -26,106 +70,391 @@ async def get_spotify_token():
 
     data = {"grant_type": "client_credentials"}
 
-    async with httpx.AsyncClient() as client:
+    async with http_client() as client:
         response = await client.post(url, data=data, headers=headers)
 
     json_result = response.json()
     token = json_result["access_token"]
 
+    # refresh a minute early so a token never expires in the middle of a request
+    _token = token
+    _token_expires_at = time.monotonic() + json_result.get("expires_in", 3600) - 60
+
     return token
 
 
-async def search_for_artist_id(token, artist_name):
+# SPOTIFY API CALLS
+# the raw calls parse responses into Album / Artist records right away, nothing else of Spotify's JSON is kept
+
+
+def market_params(params):
+
+    return dict(params, market=SPOTIFY_MARKET) if SPOTIFY_MARKET else params
+
+
+@timed_upstream("spotify.search_artist")
+async def fetch_artist(token, artist_name):
 
-    url = "https://api.spotify.com/v1/search"
+    url = f"{SPOTIFY_API_URL}/search"
 
     headers = {"Authorization": f"Bearer {token}"}
 
-    params = {"q": artist_name, "type": "artist", "limit": "1"}
+    params = market_params({"q": artist_name, "type": "artist", "limit": "1"})
 
-    async with httpx.AsyncClient() as client:
+    async with http_client() as client:
         response = await client.get(url, params=params, headers=headers)
 
     json_result = response.json()
 
     artist_items = json_result["artists"]["items"]
-    artist_items = artist_items[0]
+    if not artist_items:
+        return None
 
-    artist_id = artist_items["id"]
+    return artist_from_spotify(artist_items[0])
 
-    return artist_id
 
+@timed_upstream("spotify.artist_albums")
+async def fetch_artist_albums(token, artist_id):
 
-async def search_for_artist_albums(token, artist_name):
-
-    artist_id = await search_for_artist_id(token, artist_name)
-
-    url = f"https://api.spotify.com/v1/artists/{artist_id}/albums"
+    url = f"{SPOTIFY_API_URL}/artists/{artist_id}/albums"
 
     headers = {"Authorization": f"Bearer {token}"}
 
-    params = {"include_groups": "album"}
+    params = market_params({"include_groups": "album"})
 
-    async with httpx.AsyncClient() as client:
+    async with http_client() as client:
         response = await client.get(url, headers=headers, params=params)
 
     json_result = response.json()
 
-    albums = json_result["items"]
+    albums = [album_from_spotify(album) for album in json_result["items"]]
 
     return albums
 
 
+@timed_upstream("spotify.related_artists")
+async def fetch_related_artists(token, artist_id):
+
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async with http_client() as client:
+        response = await client.get(
+            f"{SPOTIFY_API_URL}/artists/{artist_id}/related-artists",
+            headers=headers,
+        )
+
+    json_result = response.json()
+
+    artists = [artist_from_spotify(artist) for artist in json_result.get("artists", [])]
+    return artists
+
+
+@timed_upstream("spotify.search_album")
 async def search_for_album(token, album_name):
 
-    url = "https://api.spotify.com/v1/search"
+    url = f"{SPOTIFY_API_URL}/search"
 
     headers = {"Authorization": f"Bearer {token}"}
 
-    params = {"q": album_name, "type": "album", "limit": 1}
+    params = market_params({"q": album_name, "type": "album", "limit": 1})
 
-    async with httpx.AsyncClient() as client:
+    async with http_client() as client:
         response = await client.get(url, headers=headers, params=params)
 
     json_result = response.json()
 
-    album = json_result["albums"]["items"][0]
+    album_items = json_result["albums"]["items"]
+    if not album_items:
+        return None
 
-    return album
+    return album_from_spotify(album_items[0])
 
 
 async def search_for_album_by_id(token, album_id):
 
-    url = "https://api.spotify.com/v1/albums"
+    albums = await search_for_albums_by_ids(token, [album_id])
+
+    return albums[0] if albums else None
+
+
+@timed_upstream("spotify.albums")
+async def search_for_albums_by_ids(token, album_ids):
+
+    # the several-albums endpoint accepts at most 20 ids per call; unknown ids come back as null and are skipped
+    url = f"{SPOTIFY_API_URL}/albums"
 
     headers = {"Authorization": f"Bearer {token}"}
-    params = {"ids": {album_id}}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers, params=params)
+    albums = []
 
-    album = response.json()
+    async with http_client() as client:
+        for start in range(0, len(album_ids), 20):
+            params = market_params({"ids": ",".join(album_ids[start : start + 20])})
+            response = await client.get(url, headers=headers, params=params)
+            albums.extend(
+                album_from_spotify(album) for album in response.json().get("albums", []) if album
+            )
 
-    return album["albums"][0]
+    return albums
 
 
-async def search_related_artists(token, artist_name):
+# LOCAL MIRROR
+# the functions below read the artists / artist_albums / related_artists tables first and only call Spotify
+# (and store the answer) when the artist is unknown or its mirrored data is older than MIRROR_MAX_AGE_DAYS
+# they fetch a token themselves only on a miss, so a fully mirrored lookup makes no upstream call at all
+
+
+async def save_artists(artists):
+
+    if not artists:
+        return
+
+    await database.execute(
+        """
+        INSERT INTO artists (artist_id, artist_name, fetched_at)
+        SELECT artist_id, artist_name, CURRENT_TIMESTAMP
+        FROM unnest(CAST(:artist_ids AS TEXT[]), CAST(:artist_names AS TEXT[])) AS t(artist_id, artist_name)
+        ON CONFLICT (artist_id) DO UPDATE
+        SET artist_name = EXCLUDED.artist_name, fetched_at = EXCLUDED.fetched_at
+        """,
+        {
+            "artist_ids": [artist.artist_id for artist in artists],
+            "artist_names": [artist.artist_name for artist in artists],
+        },
+    )
+
+
+async def search_for_artist_id(artist_name):
+
+    # the query a user typed rarely equals Spotify's canonical name, so earlier queries are looked up first
+    row = await database.fetch_one(
+        """
+        SELECT artist_id FROM artist_queries WHERE query = LOWER(:artist_name)
+        UNION ALL
+        (SELECT artist_id FROM artists WHERE LOWER(artist_name) = LOWER(:artist_name) LIMIT 1)
+        LIMIT 1
+        """,
+        {"artist_name": artist_name},
+    )
+    record_cache("artist_id", row is not None)
+    if row:
+        return row["artist_id"]
+
+    token = await get_spotify_token()
+    artist = await fetch_artist(token, artist_name)
+    if not artist:
+        return None
+
+    # the artist and the query pointing at it are stored in one statement
+    await database.execute(
+        """
+        WITH artist AS (
+            INSERT INTO artists (artist_id, artist_name, fetched_at)
+            VALUES (:artist_id, :name, CURRENT_TIMESTAMP)
+            ON CONFLICT (artist_id) DO UPDATE
+            SET artist_name = EXCLUDED.artist_name, fetched_at = EXCLUDED.fetched_at
+            RETURNING artist_id
+        )
+        INSERT INTO artist_queries (query, artist_id)
+        SELECT LOWER(:artist_name), artist_id FROM artist
+        ON CONFLICT (query) DO UPDATE SET artist_id = EXCLUDED.artist_id, fetched_at = CURRENT_TIMESTAMP
+        """,
+        {"artist_id": artist.artist_id, "name": artist.artist_name, "artist_name": artist_name},
+    )
+
+    return artist.artist_id
+
+
+async def get_artist_albums(artist_id, artist_name=None, defer=None):
+
+    # returns the artist's albums as Album records; artist_name is used when the artist is not mirrored yet
+    # defer is passed on to refresh_artist_albums when the mirror has to be refreshed
+    fresh = await database.fetch_one(
+        """
+        SELECT artist_id FROM artists
+        WHERE artist_id = :artist_id
+        AND albums_fetched_at >= NOW() - make_interval(days => :max_age)
+        """,
+        {"artist_id": artist_id, "max_age": MIRROR_MAX_AGE_DAYS},
+    )
+
+    record_cache("artist_albums", fresh is not None)
+    if fresh:
+        rows = await database.fetch_all(
+            """
+            SELECT a.album_id, a.album_name, a.artist_name, a.artist_id, a.release_date, a.cover
+            FROM artist_albums aa
+            JOIN albums a ON a.album_id = aa.album_id
+            WHERE aa.artist_id = :artist_id
+            ORDER BY a.release_date DESC
+            """,
+            {"artist_id": artist_id},
+        )
+        return [Album(**(dict(row) | {"release_date": str(row["release_date"])})) for row in rows]
+
+    return await refresh_artist_albums(artist_id, artist_name, defer)
+
 
-    artist_id = await search_for_artist_id(token, artist_name)
+async def refresh_artist_albums(artist_id, artist_name=None, defer=None):
+
+    # defer(fn, *args) hands the mirror write to the caller (a request passes BackgroundTasks.add_task, so the
+    # response goes out before the write transaction runs); without it the albums are stored before returning
+    token = await get_spotify_token()
+    albums = await fetch_artist_albums(token, artist_id)
+
+    if defer is not None:
+        defer(store_artist_albums, artist_id, albums, artist_name)
+    else:
+        await store_artist_albums(artist_id, albums, artist_name)
+
+    return albums
+
+
+async def store_artist_albums(artist_id, albums, artist_name=None):
+
+    # the artist row, the album rows and the links are replaced together, so a reader never sees half a discography
+    async with database.transaction():
+        # the artist row has to exist even for an empty discography, otherwise albums_fetched_at is not recorded
+        # and every lookup of the artist goes to Spotify again
+        artist_name = albums[0].artist_name if albums else artist_name
+        if artist_name:
+            await save_artists([Artist(artist_id, artist_name)])
+        else:
+            await database.execute(
+                """
+                INSERT INTO artists (artist_id, artist_name)
+                SELECT artist_id, artist_name FROM albums WHERE artist_id = :artist_id LIMIT 1
+                ON CONFLICT (artist_id) DO NOTHING
+                """,
+                {"artist_id": artist_id},
+            )
+        # a refresh is the only place the catalog learns about renamed albums or new covers
+        await album_manager.save_albums(albums, update=True)
+        await database.execute(
+            "DELETE FROM artist_albums WHERE artist_id = :artist_id",
+            {"artist_id": artist_id},
+        )
+        await database.execute(
+            """
+            INSERT INTO artist_albums (artist_id, album_id)
+            SELECT :artist_id, album_id FROM unnest(CAST(:album_ids AS TEXT[])) AS t(album_id)
+            ON CONFLICT (artist_id, album_id) DO NOTHING
+            """,
+            {"artist_id": artist_id, "album_ids": [a.album_id for a in albums]},
+        )
+        await database.execute(
+            "UPDATE artists SET albums_fetched_at = CURRENT_TIMESTAMP WHERE artist_id = :artist_id",
+            {"artist_id": artist_id},
+        )
+
+
+async def search_for_artist_albums(artist_name, defer=None):
+
+    artist_id = await search_for_artist_id(artist_name)
 
     if not artist_id:
-        print(f"Artist not found: {artist_name}")
         return []
 
-    headers = {"Authorization": f"Bearer {token}"}
+    return await get_artist_albums(artist_id, defer=defer)
+
+
+async def get_related_artists(artist_id):
+
+    # returns Artist records in Spotify's order
+    fresh = await database.fetch_one(
+        """
+        SELECT artist_id FROM artists
+        WHERE artist_id = :artist_id
+        AND related_fetched_at >= NOW() - make_interval(days => :max_age)
+        """,
+        {"artist_id": artist_id, "max_age": MIRROR_MAX_AGE_DAYS},
+    )
+
+    record_cache("related_artists", fresh is not None)
+    if fresh:
+        rows = await database.fetch_all(
+            """
+            SELECT a.artist_id, a.artist_name
+            FROM related_artists r
+            JOIN artists a ON a.artist_id = r.related_artist_id
+            WHERE r.artist_id = :artist_id
+            ORDER BY r.position
+            """,
+            {"artist_id": artist_id},
+        )
+        return [Artist(**dict(row)) for row in rows]
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"https://api.spotify.com/v1/artists/{artist_id}/related-artists",
-            headers=headers,
+    return await refresh_related_artists(artist_id)
+
+
+async def refresh_related_artists(artist_id):
+
+    token = await get_spotify_token()
+    related = await fetch_related_artists(token, artist_id)
+
+    async with database.transaction():
+        # the artist itself may only be known through an album row, the related artists need it to exist
+        await database.execute(
+            """
+            INSERT INTO artists (artist_id, artist_name)
+            SELECT artist_id, artist_name FROM albums WHERE artist_id = :artist_id LIMIT 1
+            ON CONFLICT (artist_id) DO NOTHING
+            """,
+            {"artist_id": artist_id},
+        )
+        await save_artists(related)
+        await database.execute(
+            "DELETE FROM related_artists WHERE artist_id = :artist_id",
+            {"artist_id": artist_id},
+        )
+        await database.execute(
+            """
+            INSERT INTO related_artists (artist_id, related_artist_id, position)
+            SELECT :artist_id, related_artist_id, position
+            FROM unnest(CAST(:related_ids AS TEXT[])) WITH ORDINALITY AS t(related_artist_id, position)
+            ON CONFLICT (artist_id, related_artist_id) DO NOTHING
+            """,
+            {"artist_id": artist_id, "related_ids": [a.artist_id for a in related]},
+        )
+        await database.execute(
+            "UPDATE artists SET related_fetched_at = CURRENT_TIMESTAMP WHERE artist_id = :artist_id",
+            {"artist_id": artist_id},
         )
 
-    json_result = response.json()
+    return related
 
-    artists = json_result.get("artists", [])
-    return artists
+
+async def search_related_artists(artist_name):
+
+    artist_id = await search_for_artist_id(artist_name)
+
+    if not artist_id:
+        print(f"Artist not found: {artist_name}")
+        return []
+
+    return await get_related_artists(artist_id)
+
+
+async def refresh_stale_artists(limit=500):
+
+    # used by the catalog refresh DAG: re-fetch the mirrored data that is about to expire, oldest first
+    rows = await database.fetch_all(
+        """
+        SELECT artist_id, albums_fetched_at, related_fetched_at
+        FROM artists
+        WHERE albums_fetched_at < NOW() - make_interval(days => :refresh_age)
+        OR related_fetched_at < NOW() - make_interval(days => :refresh_age)
+        ORDER BY LEAST(albums_fetched_at, related_fetched_at)
+        LIMIT :limit
+        """,
+        {"refresh_age": MIRROR_REFRESH_AGE_DAYS, "limit": limit},
+    )
+
+    # only what was mirrored before is refreshed, an artist nobody asked related artists for stays without them
+    for row in rows:
+        if row["albums_fetched_at"] is not None:
+            await refresh_artist_albums(row["artist_id"])
+        if row["related_fetched_at"] is not None:
+            await refresh_related_artists(row["artist_id"])
+
+    return len(rows)
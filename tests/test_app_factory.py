@@ -0,0 +1,28 @@
+# create_app builds the stateful parts per app, so two apps in one process never share a queue or a background task
+# (no database needed: nothing is started before lifespan runs)
+
+STATE = [
+    "catalog_writer",
+    "profiler",
+    "recommendation_refresher",
+    "loop_watchdog",
+    "trending_cache",
+    "health_monitor",
+    "cover_cache",
+]
+
+
+def test_apps_do_not_share_state():
+
+    from metrics import registry
+    from server import create_app
+
+    first, second = create_app(), create_app()
+
+    for name in STATE:
+        assert getattr(first.state, name) is not getattr(second.state, name), name
+
+    # the gauges follow the app built last
+    second.state.catalog_writer.queue.put_nowait(object())
+    assert registry.gauges["catalog_writer_queue_depth"]() == 1
+    assert first.state.catalog_writer.queue.qsize() == 0
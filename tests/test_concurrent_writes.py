@@ -0,0 +1,132 @@
+import asyncio
+import uuid
+from conftest import cleanup, create_albums, create_users, run_with_database
+
+# the write helpers are single statements (or lock the row they depend on), so the same request arriving many
+# times at once must leave exactly the rows one request would: one review per (user, album), at most 3 favorites,
+# no duplicate follows
+
+PARALLEL = 20
+
+
+def test_parallel_reviews_keep_one_row_per_album(schema):
+
+    async def scenario():
+        from init_db import database
+        from review_manager import ReviewManager
+
+        [user_id] = await create_users(1)
+        [album_id] = await create_albums(1)
+        try:
+            manager = ReviewManager()
+            results = await asyncio.gather(
+                *(manager.add_review(user_id, album_id, n % 5 + 1, f"take {n}") for n in range(PARALLEL))
+            )
+            rows = await database.fetch_all(
+                "SELECT rating, review FROM reviews WHERE user_id = :user_id AND album_id = :album_id",
+                {"user_id": user_id, "album_id": album_id},
+            )
+            return results, rows
+        finally:
+            await cleanup([user_id], [album_id])
+
+    results, rows = run_with_database(scenario)
+
+    assert all(ok for ok, _ in results)
+    assert len(rows) == 1
+    # the surviving row is one of the writes, not a mix of two
+    assert (rows[0]["rating"], rows[0]["review"]) in {(n % 5 + 1, f"take {n}") for n in range(PARALLEL)}
+
+
+def test_parallel_favorites_stop_at_three(schema):
+
+    async def scenario():
+        from init_db import database
+        from user_manager import UserManager
+
+        [user_id] = await create_users(1)
+        album_ids = await create_albums(6)
+        try:
+            manager = UserManager()
+            # every album is added several times over, in parallel
+            results = await asyncio.gather(
+                *(manager.add_favourite(user_id, album_ids[n % len(album_ids)]) for n in range(PARALLEL))
+            )
+            count = await database.fetch_val(
+                "SELECT COUNT(*) FROM favorites WHERE user_id = :user_id", {"user_id": user_id}
+            )
+            distinct = await database.fetch_val(
+                "SELECT COUNT(DISTINCT album_id) FROM favorites WHERE user_id = :user_id", {"user_id": user_id}
+            )
+            return results, count, distinct
+        finally:
+            await cleanup([user_id], album_ids)
+
+    results, count, distinct = run_with_database(scenario)
+
+    assert count == 3
+    assert distinct == 3
+    assert sum(ok for ok, _ in results) == 3
+
+
+def test_parallel_follows_insert_once(schema):
+
+    async def scenario():
+        from init_db import database
+        from user_manager import UserManager
+
+        follower_id, followed_id = await create_users(2)
+        try:
+            manager = UserManager()
+            results = await asyncio.gather(
+                *(manager.follow_user(follower_id, followed_id) for _ in range(PARALLEL))
+            )
+            count = await database.fetch_val(
+                "SELECT COUNT(*) FROM followers WHERE follower_id = :follower_id AND followed_id = :followed_id",
+                {"follower_id": follower_id, "followed_id": followed_id},
+            )
+            return results, count
+        finally:
+            await cleanup([follower_id, followed_id])
+
+    results, count = run_with_database(scenario)
+
+    assert count == 1
+    assert sum(ok for ok, _ in results) == 1
+    assert all(message == "You already follow this user" for ok, message in results if not ok)
+
+
+def test_parallel_case_variant_registrations_create_one_user(schema):
+
+    async def scenario():
+        import httpx
+        from init_db import database
+        from server import app
+
+        username = f"Reg{uuid.uuid4().hex[:10]}"
+        variants = [username.upper(), username.lower(), username] * 3
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                responses = await asyncio.gather(
+                    *(
+                        client.post(
+                            "/register",
+                            json={"username": name, "email": "reg@example.com", "password": "secret"},
+                        )
+                        for name in variants
+                    )
+                )
+            rows = await database.fetch_all(
+                "SELECT id FROM users WHERE LOWER(username) = LOWER(:username)", {"username": username}
+            )
+            return responses, rows
+        finally:
+            await database.execute(
+                "DELETE FROM users WHERE LOWER(username) = LOWER(:username)", {"username": username}
+            )
+
+    responses, rows = run_with_database(scenario)
+
+    assert sorted(r.status_code for r in responses) == [201] + [400] * 8
+    assert all(r.json() == {"detail": "Username already exists"} for r in responses if r.status_code == 400)
+    assert len(rows) == 1
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import uuid
+import pytest
+from conftest import run_with_database
+
+# the cover proxy against the /image route of bench/fake_spotify.py: each cover is downloaded once, also by concurrent
+# requests, served with an ETag that is the hash of its content, answered with 304 when the client has it, and
+# resized to the next configured size
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+
+    # the real fetch_cover, counted
+    import covers
+
+    urls = []
+    fetch_cover = covers.fetch_cover
+
+    async def counted(url):
+        urls.append(url)
+        return await fetch_cover(url)
+
+    monkeypatch.setattr(covers, "fetch_cover", counted)
+    return urls
+
+
+def image_url(fake_spotify):
+
+    return f"{fake_spotify}/image/{uuid.uuid4().hex}"
+
+
+def test_cover_is_downloaded_once(fake_spotify, downloads, tmp_path):
+
+    import httpx
+    from covers import CoverCache
+
+    url = image_url(fake_spotify)
+    content = httpx.get(url).content
+
+    async def scenario():
+        cache = CoverCache(directory=str(tmp_path))
+        first = await cache.get(url)
+        # a new cache over the same directory, as after a restart
+        second = await CoverCache(directory=str(tmp_path)).get(url)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+
+    assert downloads == [url]
+    assert first == second
+    path, etag, media_type = first
+    assert etag == f'"{hashlib.sha256(content).hexdigest()}"'
+    assert media_type == "image/png"
+    with open(path, "rb") as f:
+        assert f.read() == content
+
+
+def test_concurrent_requests_share_one_download(fake_spotify, downloads, tmp_path):
+
+    from covers import CoverCache
+
+    url = image_url(fake_spotify)
+
+    async def scenario():
+        cache = CoverCache(directory=str(tmp_path))
+        return await asyncio.gather(*(cache.get(url) for _ in range(10)))
+
+    results = asyncio.run(scenario())
+
+    assert downloads == [url]
+    assert len(set(results)) == 1
+
+
+def test_sizes_snap_to_the_configured_ones(fake_spotify, tmp_path):
+
+    pytest.importorskip("PIL")
+    from PIL import Image
+    from covers import CoverCache
+
+    url = image_url(fake_spotify)
+
+    async def scenario():
+        cache = CoverCache(directory=str(tmp_path), sizes=(64, 300), workers=1)
+        try:
+            return await asyncio.gather(cache.get(url, 100), cache.get(url, 300), cache.get(url, 20))
+        finally:
+            await cache.stop()
+
+    (at_100, etag_100, type_100), (at_300, etag_300, _), (at_20, etag_20, _) = asyncio.run(scenario())
+
+    assert at_100 == at_300 and etag_100 == etag_300
+    assert etag_100.endswith('-300"') and etag_20.endswith('-64"')
+    assert type_100 == "image/jpeg"
+    with Image.open(at_100) as image:
+        assert max(image.size) == 300
+    with Image.open(at_20) as image:
+        assert max(image.size) == 64
+
+
+def test_oversized_cover_is_refused(fake_spotify, monkeypatch, tmp_path):
+
+    import covers
+
+    monkeypatch.setattr(covers, "COVER_MAX_BYTES", 1024)
+    url = image_url(fake_spotify)
+
+    with pytest.raises(ValueError):
+        asyncio.run(covers.CoverCache(directory=str(tmp_path)).get(url))
+    assert not any(path.is_file() for path in tmp_path.rglob("*"))
+
+
+def test_cover_route_answers_304_for_a_known_etag(schema, fake_spotify, tmp_path):
+
+    from covers import CoverCache
+
+    album_id = uuid.uuid4().hex
+    url = image_url(fake_spotify)
+
+    async def scenario():
+        import httpx
+        from init_db import database
+        from server import create_app
+
+        app = create_app()
+        app.state.cover_cache = CoverCache(directory=str(tmp_path))
+        await database.execute(
+            """
+            INSERT INTO albums (album_id, album_name, artist_name, artist_id, release_date, cover)
+            VALUES (:album_id, 'Album', 'Artist', 'artist', DATE '2020-01-01', :cover)
+            """,
+            {"album_id": album_id, "cover": url},
+        )
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                full = await client.get(f"/album/{album_id}/cover")
+                cached = await client.get(f"/album/{album_id}/cover", headers={"If-None-Match": full.headers["etag"]})
+                other = await client.get(f"/album/{album_id}/cover", headers={"If-None-Match": '"something else"'})
+            return full, cached, other
+        finally:
+            await database.execute("DELETE FROM albums WHERE album_id = :album_id", {"album_id": album_id})
+
+    full, cached, other = run_with_database(scenario)
+
+    assert full.status_code == 200
+    assert full.headers["etag"] == f'"{hashlib.sha256(full.content).hexdigest()}"'
+    assert "immutable" in full.headers["cache-control"]
+    assert cached.status_code == 304 and cached.content == b""
+    assert other.status_code == 200
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import pytest
+from bench.importtime import ROOT, TARGETS, measure
+
+# cold start: a new API worker and the Airflow scheduler parsing a DAG file only pay for what they use; the heavy
+# dependencies are imported on first use, and the DAG files import the database and Spotify stack inside their tasks
+
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+
+LAZY_IN_SERVER = ("passlib", "jose", "httpx", "requests", "redis", "PIL")
+LAZY_IN_DAGS = ("databases", "init_db", "spotify", "user_manager", "recommendation_runner", "httpx")
+
+
+def imported_modules(code, candidates):
+
+    result = subprocess.run(
+        [sys.executable, "-c", f"{code}; import sys; print(' '.join(sys.modules))"],
+        cwd=ROOT,
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+
+    loaded = set(result.stdout.split())
+    return sorted(name for name in candidates if name in loaded)
+
+
+def test_server_defers_heavy_imports():
+
+    assert imported_modules(TARGETS["server"], LAZY_IN_SERVER) == []
+
+
+@pytest.mark.parametrize("target", [target for target in TARGETS if target.startswith("dags/")])
+def test_dag_files_do_not_import_the_stack(target):
+
+    pytest.importorskip("airflow")
+
+    assert imported_modules(TARGETS[target], LAZY_IN_DAGS) == []
+
+
+def test_server_import_time_within_budget():
+
+    # best of three fresh interpreters, like bench/importtime.py; IMPORT_TIME_BUDGET_MS adjusts it for slow machines
+    total, modules = min((measure(TARGETS["server"]) for _ in range(3)), key=lambda run: run[0])
+
+    slowest = sorted(modules.items(), key=lambda item: -item[1])[:5]
+    assert total / 1000 <= IMPORT_TIME_BUDGET_MS, slowest
@@ -0,0 +1,105 @@
+import re
+
+import pytest
+from conftest import run_with_database
+from review_manager import FRIENDS_ACTIVITY_QUERY, USER_REVIEWS_QUERY
+from user_manager import COLLABORATIVE_CANDIDATES_QUERY, FOLLOWERS_QUERY
+
+# the hot queries the handlers run, EXPLAINed on a seeded, analyzed data set with the planner left to its own costs:
+# a user's slice of reviews or follows is a fraction of a percent of the table, so only an index makes sense, and a
+# "Seq Scan" on reviews or followers means the matching index is missing or unusable
+
+USERS = 5000
+ALBUMS = 2000
+REVIEWS_PER_USER = 20
+FOLLOWS_PER_USER = 10
+
+SEED = [
+    "DELETE FROM users WHERE username LIKE 'index\\_seed\\_%'",
+    "DELETE FROM albums WHERE album_id LIKE 'index\\_seed\\_%'",
+    f"""
+    INSERT INTO users (username, password_hash)
+    SELECT 'index_seed_' || n, 'not a hash' FROM generate_series(0, {USERS - 1}) AS n
+    """,
+    f"""
+    INSERT INTO albums (album_id, album_name, artist_name, artist_id, release_date, cover)
+    SELECT 'index_seed_' || n, 'Album ' || n, 'Artist ' || n % 300, 'index_seed_artist_' || n % 300,
+        DATE '2000-01-01' + n, ''
+    FROM generate_series(0, {ALBUMS - 1}) AS n
+    """,
+    # every user reviews REVIEWS_PER_USER distinct albums over the last 60 days and follows FOLLOWS_PER_USER users
+    f"""
+    WITH seed AS (
+        SELECT id, CAST(substr(username, 12) AS INTEGER) AS n FROM users WHERE username LIKE 'index\\_seed\\_%'
+    )
+    INSERT INTO reviews (user_id, album_id, rating, review, created_at)
+    SELECT seed.id, 'index_seed_' || (seed.n * 7 + k * 13) % {ALBUMS}, 1 + (seed.n + k) % 5, '',
+        NOW() - make_interval(days => (seed.n + k) % 60)
+    FROM seed CROSS JOIN generate_series(1, {REVIEWS_PER_USER}) AS k
+    """,
+    f"""
+    WITH seed AS (
+        SELECT id, CAST(substr(username, 12) AS INTEGER) AS n FROM users WHERE username LIKE 'index\\_seed\\_%'
+    )
+    INSERT INTO followers (follower_id, followed_id)
+    SELECT follower.id, followed.id
+    FROM seed follower
+    CROSS JOIN generate_series(1, {FOLLOWS_PER_USER}) AS k
+    JOIN seed followed ON followed.n = (follower.n + k * 37) % {USERS}
+    """,
+    "ANALYZE users",
+    "ANALYZE albums",
+    "ANALYZE reviews",
+    "ANALYZE followers",
+]
+
+
+@pytest.fixture(scope="module")
+def seeded_user(schema):
+
+    async def seed():
+        from init_db import database
+
+        for statement in SEED:
+            await database.execute(statement)
+        return await database.fetch_val("SELECT id FROM users WHERE username = 'index_seed_42'")
+
+    async def cleanup():
+        from init_db import database
+
+        await database.execute(SEED[0])
+        await database.execute(SEED[1])
+
+    yield run_with_database(seed)
+    run_with_database(cleanup)
+
+
+async def explain(query, params):
+
+    from init_db import database
+
+    rows = await database.fetch_all(f"EXPLAIN {query}", params)
+    return "\n".join(row[0] for row in rows)
+
+
+@pytest.mark.parametrize(
+    "query, params, index",
+    [
+        (FRIENDS_ACTIVITY_QUERY, {}, "followers_follower_id_followed_id_key"),
+        (USER_REVIEWS_QUERY, {"limit": 20}, "reviews_user_recent_idx"),
+        (FOLLOWERS_QUERY, {"after": 0, "limit": 51}, "followers_followed_id_idx"),
+        (COLLABORATIVE_CANDIDATES_QUERY, {"album_ids": None}, "reviews_positive_idx"),
+    ],
+    ids=["friends_activity", "user_reviews", "followers", "positive_reviews_join"],
+)
+def test_hot_queries_use_an_index(seeded_user, query, params, index):
+
+    params = dict(params, user_id=seeded_user, viewer_id=seeded_user, user_ids=[seeded_user])
+    # only the parameters the query uses are passed, the driver rejects unknown ones
+    params = {name: value for name, value in params.items() if re.search(rf":{name}\b", query)}
+
+    plan = run_with_database(explain, query, params)
+
+    assert "Seq Scan on reviews" not in plan, plan
+    assert "Seq Scan on followers" not in plan, plan
+    assert index in plan, plan
@@ -0,0 +1,199 @@
+import contextvars
+import types
+import uuid
+import pytest
+from starlette.requests import Request
+from starlette.responses import Response
+import auth
+import init_db
+from auth import LAST_WRITE_HEADER, sign_last_write, track_writes
+from conftest import TEST_DATABASE_URL, cleanup, create_albums, create_users, run_with_database
+from init_db import REPLICA_STICKY_SECONDS, ReadDatabase
+from metrics import InstrumentedDatabase
+
+# read-your-writes: a write request answers with a signed marker of when it happened, and for REPLICA_STICKY_SECONDS
+# every request that sends it back reads from the primary, whichever worker or instance serves it; everybody else
+# keeps reading from the replica; every request runs in its own context, as under the ASGI server
+
+PRIMARY = "primary"
+REPLICA = "replica"
+
+
+@pytest.fixture
+def keys(monkeypatch):
+
+    monkeypatch.setattr(auth, "JWT_KEYS", {"2025-10": "current-secret"})
+    monkeypatch.setattr(auth, "JWT_ACTIVE_KID", "2025-10")
+
+
+@pytest.fixture
+def clock(monkeypatch, keys):
+
+    now = [1_700_000_000.0]
+    fake_time = types.SimpleNamespace(time=lambda: now[0])
+    monkeypatch.setattr(init_db, "time", fake_time)
+    monkeypatch.setattr(auth, "time", fake_time)
+    return now
+
+
+def request(user_id, method="GET", marker=None, reader=None):
+
+    # returns (where the reads of the request go, the marker its response carries)
+    reader = reader or ReadDatabase(PRIMARY, REPLICA)
+    headers = [(LAST_WRITE_HEADER.lower().encode(), marker.encode())] if marker else []
+    response = Response()
+
+    def handle():
+        track_writes(Request({"type": "http", "method": method, "headers": headers}), response, user_id)
+        return reader._target()
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(auth, "reader", reader)
+        target = contextvars.copy_context().run(handle)
+
+    return target, response.headers.get(LAST_WRITE_HEADER)
+
+
+def test_reads_go_to_the_replica_without_a_recent_write(clock):
+
+    assert request(1) == (REPLICA, None)
+
+
+def test_write_request_reads_from_the_primary_and_marks_the_client(clock):
+
+    target, marker = request(1, method="POST")
+
+    assert target == PRIMARY
+    assert marker == sign_last_write(1, clock[0])
+
+
+def test_reads_stick_to_the_primary_inside_the_window(clock):
+
+    _, marker = request(1, method="POST")
+    clock[0] += REPLICA_STICKY_SECONDS - 0.5
+
+    assert request(1, marker=marker)[0] == PRIMARY
+    # a client that did not write, or does not send the marker back, reads from the replica
+    assert request(2)[0] == REPLICA
+    assert request(1)[0] == REPLICA
+
+
+def test_reads_return_to_the_replica_after_the_window(clock):
+
+    _, marker = request(1, method="POST")
+    clock[0] += REPLICA_STICKY_SECONDS + 0.5
+
+    assert request(1, marker=marker)[0] == REPLICA
+
+
+def test_forged_or_foreign_markers_are_ignored(clock):
+
+    _, marker = request(1, method="POST")
+    user_id, at, signature = marker.split(":")
+
+    assert request(2, marker=marker)[0] == REPLICA
+    assert request(1, marker=f"{user_id}:{float(at) + 5:.3f}:{signature}")[0] == REPLICA
+    assert request(1, marker="1:not-a-time:0")[0] == REPLICA
+
+
+def test_reads_skip_an_unhealthy_replica(clock):
+
+    reader = ReadDatabase(PRIMARY, REPLICA)
+    reader.replica_healthy = False
+
+    assert request(1, reader=reader)[0] == PRIMARY
+
+
+def test_every_read_goes_to_the_primary_without_a_replica(clock):
+
+    assert request(1, reader=ReadDatabase(PRIMARY)) == (PRIMARY, None)
+
+
+class RecordingReplica(InstrumentedDatabase):
+
+    # a second pool on the test database standing in for the replica, remembering how many queries it served
+    queries = 0
+
+    async def _timed(self, method, *args, **kwargs):
+        self.queries += 1
+        return await super()._timed(method, *args, **kwargs)
+
+
+def test_write_on_one_instance_pins_reads_on_another(schema, keys, monkeypatch):
+
+    # two apps stand for two instances behind a load balancer: the client writes through one and reads through the
+    # other, with get_current_user deciding where /user/profile reads from
+    from databases import Database
+
+    replica = RecordingReplica(Database(TEST_DATABASE_URL, min_size=1, max_size=2))
+    monkeypatch.setattr(init_db.reader, "replica", replica)
+
+    async def scenario():
+        import httpx
+        from server import create_app
+
+        [user_id] = await create_users(1)
+        [album_id] = await create_albums(1)
+        await replica.connect()
+        try:
+            headers = {"Authorization": f"Bearer {auth.create_access_token(user_id, 'reader')}"}
+            first, second = (
+                httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app()), base_url="http://test")
+                for _ in range(2)
+            )
+            async with first, second:
+                served = []
+
+                async def profile(client, **extra):
+                    before = replica.queries
+                    response = await client.get("/user/profile", headers={**headers, **extra})
+                    assert response.status_code == 200
+                    served.append("replica" if replica.queries > before else "primary")
+
+                await profile(second)
+                written = await first.post(
+                    f"/album/{album_id}/rating", json={"rating": 2, "review": "fine"}, headers=headers
+                )
+                marker = written.headers[LAST_WRITE_HEADER]
+                await profile(second, **{LAST_WRITE_HEADER: marker})
+                await profile(second, cookie=f"{auth.LAST_WRITE_COOKIE}={written.cookies[auth.LAST_WRITE_COOKIE]}")
+                await profile(second)
+                monkeypatch.setattr(init_db, "REPLICA_STICKY_SECONDS", 0)
+                await profile(second, **{LAST_WRITE_HEADER: marker})
+            return written.status_code, served
+        finally:
+            await replica.disconnect()
+            await cleanup([user_id], [album_id])
+
+    status_code, served = run_with_database(scenario)
+
+    assert status_code == 200
+    assert served == ["replica", "primary", "primary", "replica", "replica"]
+
+
+def test_health_monitor_takes_a_failing_replica_out_of_reads(schema, monkeypatch):
+
+    from databases import Database
+    from health import HealthMonitor
+
+    working = InstrumentedDatabase(Database(TEST_DATABASE_URL, min_size=1, max_size=1))
+    # never connected, and nothing listens on port 9 anyway: every query on this pool fails
+    broken = InstrumentedDatabase(Database("postgresql+asyncpg://localhost:9/missing", min_size=1, max_size=1))
+
+    async def scenario():
+        monitor = HealthMonitor()
+        results = []
+        await working.connect()
+        try:
+            for replica in (working, broken, working):
+                monkeypatch.setattr(init_db.reader, "replica", replica)
+                await monitor.probe()
+                ready, details = monitor.readiness(True)
+                results.append((init_db.reader.replica_healthy, ready, details["replica"]["in_use"]))
+        finally:
+            await working.disconnect()
+            init_db.reader.replica_healthy = True
+        return results
+
+    # the worker stays ready either way, the primary serves the reads while the replica is out
+    assert run_with_database(scenario) == [(True, True, True), (False, True, False), (True, True, True)]
@@ -0,0 +1,150 @@
+import uuid
+from conftest import cleanup, create_albums, create_users, run_with_database
+
+# the generation lifecycle of recommendation_runner.py: a full run writes into a generation of its own that readers do
+# not see until activate(), which retires the generations before it and detaches and drops their partitions; a run
+# activated after a newer one is out of date and retired itself; writes without a generation (on-demand refreshes,
+# partial runs) go into the active generation and the one being built, so they survive the swap
+
+
+async def visible(user_id):
+
+    # what /user/get_recommendations reads: the user's rows in the active generation
+    from init_db import database
+
+    rows = await database.fetch_all(
+        """
+        SELECT album_id FROM recommendations
+        WHERE user_id = :user_id
+        AND generation = (SELECT generation FROM recommendation_generations WHERE status = 'active')
+        """,
+        {"user_id": user_id},
+    )
+    return {row["album_id"] for row in rows}
+
+
+async def generation_state(generation):
+
+    # (status, dropped, partition still attached)
+    from init_db import database
+
+    row = await database.fetch_one(
+        """
+        SELECT g.status, g.dropped_at IS NOT NULL AS dropped,
+            EXISTS (
+                SELECT 1 FROM pg_inherits
+                WHERE inhrelid = to_regclass('recommendations_g' || g.generation)
+            ) AS attached
+        FROM recommendation_generations g WHERE g.generation = :generation
+        """,
+        {"generation": generation},
+    )
+    return row["status"], row["dropped"], row["attached"]
+
+
+def run_id(name):
+
+    return f"test-{name}-{uuid.uuid4().hex[:8]}"
+
+
+def scenario(test):
+
+    # runs test(runner, user_id, album_ids) with a user and three albums that are removed afterwards
+    async def run():
+        from recommendation_runner import RecommendationRunner
+
+        [user_id] = await create_users(1)
+        album_ids = await create_albums(3)
+        try:
+            return await test(RecommendationRunner(), user_id, album_ids)
+        finally:
+            await cleanup([user_id], album_ids)
+
+    return run_with_database(run)
+
+
+def test_building_generation_is_invisible_until_activated(schema):
+
+    async def test(runner, user_id, album_ids):
+        run = run_id("invisible")
+        generation = await runner.begin_generation(run)
+        await runner.user_manager.save_recommendations([(user_id, album_ids[0])], generation=generation)
+
+        before = await visible(user_id)
+        await runner.activate(run)
+        return before, await visible(user_id), await generation_state(generation)
+
+    before, after, state = scenario(test)
+
+    assert before == set()
+    assert len(after) == 1
+    assert state == ("active", False, True)
+
+
+def test_activation_retires_and_detaches_the_old_generation(schema):
+
+    async def test(runner, user_id, album_ids):
+        old_run, new_run = run_id("old"), run_id("new")
+        old = await runner.begin_generation(old_run)
+        await runner.user_manager.save_recommendations([(user_id, album_ids[0])], generation=old)
+        await runner.activate(old_run)
+
+        new = await runner.begin_generation(new_run)
+        await runner.user_manager.save_recommendations([(user_id, album_ids[1])], generation=new)
+        # the old generation is still the one users see while the new one is built
+        during = await visible(user_id)
+        dropped = await runner.activate(new_run)
+        return during, dropped, await visible(user_id), await generation_state(old), await generation_state(new)
+
+    during, dropped, after, old, new = scenario(test)
+
+    assert len(during) == 1 and len(after) == 1 and during != after
+    assert dropped >= 1
+    assert old == ("retired", True, False)
+    assert new == ("active", False, True)
+
+
+def test_stale_run_activated_late_is_retired(schema):
+
+    async def test(runner, user_id, album_ids):
+        stale_run, newer_run = run_id("stale"), run_id("newer")
+        stale = await runner.begin_generation(stale_run)
+        newer = await runner.begin_generation(newer_run)
+        await runner.user_manager.save_recommendations([(user_id, album_ids[0])], generation=stale)
+        await runner.user_manager.save_recommendations([(user_id, album_ids[1])], generation=newer)
+
+        await runner.activate(newer_run)
+        await runner.activate(stale_run)
+        return album_ids[1], await visible(user_id), await generation_state(stale), await generation_state(newer)
+
+    newer_album, after, stale, newer = scenario(test)
+
+    assert after == {newer_album}
+    assert stale == ("retired", True, False)
+    assert newer == ("active", False, True)
+
+
+def test_refreshes_write_into_the_active_and_the_building_generation(schema):
+
+    async def test(runner, user_id, album_ids):
+        active_run, building_run = run_id("active"), run_id("building")
+        await runner.begin_generation(active_run)
+        await runner.activate(active_run)
+        await runner.begin_generation(building_run)
+
+        # an on-demand refresh: no generation given
+        pairs = [(user_id, album_id) for album_id in album_ids[:2]]
+        created = await runner.user_manager.save_recommendations(pairs)
+        again = await runner.user_manager.save_recommendations(pairs)
+
+        before_swap = await visible(user_id)
+        await runner.activate(building_run)
+        return created, again, before_swap, await visible(user_id)
+
+    created, again, before_swap, after_swap = scenario(test)
+
+    # each pair is counted once although it was written into two generations
+    assert created == 2
+    assert again == 0
+    assert len(before_swap) == 2
+    assert after_swap == before_swap
@@ -0,0 +1,107 @@
+import uuid
+from conftest import run_with_database
+
+# the read-through mirror in spotify.py, against bench/fake_spotify.py: a search query is remembered even when it is
+# not Spotify's canonical name, a refresh overwrites stale album rows, and a search can hand the mirror write back to
+# the caller instead of running it before it returns
+
+
+async def delete_artist(artist_id):
+
+    from init_db import database
+
+    await database.execute("DELETE FROM albums WHERE artist_id = :artist_id", {"artist_id": artist_id})
+    await database.execute("DELETE FROM artists WHERE artist_id = :artist_id", {"artist_id": artist_id})
+
+
+def test_search_query_is_remembered(schema, spotify_api, monkeypatch):
+
+    import spotify
+
+    query = f"Mirror Query {uuid.uuid4().hex[:8]}"
+
+    async def scenario():
+
+        from init_db import database
+
+        artist_id = await spotify.search_for_artist_id(query)
+        try:
+            # the fake's artist is called "Artist <id>", so only the stored query can answer the second lookup;
+            # Spotify is unreachable from here on
+            monkeypatch.setattr(spotify, "SPOTIFY_API_URL", "http://127.0.0.1:9/v1")
+            monkeypatch.setattr(spotify, "_token", None)
+            name = await database.fetch_val(
+                "SELECT artist_name FROM artists WHERE artist_id = :artist_id", {"artist_id": artist_id}
+            )
+            return artist_id, name, await spotify.search_for_artist_id(query.upper())
+        finally:
+            await delete_artist(artist_id)
+
+    artist_id, name, again = run_with_database(scenario)
+
+    assert name.lower() != query.lower()
+    assert again == artist_id
+
+
+def test_refresh_overwrites_stale_albums(schema, spotify_api):
+
+    import spotify
+
+    query = f"Refresh Query {uuid.uuid4().hex[:8]}"
+
+    async def scenario():
+
+        from init_db import database
+
+        artist_id = await spotify.search_for_artist_id(query)
+        try:
+            albums = await spotify.refresh_artist_albums(artist_id)
+            await database.execute(
+                "UPDATE albums SET album_name = 'stale', cover = '' WHERE artist_id = :artist_id",
+                {"artist_id": artist_id},
+            )
+            await spotify.refresh_artist_albums(artist_id)
+            rows = await database.fetch_all(
+                "SELECT album_id, album_name, cover FROM albums WHERE artist_id = :artist_id",
+                {"artist_id": artist_id},
+            )
+            return albums, rows
+        finally:
+            await delete_artist(artist_id)
+
+    albums, rows = run_with_database(scenario)
+
+    assert albums
+    assert {(row["album_id"], row["album_name"], row["cover"]) for row in rows} == {
+        (album.album_id, album.album_name, album.cover) for album in albums
+    }
+
+
+def test_search_defers_the_mirror_write(schema, spotify_api):
+
+    import spotify
+
+    query = f"Deferred Query {uuid.uuid4().hex[:8]}"
+
+    async def scenario():
+
+        from init_db import database
+
+        deferred = []
+        albums = await spotify.search_for_artist_albums(query, defer=lambda fn, *args: deferred.append((fn, args)))
+        artist_id = albums[0].artist_id
+        try:
+            count = "SELECT COUNT(*) FROM artist_albums WHERE artist_id = :artist_id"
+            before = await database.fetch_val(count, {"artist_id": artist_id})
+            for fn, args in deferred:
+                await fn(*args)
+            after = await database.fetch_val(count, {"artist_id": artist_id})
+            return albums, len(deferred), before, after
+        finally:
+            await delete_artist(artist_id)
+
+    albums, deferred, before, after = run_with_database(scenario)
+
+    assert deferred == 1
+    assert before == 0
+    assert after == len(albums)
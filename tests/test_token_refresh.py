@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+from conftest import cleanup, create_users, run_with_database
+
+# /token/refresh accepts a refresh token once: the response carries a new one, the old one is refused from then on,
+# also when the same token is presented twice at the same time
+
+
+@pytest.fixture
+def keys(monkeypatch):
+
+    import auth
+
+    monkeypatch.setattr(auth, "SECRET_KEY", "legacy-secret")
+    monkeypatch.setattr(auth, "JWT_KEYS", {"2025-10": "current-secret"})
+    monkeypatch.setattr(auth, "JWT_ACTIVE_KID", "2025-10")
+
+
+async def post_refresh(client, *tokens):
+
+    return await asyncio.gather(*(client.post("/token/refresh", json={"refresh_token": t}) for t in tokens))
+
+
+def test_refresh_token_is_accepted_once(schema, keys):
+
+    async def scenario():
+        import httpx
+        from auth import create_refresh_token
+        from server import app
+
+        [user_id] = await create_users(1)
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                token = create_refresh_token(user_id)
+                [first] = await post_refresh(client, token)
+                [again] = await post_refresh(client, token)
+                [rotated] = await post_refresh(client, first.json()["refresh_token"])
+                # the same token twice at once: exactly one of them wins
+                racing = await post_refresh(client, *[create_refresh_token(user_id)] * 2)
+            return first, again, rotated, racing
+        finally:
+            await cleanup([user_id])
+
+    first, again, rotated, racing = run_with_database(scenario)
+
+    assert first.status_code == 200
+    assert again.status_code == 401
+    assert rotated.status_code == 200
+    assert sorted(r.status_code for r in racing) == [200, 401]
+
+
+def test_tokens_without_kid_use_secret_key(keys):
+
+    from jose import JWTError, jwt
+    from auth import decode_token
+
+    legacy = jwt.encode({"sub": "1", "type": "access"}, "legacy-secret", algorithm="HS256")
+    assert decode_token(legacy)["sub"] == "1"
+
+    forged = jwt.encode({"sub": "1", "type": "access"}, "current-secret", algorithm="HS256")
+    with pytest.raises(JWTError):
+        decode_token(forged)
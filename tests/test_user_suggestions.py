@@ -0,0 +1,35 @@
+from conftest import cleanup, create_albums, create_users, run_with_database
+
+# the suggestion score mixes integer counts with float weights; the weights are bound as parameters, so the query has
+# to cast them, otherwise Postgres types them from the integer side and SHARED_ALBUM_WEIGHT = 0.5 becomes 0
+
+
+def test_shared_albums_alone_give_a_score(schema):
+
+    async def scenario():
+        from init_db import database
+        from user_manager import UserManager
+
+        user_id, other_id = await create_users(2)
+        album_ids = await create_albums(3)
+        try:
+            # both liked the same three albums, neither follows anyone
+            await database.execute(
+                """
+                INSERT INTO reviews (user_id, album_id, rating, review)
+                SELECT user_id, album_id, 4, ''
+                FROM unnest(CAST(:user_ids AS INTEGER[])) AS u(user_id)
+                CROSS JOIN unnest(CAST(:album_ids AS TEXT[])) AS a(album_id)
+                """,
+                {"user_ids": [user_id, other_id], "album_ids": album_ids},
+            )
+            return other_id, await UserManager().user_suggestion_candidates([user_id])
+        finally:
+            await cleanup([user_id, other_id], album_ids)
+
+    other_id, candidates = run_with_database(scenario)
+
+    [candidate] = [c for c in candidates if c["suggested_id"] == other_id]
+    assert candidate["mutual_count"] == 0
+    assert candidate["shared_albums"] == 3
+    assert candidate["score"] > 0
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+from typing import NamedTuple
+from dotenv import load_dotenv
+from init_db import database, reader
+
+load_dotenv()
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "48"))
+TRENDING_WINDOW_DAYS = int(os.getenv("TRENDING_WINDOW_DAYS", "14"))  # older reviews have decayed to almost nothing
+TRENDING_SIZE = int(os.getenv("TRENDING_SIZE", "100"))
+TRENDING_CACHE_SECONDS = float(os.getenv("TRENDING_CACHE_SECONDS", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+async def recompute_trending():
+
+    # every review counts exp(-ln 2 * age / half life), so a review loses half its weight every half life;
+    # the decayed volume is scaled by the album's average rating in the window
+    # only the window is read (reviews_recent_idx), and the ranking is swapped in one transaction,
+    # so readers see either the old or the new list
+    async with database.transaction():
+        await database.execute("DELETE FROM trending_albums")
+        await database.execute(
+            """
+            INSERT INTO trending_albums (position, album_id, score, review_count, avg_rating)
+            SELECT ROW_NUMBER() OVER (ORDER BY score DESC, album_id), album_id, score, review_count, avg_rating
+            FROM (
+                SELECT
+                    album_id,
+                    SUM(EXP(-LN(2) * EXTRACT(EPOCH FROM NOW() - COALESCE(updated_at, created_at)) / 3600 / :half_life))
+                        * AVG(rating) / 5 AS score,
+                    COUNT(*) AS review_count,
+                    AVG(rating) AS avg_rating
+                FROM reviews
+                WHERE COALESCE(updated_at, created_at) >= NOW() - make_interval(days => :window_days)
+                GROUP BY album_id
+                ORDER BY score DESC, album_id
+                LIMIT :size
+            ) ranked
+            """,
+            {
+                "half_life": TRENDING_HALF_LIFE_HOURS,
+                "window_days": TRENDING_WINDOW_DAYS,
+                "size": TRENDING_SIZE,
+            },
+        )
+
+
+class TrendingAlbum(NamedTuple):
+
+    # compact cache entry, the same fields as TrendingAlbumOut
+    position: int
+    album_id: str
+    album_name: str
+    artist_name: str
+    artist_id: str
+    release_date: str
+    cover: str
+    score: float
+    review_count: int
+    avg_rating: float
+
+
+class TrendingCache:
+
+    # the ranked list is small, so every worker keeps it in memory and re-reads it in the background;
+    # a request only slices the list, whatever the review volume
+
+    def __init__(self, refresh_seconds=TRENDING_CACHE_SECONDS):
+
+        self.refresh_seconds = refresh_seconds
+        self.albums = []
+        self.loaded_at = None
+        self._task = None
+
+    async def refresh(self):
+
+        rows = await reader.fetch_all(
+            """
+            SELECT t.position, a.album_id, a.album_name, a.artist_name, a.artist_id, a.release_date, a.cover,
+                t.score, t.review_count, t.avg_rating
+            FROM trending_albums t
+            JOIN albums a ON a.album_id = t.album_id
+            ORDER BY t.position
+            """
+        )
+        self.albums = [
+            TrendingAlbum(**(dict(row) | {"release_date": str(row["release_date"])})) for row in rows
+        ]
+        self.loaded_at = asyncio.get_running_loop().time()
+
+    def start(self):
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+
+        # when the list was already loaded (during startup warm-up), the first reload waits a full period
+        if self.loaded_at is not None:
+            await asyncio.sleep(self.refresh_seconds)
+
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                # keep serving the last list we have
+                logger.exception("could not refresh the trending albums")
+            await asyncio.sleep(self.refresh_seconds)
+
+    def get(self, limit):
+
+        return [album._asdict() for album in self.albums[:limit]]
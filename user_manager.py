@@ -1,10 +1,66 @@
-from spotify import (
-    get_spotify_token,
-    search_for_album_by_id,
-    search_for_artist_albums,
-    search_related_artists,
-)
-from init_db import database
+from spotify import get_artist_albums, get_related_artists
+from init_db import database, reader
+from metrics import measured
+
+# weights of the "people you may know" score: every mutual follow and every album both users liked adds to it
+MUTUAL_FOLLOW_WEIGHT = 1.0
+SHARED_ALBUM_WEIGHT = 0.5
+SUGGESTIONS_PER_USER = 50
+
+# the hot read queries are module constants, so tests/test_indexes.py can EXPLAIN exactly what the handlers run
+
+# a page of a user's followers / followed users, keyset paginated on user id; LIMIT NULL means no limit
+FOLLOWERS_QUERY = """
+    SELECT u.id as id, u.username as username,
+        EXISTS (
+            SELECT 1 FROM followers mine WHERE mine.follower_id = :viewer_id AND mine.followed_id = u.id
+        ) AS you_follow,
+        EXISTS (
+            SELECT 1 FROM followers theirs WHERE theirs.follower_id = u.id AND theirs.followed_id = :viewer_id
+        ) AS follows_you
+    FROM followers f
+    JOIN users u
+    ON f.follower_id = u.id
+    WHERE f.followed_id = :user_id AND f.follower_id > :after
+    ORDER BY f.follower_id
+    LIMIT :limit
+"""
+
+FOLLOWING_QUERY = """
+    SELECT u.id as id, u.username as username,
+        EXISTS (
+            SELECT 1 FROM followers mine WHERE mine.follower_id = :viewer_id AND mine.followed_id = u.id
+        ) AS you_follow,
+        EXISTS (
+            SELECT 1 FROM followers theirs WHERE theirs.follower_id = u.id AND theirs.followed_id = :viewer_id
+        ) AS follows_you
+    FROM followers f
+    JOIN users u
+    ON f.followed_id = u.id
+    WHERE f.follower_id = :user_id AND f.followed_id > :after
+    ORDER BY f.followed_id
+    LIMIT :limit
+"""
+
+# albums liked by users who liked the same albums, in one set-based query instead of a query per review
+COLLABORATIVE_CANDIDATES_QUERY = """
+    SELECT DISTINCT mine.user_id, theirs.album_id
+    FROM reviews mine
+    JOIN reviews peer
+        ON peer.album_id = mine.album_id AND peer.user_id <> mine.user_id AND peer.rating >= 3
+    JOIN reviews theirs
+        ON theirs.user_id = peer.user_id AND theirs.rating >= 3
+    WHERE mine.rating >= 3
+    AND (CAST(:user_ids AS INTEGER[]) IS NULL OR mine.user_id = ANY(CAST(:user_ids AS INTEGER[])))
+    AND (CAST(:album_ids AS TEXT[]) IS NULL OR mine.album_id = ANY(CAST(:album_ids AS TEXT[])))
+    AND NOT EXISTS (
+        SELECT 1 FROM reviews own
+        WHERE own.user_id = mine.user_id AND own.album_id = theirs.album_id
+        -- redundant with the correlation, but lets the planner build the anti-join from the requested users' own
+        -- reviews instead of hashing the whole table
+        AND (CAST(:user_ids AS INTEGER[]) IS NULL OR own.user_id = ANY(CAST(:user_ids AS INTEGER[])))
+    )
+"""
 
 
 class UserManager:
@@ -12,32 +68,47 @@ class UserManager:
     # FAVORITES FUNCTIONS
     async def add_favourite(self, user_id, album_id):
 
-        row = await database.fetch_one(
-            "SELECT COUNT(*) as count FROM favorites WHERE user_id = :user_id",
-            {"user_id": int(user_id)},
-        )
-
-        if row["count"] == 3:
+        # the cap check, the duplicate check and the insert run as one statement; locking the user row first
+        # serializes concurrent adds for the same user, so two requests cannot both see 2 favorites and insert
+        async with database.transaction():
 
-            return False, "You can have only 3 favorites"
-
-        else:
-            albums = await database.fetch_all(
-                "SELECT album_id FROM favorites WHERE user_id = :user_id",
+            await database.execute(
+                "SELECT id FROM users WHERE id = :user_id FOR UPDATE",
                 {"user_id": int(user_id)},
             )
-            for album in albums:
-                if album_id == album["album_id"]:
-                    return False, "Already added to favorites"
-            await database.execute(
-                "INSERT INTO favorites (user_id, album_id) VALUES (:user_id, :album_id)",
+
+            row = await database.fetch_one(
+                """
+                WITH current AS (
+                    SELECT COUNT(*) AS count, COALESCE(BOOL_OR(album_id = :album_id), FALSE) AS already_added
+                    FROM favorites
+                    WHERE user_id = :user_id
+                ),
+                inserted AS (
+                    INSERT INTO favorites (user_id, album_id)
+                    SELECT :user_id, :album_id
+                    FROM current
+                    WHERE current.count < 3 AND NOT current.already_added
+                    ON CONFLICT (user_id, album_id) DO NOTHING
+                    RETURNING id
+                )
+                SELECT current.already_added, EXISTS (SELECT 1 FROM inserted) AS added
+                FROM current
+                """,
                 {"user_id": int(user_id), "album_id": album_id},
             )
+
+        if row["added"]:
             return True, "Album added to favorites"
 
+        if row["already_added"]:
+            return False, "Already added to favorites"
+
+        return False, "You can have only 3 favorites"
+
     async def get_favorites(self, user_id):
 
-        albums = await database.fetch_all(
+        albums = await reader.fetch_all(
             "SELECT a.album_id as album_id, a.album_name as album_name, a.artist_id as artist_id, a.artist_name as artist_name, a.release_date as release_date, a.cover as cover FROM favorites f join albums a "
             "on f.album_id = a.album_id WHERE user_id = :user_id",
             {"user_id": int(user_id)},
@@ -49,42 +120,72 @@ class UserManager:
 
     async def search_user(self, username):
 
-        user = await database.fetch_one(
-            "select id from users where username = :username", {"username": username}
+        # case-insensitive, returns the user with the username as it was registered
+        user = await reader.fetch_one(
+            "select id, username from users where LOWER(username) = LOWER(:username)",
+            {"username": username},
         )
 
         if not user:
 
             return None
 
-        return user["id"]
+        return dict(user)
+
+    async def autocomplete_users(self, prefix, limit=10):
+
+        # walks users_username_lower_idx from the prefix and stops after `limit` names, so the cost does not depend
+        # on how many users match (~<~ is the index's own byte order); follower counts come from followers_followed_id_idx
+        pattern = (
+            prefix.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        )
+        rows = await reader.fetch_all(
+            """
+            SELECT u.id, u.username,
+                (SELECT COUNT(*) FROM followers f WHERE f.followed_id = u.id) AS follower_count
+            FROM users u
+            WHERE LOWER(u.username) LIKE :pattern
+            ORDER BY LOWER(u.username) USING ~<~
+            LIMIT :limit
+            """,
+            {"pattern": pattern, "limit": limit},
+        )
+
+        return [dict(row) for row in rows]
 
     async def follow_user(self, follower_id, followed_id):
 
         if follower_id == followed_id:
             return False, "You cannot follow yourself"
 
-        existing = await database.execute(
-            "select * from users where id = :followed_id", {"followed_id": followed_id}
+        row = await database.fetch_one(
+            """
+            WITH target AS (
+                SELECT id FROM users WHERE id = :followed_id
+            ),
+            inserted AS (
+                INSERT INTO followers (follower_id, followed_id)
+                SELECT :follower_id, id FROM target
+                ON CONFLICT (follower_id, followed_id) DO NOTHING
+                RETURNING followed_id
+            )
+            SELECT EXISTS (SELECT 1 FROM target) AS found, EXISTS (SELECT 1 FROM inserted) AS followed
+            """,
+            {
+                "follower_id": follower_id,
+                "followed_id": followed_id,
+            },
         )
 
-        if not existing:
+        if not row["found"]:
             return False, "User not found"
 
-        try:
+        if not row["followed"]:
+            return False, "You already follow this user"
 
-            await database.execute(
-                "INSERT INTO followers (follower_id, followed_id) VALUES (:follower_id, :followed_id)",
-                {
-                    "follower_id": follower_id,
-                    "followed_id": followed_id,
-                },
-            )
-            return True, "User followed successfully"
+        await self.apply_follows_to_suggestions(follower_id, [followed_id])
 
-        except Exception:
-
-            return False, "You already follow this user"
+        return True, "User followed successfully"
 
     async def unfollow_user(self, follower_id, followed_id):
 
@@ -95,269 +196,373 @@ class UserManager:
 
         return True, "Successfully unfollowed user"
 
-    async def get_followers(self, user_id):
+    async def follow_users(self, follower_id, followed_ids):
 
-        rows = await database.fetch_all(
-            """
-                SELECT u.id as id, u.username as username
-                FROM followers f
-                JOIN users u
-                ON f.follower_id = u.id
-                WHERE f.followed_id = :user_id
-            """,
-            {"user_id": int(user_id)},
-        )
+        # one multi-row insert for the whole batch; the CTE also tells us which ids exist and which were already followed
+        async with database.transaction():
+            rows = await database.fetch_all(
+                """
+                WITH targets AS (
+                    SELECT id FROM users
+                    WHERE id = ANY(CAST(:followed_ids AS INTEGER[])) AND id <> :follower_id
+                ),
+                inserted AS (
+                    INSERT INTO followers (follower_id, followed_id)
+                    SELECT :follower_id, id FROM targets
+                    ON CONFLICT (follower_id, followed_id) DO NOTHING
+                    RETURNING followed_id
+                )
+                SELECT t.id, i.followed_id IS NOT NULL AS followed
+                FROM targets t
+                LEFT JOIN inserted i ON i.followed_id = t.id
+                """,
+                {"follower_id": follower_id, "followed_ids": list(followed_ids)},
+            )
+        status_by_id = {row["id"]: row["followed"] for row in rows}
+
+        newly_followed = [row["id"] for row in rows if row["followed"]]
+        if newly_followed:
+            await self.apply_follows_to_suggestions(follower_id, newly_followed)
+
+        results = []
+        for followed_id in followed_ids:
+            if followed_id == follower_id:
+                results.append((followed_id, False, "You cannot follow yourself"))
+            elif followed_id not in status_by_id:
+                results.append((followed_id, False, "User not found"))
+            elif status_by_id[followed_id]:
+                results.append((followed_id, True, "User followed successfully"))
+                # a repeated id in the same batch is already followed the second time
+                status_by_id[followed_id] = False
+            else:
+                results.append((followed_id, False, "You already follow this user"))
+
+        return results
+
+    async def unfollow_users(self, follower_id, followed_ids):
+
+        async with database.transaction():
+            rows = await database.fetch_all(
+                """
+                DELETE FROM followers
+                WHERE follower_id = :follower_id AND followed_id = ANY(CAST(:followed_ids AS INTEGER[]))
+                RETURNING followed_id
+                """,
+                {"follower_id": follower_id, "followed_ids": list(followed_ids)},
+            )
+        unfollowed = {row["followed_id"] for row in rows}
 
-        followers = [{"id": row["id"], "username": row["username"]} for row in rows]
+        return [
+            (
+                (followed_id, True, "Successfully unfollowed user")
+                if followed_id in unfollowed
+                else (followed_id, False, "You do not follow this user")
+            )
+            for followed_id in followed_ids
+        ]
+
+    # both lists are keyset paginated on the listed user's id (after = last id of the previous page), which the
+    # (followed_id, follower_id) index and the UNIQUE (follower_id, followed_id) constraint serve directly,
+    # so a page costs the same on an account with 100k followers as on one with 10
+    # viewer_id annotates every listed user with whether the viewer follows them and whether they follow the viewer
+
+    async def get_followers(self, user_id, viewer_id=None, after=0, limit=50):
+
+        rows = await reader.fetch_all(
+            FOLLOWERS_QUERY,
+            {
+                "user_id": int(user_id),
+                "viewer_id": int(viewer_id if viewer_id is not None else user_id),
+                "after": after,
+                "limit": limit,
+            },
+        )
 
-        return followers
+        return [dict(row) for row in rows]
 
-    async def get_following(self, user_id):
+    async def get_following(self, user_id, viewer_id=None, after=0, limit=50):
 
-        rows = await database.fetch_all(
-            """
-                SELECT u.id as id, u.username as username
-                FROM followers f
-                JOIN users u
-                ON f.followed_id = u.id
-                WHERE f.follower_id = :user_id
-            """,
-            {"user_id": int(user_id)},
+        rows = await reader.fetch_all(
+            FOLLOWING_QUERY,
+            {
+                "user_id": int(user_id),
+                "viewer_id": int(viewer_id if viewer_id is not None else user_id),
+                "after": after,
+                "limit": limit,
+            },
         )
 
-        following = [{"id": row["id"], "username": row["username"]} for row in rows]
+        return [dict(row) for row in rows]
 
-        return following
-
-    # RECOMANDATION ENGINE
+    # PEOPLE YOU MAY KNOW
+    # suggestions are computed in batch (a pipeline stage, like the album generators) into user_suggestions and
+    # served from its (user_id, score) index; a new follow updates the follower's suggestions incrementally
 
-    async def other_albums_by_artist(self):
+    async def user_suggestion_candidates(self, user_ids):
 
-        token = await get_spotify_token()
-
-        rows = await database.fetch_all(
-            """
-            SELECT r.album_id, r.user_id, a.artist_name
-            FROM reviews r
-            JOIN albums a ON r.album_id = a.album_id
-            WHERE r.rating >= 3
+        rows = await reader.fetch_all(
             """
+            WITH friends_of_friends AS (
+                SELECT f1.follower_id AS user_id, f2.followed_id AS suggested_id, COUNT(*) AS mutual_count
+                FROM followers f1
+                JOIN followers f2 ON f2.follower_id = f1.followed_id
+                WHERE f1.follower_id = ANY(CAST(:user_ids AS INTEGER[])) AND f2.followed_id <> f1.follower_id
+                GROUP BY 1, 2
+            ),
+            same_taste AS (
+                SELECT mine.user_id, theirs.user_id AS suggested_id, COUNT(*) AS shared_albums
+                FROM reviews mine
+                JOIN reviews theirs
+                    ON theirs.album_id = mine.album_id AND theirs.user_id <> mine.user_id AND theirs.rating >= 3
+                WHERE mine.user_id = ANY(CAST(:user_ids AS INTEGER[])) AND mine.rating >= 3
+                GROUP BY 1, 2
+            ),
+            scored AS (
+                SELECT
+                    COALESCE(fof.user_id, st.user_id) AS user_id,
+                    COALESCE(fof.suggested_id, st.suggested_id) AS suggested_id,
+                    COALESCE(fof.mutual_count, 0) AS mutual_count,
+                    COALESCE(st.shared_albums, 0) AS shared_albums
+                FROM friends_of_friends fof
+                FULL OUTER JOIN same_taste st ON st.user_id = fof.user_id AND st.suggested_id = fof.suggested_id
+            ),
+            ranked AS (
+                -- the weights are cast, an untyped parameter multiplied by a count is bound as an integer (0.5 -> 0)
+                SELECT s.*,
+                    s.mutual_count * CAST(:mutual_weight AS DOUBLE PRECISION)
+                    + s.shared_albums * CAST(:album_weight AS DOUBLE PRECISION) AS score,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY s.user_id
+                        ORDER BY
+                            s.mutual_count * CAST(:mutual_weight AS DOUBLE PRECISION)
+                            + s.shared_albums * CAST(:album_weight AS DOUBLE PRECISION) DESC,
+                            s.suggested_id
+                    ) AS position
+                FROM scored s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM followers already
+                    WHERE already.follower_id = s.user_id AND already.followed_id = s.suggested_id
+                )
+            )
+            SELECT user_id, suggested_id, mutual_count, shared_albums, score
+            FROM ranked
+            WHERE position <= :per_user
+            """,
+            {
+                "user_ids": list(user_ids),
+                "mutual_weight": MUTUAL_FOLLOW_WEIGHT,
+                "album_weight": SHARED_ALBUM_WEIGHT,
+                "per_user": SUGGESTIONS_PER_USER,
+            },
         )
 
-        for row in rows:
-
-            album_id = row["album_id"]
-            user_id = row["user_id"]
-            artist_name = row["artist_name"]
+        return [dict(row) for row in rows]
 
-            artist_albums = await search_for_artist_albums(token, artist_name)
+    @measured("recommendations.user_suggestions")
+    async def compute_user_suggestions(self, user_ids):
 
-            for album in artist_albums:
+        # replaces the suggestions of the whole batch at once
+        rows = await self.user_suggestion_candidates(user_ids)
 
-                artist_album_id = album["id"]
-
-                if artist_album_id == album_id:
-                    continue
-
-                # Insert recommendation
+        async with database.transaction():
+            await database.execute(
+                "DELETE FROM user_suggestions WHERE user_id = ANY(CAST(:user_ids AS INTEGER[]))",
+                {"user_ids": list(user_ids)},
+            )
+            if rows:
                 await database.execute(
                     """
-                    INSERT INTO recommendations (user_id, album_id)
-                    VALUES (:user_id, :album_id)
-                    ON CONFLICT (user_id, album_id) DO NOTHING
+                    INSERT INTO user_suggestions (user_id, suggested_id, mutual_count, shared_albums, score)
+                    SELECT * FROM unnest(
+                        CAST(:user_ids AS INTEGER[]),
+                        CAST(:suggested_ids AS INTEGER[]),
+                        CAST(:mutual_counts AS INTEGER[]),
+                        CAST(:shared_albums AS INTEGER[]),
+                        CAST(:scores AS REAL[])
+                    )
                     """,
                     {
-                        "user_id": user_id,
-                        "album_id": artist_album_id,
+                        "user_ids": [row["user_id"] for row in rows],
+                        "suggested_ids": [row["suggested_id"] for row in rows],
+                        "mutual_counts": [row["mutual_count"] for row in rows],
+                        "shared_albums": [row["shared_albums"] for row in rows],
+                        "scores": [row["score"] for row in rows],
                     },
                 )
 
-                # Check if album already exists
-                existing_album = await database.fetch_one(
-                    "SELECT album_id FROM albums WHERE album_id = :album_id",
-                    {"album_id": artist_album_id},
-                )
+        return len(rows)
+
+    async def apply_follows_to_suggestions(self, follower_id, followed_ids):
+
+        # following someone makes the people they follow friends of friends: bump those suggestions instead of
+        # recomputing the follower's whole neighbourhood, and drop the users that are now followed
+        await database.execute(
+            """
+            INSERT INTO user_suggestions (user_id, suggested_id, mutual_count, score)
+            SELECT :follower_id, f.followed_id, COUNT(*), COUNT(*) * CAST(:mutual_weight AS DOUBLE PRECISION)
+            FROM followers f
+            WHERE f.follower_id = ANY(CAST(:followed_ids AS INTEGER[])) AND f.followed_id <> :follower_id
+            AND NOT EXISTS (
+                SELECT 1 FROM followers mine WHERE mine.follower_id = :follower_id AND mine.followed_id = f.followed_id
+            )
+            GROUP BY f.followed_id
+            ON CONFLICT (user_id, suggested_id) DO UPDATE
+            SET mutual_count = user_suggestions.mutual_count + EXCLUDED.mutual_count,
+                score = user_suggestions.score + EXCLUDED.score
+            """,
+            {
+                "follower_id": follower_id,
+                "followed_ids": list(followed_ids),
+                "mutual_weight": MUTUAL_FOLLOW_WEIGHT,
+            },
+        )
+        await database.execute(
+            """
+            DELETE FROM user_suggestions
+            WHERE user_id = :follower_id AND suggested_id = ANY(CAST(:followed_ids AS INTEGER[]))
+            """,
+            {"follower_id": follower_id, "followed_ids": list(followed_ids)},
+        )
 
-                if existing_album:
-                    continue
+    async def get_user_suggestions(self, user_id, limit=20):
 
-                # Fetch album from Spotify
-                token = await get_spotify_token()
-                album_data = await search_for_album_by_id(token, artist_album_id)
+        rows = await reader.fetch_all(
+            """
+            SELECT u.id, u.username, s.mutual_count, s.shared_albums
+            FROM user_suggestions s
+            JOIN users u ON u.id = s.suggested_id
+            WHERE s.user_id = :user_id
+            ORDER BY s.score DESC
+            LIMIT :limit
+            """,
+            {"user_id": int(user_id), "limit": limit},
+        )
 
-                # Insert album
-                await database.execute(
-                    """
-                    INSERT INTO albums (
-                        album_id,
-                        album_name,
-                        artist_name,
-                        artist_id,
-                        release_date,
-                        cover
-                    )
-                    VALUES (
-                        :album_id,
-                        :album_name,
-                        :artist_name,
-                        :artist_id,
-                        :release_date,
-                        :cover
-                    )
-                    """,
-                    {
-                        "album_id": album_data["id"],
-                        "album_name": album_data["name"],
-                        "artist_name": album_data["artists"][0]["name"],
-                        "artist_id": album_data["artists"][0]["id"],
-                        "release_date": album_data["release_date"],
-                        "cover": album_data["images"][0]["url"],
-                    },
-                )
+        return [dict(row) for row in rows]
 
-    async def albums_by_similar_artists(self):
+    # RECOMANDATION ENGINE
+    # every generator works on a batch of user ids (None = every user with a positive review), so the pipeline can
+    # split users into ranges and run the ranges in parallel; the *_candidates methods only compute
+    # (user_id, album_id) pairs and save_recommendations writes them, inserts are idempotent so a batch can be re-run
 
-        token = await get_spotify_token()
+    async def positive_reviews(self, user_ids=None, album_ids=None):
 
-        rows = await database.fetch_all(
+        # album_ids narrows the reviews to those albums, which is how a single user's refresh stays incremental
+        return await reader.fetch_all(
             """
-            SELECT r.album_id, r.user_id, a.artist_name
+            SELECT r.user_id, r.album_id, a.artist_id
             FROM reviews r
             JOIN albums a ON r.album_id = a.album_id
             WHERE r.rating >= 3
-            """
+            AND (CAST(:user_ids AS INTEGER[]) IS NULL OR r.user_id = ANY(CAST(:user_ids AS INTEGER[])))
+            AND (CAST(:album_ids AS TEXT[]) IS NULL OR r.album_id = ANY(CAST(:album_ids AS TEXT[])))
+            """,
+            {
+                "user_ids": list(user_ids) if user_ids is not None else None,
+                "album_ids": list(album_ids) if album_ids is not None else None,
+            },
         )
 
-        for row in rows:
+    async def save_recommendations(self, pairs, generation=None):
 
-            album_id = row["album_id"]
-            user_id = row["user_id"]
-            artist_name = row["artist_name"]
+        # a full run writes into the generation it is building; without one (refreshes, partial runs) the pairs go
+        # into the active generation and any being built, so they survive the next swap
+        # returns how many pairs are new; a pair written into both live generations is still one recommendation
+        if not pairs:
+            return 0
 
-            related_artists = await search_related_artists(token, artist_name)
+        return await database.fetch_val(
+            """
+            WITH inserted AS (
+                INSERT INTO recommendations (generation, user_id, album_id)
+                SELECT g.generation, t.user_id, t.album_id
+                FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:album_ids AS TEXT[])) AS t(user_id, album_id)
+                CROSS JOIN (
+                    SELECT generation FROM recommendation_generations
+                    WHERE generation = CAST(:generation AS INTEGER)
+                    OR (CAST(:generation AS INTEGER) IS NULL AND status <> 'retired')
+                ) g
+                ON CONFLICT (generation, user_id, album_id) DO NOTHING
+                RETURNING user_id, album_id
+            )
+            SELECT COUNT(*) FROM (SELECT DISTINCT user_id, album_id FROM inserted) AS pairs
+            """,
+            {
+                "user_ids": [user_id for user_id, _ in pairs],
+                "album_ids": [album_id for _, album_id in pairs],
+                "generation": generation,
+            },
+        )
 
-            for related_artist in related_artists:
+    async def artist_candidates(self, user_ids=None, album_ids=None):
 
-                related_artist_name = related_artist["name"]
+        # other albums by the artists of every positively rated album; each artist is looked up once per batch
+        rows = await self.positive_reviews(user_ids, album_ids)
 
-                related_artist_albums = await search_for_artist_albums(
-                    token, related_artist_name
-                )
+        reviewed_by_artist = {}
+        for row in rows:
+            reviewed_by_artist.setdefault(row["artist_id"], []).append(
+                (row["user_id"], row["album_id"])
+            )
 
-                for album in related_artist_albums:
+        pairs = set()
+        for artist_id, reviewed in reviewed_by_artist.items():
+            artist_albums = await get_artist_albums(artist_id)
+            for user_id, album_id in reviewed:
+                for album in artist_albums:
+                    if album.album_id != album_id:
+                        pairs.add((user_id, album.album_id))
 
-                    related_artist_album_id = album["id"]
+        return sorted(pairs)
 
-                    if related_artist_album_id == album_id:
-                        continue
+    async def related_artist_candidates(self, user_ids=None, album_ids=None):
 
-                    await database.execute(
-                        """
-                        INSERT INTO recommendations (user_id, album_id)
-                        VALUES (:user_id, :album_id)
-                        ON CONFLICT (user_id, album_id) DO NOTHING
-                        """,
-                        {
-                            "user_id": user_id,
-                            "album_id": related_artist_album_id,
-                        },
-                    )
+        # albums by the artists Spotify lists as related to the artists of every positively rated album
+        rows = await self.positive_reviews(user_ids, album_ids)
 
-                    existing_album = await database.fetch_one(
-                        "SELECT album_id FROM albums WHERE album_id = :album_id",
-                        {"album_id": related_artist_album_id},
-                    )
-
-                    if existing_album:
-                        continue
+        users_by_artist = {}
+        for row in rows:
+            users_by_artist.setdefault(row["artist_id"], set()).add(row["user_id"])
 
-                    token = await get_spotify_token()
-                    album_data = await search_for_album_by_id(
-                        token, related_artist_album_id
-                    )
+        pairs = set()
+        for artist_id, users in users_by_artist.items():
+            for related_artist in await get_related_artists(artist_id):
+                related_artist_albums = await get_artist_albums(
+                    related_artist.artist_id, related_artist.artist_name
+                )
+                for user_id in users:
+                    for album in related_artist_albums:
+                        pairs.add((user_id, album.album_id))
 
-                    await database.execute(
-                        """
-                        INSERT INTO albums (
-                            album_id,
-                            album_name,
-                            artist_name,
-                            artist_id,
-                            release_date,
-                            cover
-                        )
-                        VALUES (
-                            :album_id,
-                            :album_name,
-                            :artist_name,
-                            :artist_id,
-                            :release_date,
-                            :cover
-                        )
-                        """,
-                        {
-                            "album_id": album_data["id"],
-                            "album_name": album_data["name"],
-                            "artist_name": album_data["artists"][0]["name"],
-                            "artist_id": album_data["artists"][0]["id"],
-                            "release_date": album_data["release_date"],
-                            "cover": album_data["images"][0]["url"],
-                        },
-                    )
+        return sorted(pairs)
 
-    async def collaborative_filtering(self):
+    async def collaborative_candidates(self, user_ids=None, album_ids=None):
 
-        rows = await database.fetch_all(
-            """
-            SELECT album_id, user_id
-            FROM reviews
-            WHERE rating >= 3
-            """
+        rows = await reader.fetch_all(
+            COLLABORATIVE_CANDIDATES_QUERY,
+            {
+                "user_ids": list(user_ids) if user_ids is not None else None,
+                "album_ids": list(album_ids) if album_ids is not None else None,
+            },
         )
 
-        for row in rows:
+        return [(row["user_id"], row["album_id"]) for row in rows]
 
-            album_id = row["album_id"]
-            user_id = row["user_id"]
+    @measured("recommendations.other_albums_by_artist")
+    async def other_albums_by_artist(self, user_ids=None, generation=None):
 
-            other_users = await database.fetch_all(
-                """
-                SELECT DISTINCT user_id
-                FROM reviews
-                WHERE rating >= 3
-                AND album_id = :album_id
-                AND user_id != :user_id
-                """,
-                {
-                    "album_id": album_id,
-                    "user_id": user_id,
-                },
-            )
+        return await self.save_recommendations(await self.artist_candidates(user_ids), generation)
 
-            for other_user in other_users:
+    @measured("recommendations.albums_by_similar_artists")
+    async def albums_by_similar_artists(self, user_ids=None, generation=None):
 
-                other_user_id = other_user["user_id"]
+        return await self.save_recommendations(
+            await self.related_artist_candidates(user_ids), generation
+        )
 
-                albums_to_recommend = await database.fetch_all(
-                    """
-                    SELECT album_id
-                    FROM reviews
-                    WHERE user_id = :other_user_id
-                    AND rating >= 3
-                    """,
-                    {"other_user_id": other_user_id},
-                )
+    @measured("recommendations.collaborative_filtering")
+    async def collaborative_filtering(self, user_ids=None, generation=None):
 
-                for album in albums_to_recommend:
-
-                    await database.execute(
-                        """
-                        INSERT INTO recommendations (user_id, album_id)
-                        VALUES (:user_id, :album_id)
-                        ON CONFLICT (user_id, album_id) DO NOTHING
-                        """,
-                        {
-                            "user_id": user_id,
-                            "album_id": album["album_id"],
-                        },
-                    )
+        return await self.save_recommendations(
+            await self.collaborative_candidates(user_ids), generation
+        )